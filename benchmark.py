@@ -0,0 +1,383 @@
+#! /usr/bin/env python
+
+''' How fast do splits, merges, validations and repairs go?
+
+Generates synthetic sources (the same bytes every time, for a given seed),
+runs each operation over a matrix of buffer sizes and chunk counts, and
+prints the results as JSON. Every operation runs in a process of its own,
+so its peak RSS and CPU time are its own too.
+
+Save the output from one commit and hand it to --compare on the next to
+find out what got slower:
+./benchmark.py -o before.json
+(change things)
+./benchmark.py --compare before.json
+
+The sources are in the page cache by the time anything reads them, unless
+--cold can drop it (which takes root). Use -d to put them on tmpfs (to
+measure the code) or on a real disk (to measure the disk). '''
+
+import binascii, getopt, json, logging, multiprocessing, os, platform, random
+import resource, shutil, subprocess, sys, tempfile, time
+import splice, ui
+
+# What the sources can look like
+KINDS = ('random', 'text', 'mixed', 'zeros', 'sparse')
+OPERATIONS = ('split', 'validate', 'verify', 'merge', 'repair')
+
+# Bumped whenever the results change meaning, so --compare can refuse
+_FORMAT = 1
+
+# Sources get written this much at a time
+_BLOCK = 1024 * 1024
+
+_TEXT = "The quick red fox jumped over the lazy brown dog. Now is the time for all good men.\n"
+
+def _RandomBytes(generator, size):
+    if not size:
+        return ''
+    return binascii.unhexlify('%0*x' % (size * 2, generator.getrandbits(size * 8)))
+
+def _Block(generator, size, kind, entropy):
+    ''' One block of a source. generator is seeded, so this is reproducible '''
+    if kind == 'random':
+        entropy = 1.0
+    elif kind == 'text':
+        entropy = 0.0
+    elif kind in ('zeros', 'sparse'):
+        # Mostly nothing. The odd block's real data
+        if generator.random() >= 0.1:
+            return None
+        entropy = 1.0
+
+    noisy = int(size * entropy)
+    text = (_TEXT * (size / len(_TEXT) + 1))[:size - noisy]
+    return _RandomBytes(generator, noisy) + text
+
+def Generate(path, size, kind='random', entropy=0.5, seed=0):
+    ''' Write a source of size bytes to path.
+
+    random: incompressible
+    text: one line of text, over and over
+    mixed: each block is entropy random, the rest text
+    zeros: 90% of the blocks are zeros
+    sparse: like zeros, except those blocks are holes in the file '''
+    if kind not in KINDS:
+        raise ValueError("Unknown kind of source '%s'. Have: %s" % (kind, ", ".join(KINDS)))
+    generator = random.Random(seed)
+    with open(path, "wb") as destination:
+        written = 0
+        while written < size:
+            count = min(_BLOCK, size - written)
+            block = _Block(generator, count, kind, entropy)
+            if block is None and kind == 'sparse':
+                destination.seek(count, 1)
+            else:
+                destination.write(block or '\0' * count)
+            written += count
+        destination.truncate(size)
+
+def _Child(function, args, results):
+    try:
+        before = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        started = time.time()
+        function(*args)
+        seconds = time.time() - started
+        after = resource.getrusage(resource.RUSAGE_SELF)
+        finished = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+        cpu = (after.ru_utime - before.ru_utime + after.ru_stime - before.ru_stime
+               + finished.ru_utime - children.ru_utime + finished.ru_stime - children.ru_stime)
+        results.put({'seconds': seconds,
+                     'cpu_seconds': cpu,
+                     # Kilobytes, on Linux. Includes any compression processes
+                     'peak_rss_kb': max(after.ru_maxrss, finished.ru_maxrss)})
+    except Exception, e:
+        logging.getLogger("splice.benchmark").exception("Benchmark failed")
+        results.put({'error': str(e)})
+
+def Measure(function, *args):
+    ''' Run function(*args) in a process of its own. Returns what it cost '''
+    results = multiprocessing.Queue()
+    child = multiprocessing.Process(target=_Child, args=(function, args, results))
+    child.start()
+    result = results.get()
+    child.join()
+    if 'error' in result:
+        raise RuntimeError(result['error'])
+    return result
+
+def _Splicer(settings):
+    splicer = splice.Splicer(ui.DoesNothing())
+    for setter, value in settings:
+        getattr(splicer, setter)(value)
+    return splicer
+
+def _Split(source_path, directory, buffer_size, settings, repairing=False):
+    splicer = _Splicer(settings)
+    splicer.BufferSize(buffer_size)
+    splicer.SetRepairSplice(repairing)
+    splicer.WorkingDirectory(directory)
+    splicer.SourceFileName(os.path.basename(source_path))
+    with open(source_path, "rb") as source:
+        splicer.Source(source)
+        splicer.Operate()
+
+def _Check(directory, name, level, settings):
+    splicer = _Splicer(settings)
+    splicer.WorkingDirectory(directory)
+    splicer.SetValidateMode(level=level)
+    splicer.SourceFileName(name + ".details")
+    if not splicer.Operate():
+        raise RuntimeError("%s validation of '%s' failed" % (level, directory))
+
+def _Merge(directory, name, destination, settings):
+    splicer = _Splicer(settings)
+    splicer.SetMergeMode()
+    splicer.WorkingDirectory(directory)
+    splicer.SourceFileName(name + ".details")
+    splicer.MergeDestination(destination)
+    if not splicer.Operate():
+        raise RuntimeError("Merging '%s' failed its checksum" % (directory,))
+
+def _DropCaches():
+    ''' Returns whether it worked '''
+    try:
+        os.system("sync")
+        with open("/proc/sys/vm/drop_caches", "w") as caches:
+            caches.write("3\n")
+        return True
+    except IOError:
+        return False
+
+def _Best(measure, repeat, prepare, cold):
+    best = None
+    for attempt in range(repeat):
+        prepare()
+        if cold:
+            _DropCaches()
+        result = measure()
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+    return best
+
+def _Remove(*paths):
+    for path in paths:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+def Run(directory, kinds=('random',), buffer_sizes=(1024 * 1024,), chunk_counts=(64,),
+        operations=OPERATIONS, entropy=0.5, repeat=3, seed=0, settings=(), maximum=2 ** 30,
+        cold=False):
+    ''' Benchmark every combination. Returns a list of dicts, one per
+    (kind, buffer size, chunk count, operation). Each source is buffer size
+    times chunk count bytes, which can't be more than maximum '''
+    logger = logging.getLogger("splice.benchmark")
+    if cold and not _DropCaches():
+        logger.warn("Can't drop the page cache (not root?). Everything's warm")
+        cold = False
+    for operation in operations:
+        if operation not in OPERATIONS:
+            raise ValueError("Unknown operation '%s'. Have: %s" % (operation, ", ".join(OPERATIONS)))
+
+    results = []
+    for kind in kinds:
+        for buffer_size in buffer_sizes:
+            for chunk_count in chunk_counts:
+                size = buffer_size * chunk_count
+                if size > maximum:
+                    logger.info("Skipping %d chunks of %d bytes: too big" % (chunk_count, buffer_size))
+                    continue
+                case = {'kind': kind,
+                        'entropy': kind == 'mixed' and entropy or None,
+                        'size': size,
+                        'buffer_size': buffer_size,
+                        'chunks': chunk_count}
+                results.extend(_RunCase(directory, case, operations, repeat, seed, list(settings), cold))
+    return results
+
+def _RunCase(directory, case, operations, repeat, seed, settings, cold):
+    scratch = tempfile.mkdtemp(prefix="benchmark-", dir=directory)
+    try:
+        name = "source.bin"
+        source_path = os.path.join(scratch, name)
+        Generate(source_path, case['size'], case['kind'], case['entropy'], seed)
+        split = os.path.join(scratch, name + ".split")
+        rescued = os.path.join(scratch, "rescued")
+        merged = os.path.join(scratch, "merged.bin")
+
+        def Split():
+            return Measure(_Split, source_path, scratch, case['buffer_size'], settings)
+        work = {
+            'split': (Split, lambda: _Remove(split)),
+            'validate': (lambda: Measure(_Check, split, name, 'stat', settings), lambda: None),
+            'verify': (lambda: Measure(_Check, split, name, 'full', settings), lambda: None),
+            'merge': (lambda: Measure(_Merge, split, name, merged, settings), lambda: _Remove(merged)),
+            'repair': (lambda: Measure(_Split, source_path, rescued, case['buffer_size'], settings, True),
+                       lambda: (_Remove(rescued), os.mkdir(rescued))),
+            }
+
+        results = []
+        for operation in OPERATIONS:
+            if operation not in operations:
+                if operation == 'split' and set(operations) & set(('validate', 'verify', 'merge')):
+                    # Everything else needs something to work on
+                    Split()
+                continue
+            measure, prepare = work[operation]
+            result = dict(case)
+            result['operation'] = operation
+            result.update(_Best(measure, repeat, prepare, cold))
+            if operation == 'validate':
+                # Reads nothing but directories. Throughput means nothing
+                result['mb_per_second'] = None
+            else:
+                result['mb_per_second'] = round(case['size'] / result['seconds'] / 2 ** 20, 2)
+            result['chunks_per_second'] = round(case['chunks'] / result['seconds'], 1)
+            result['seconds'] = round(result['seconds'], 4)
+            result['cpu_seconds'] = round(result['cpu_seconds'], 4)
+            results.append(result)
+        return results
+    finally:
+        shutil.rmtree(scratch)
+
+def _Commit():
+    ''' Which commit this is, when it's a git checkout '''
+    try:
+        here = os.path.dirname(os.path.abspath(__file__))
+        with open(os.devnull, "w") as nowhere:
+            return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=here, stderr=nowhere).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def Environment():
+    return {'format': _FORMAT,
+            'commit': _Commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': multiprocessing.cpu_count()}
+
+def _Key(result):
+    return (result['kind'], result['entropy'], result['buffer_size'], result['chunks'], result['operation'])
+
+def Compare(baseline, current, tolerance=0.1):
+    ''' Every case that took more than tolerance longer than it used to, as
+    (case, old seconds, new seconds) '''
+    if baseline.get('format') != current.get('format'):
+        raise ValueError("Those results are in different formats. Can't compare them")
+    before = dict((_Key(result), result) for result in baseline['results'])
+    slower = []
+    for result in current['results']:
+        old = before.get(_Key(result))
+        if old is not None and result['seconds'] > old['seconds'] * (1 + tolerance):
+            slower.append((_Key(result), old['seconds'], result['seconds']))
+    return slower
+
+def _Sizes(argument):
+    ''' "64K,1M,16M" => [65536, 1048576, 16777216] '''
+    sizes = []
+    for size in argument.split(','):
+        multiplier = 1
+        if size[-1:].upper() in ('K', 'M', 'G'):
+            multiplier = 1024 ** ('KMG'.index(size[-1].upper()) + 1)
+            size = size[:-1]
+        sizes.append(int(size) * multiplier)
+    return sizes
+
+def usage():
+    return """./benchmark.py [-d directory] [-k kinds] [-b sizes] [-c counts] [-p operations] [-o output]
+-d directory: where the sources go (default: the temp directory). tmpfs measures the code, a disk measures the disk
+-k kinds: comma separated, from %s (default random)
+-e fraction: how much of each block of a mixed source is random (default 0.5)
+-b sizes: buffer sizes to try, comma separated, with K/M/G suffixes (default 1M)
+-c counts: chunk counts to try, comma separated (default 64). Each source is a buffer size times a chunk count
+-p operations: comma separated, from %s (default all)
+-r repeat: run everything this many times, and keep the fastest (default 3)
+-s seed: what the sources get generated from (default 0)
+-m size: skip any source bigger than this (default 1G)
+--set Setter=value: call that Splicer setter every time (e.g. Workers=4). Repeatable
+--cold: drop the page cache before everything (needs root)
+-o file: write the results there instead of STDOUT
+--compare file: compare with earlier results. Exits with 1 if anything got slower
+--tolerance fraction: how much slower counts (default 0.1)""" % (", ".join(KINDS), ", ".join(OPERATIONS))
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "hd:k:e:b:c:p:r:s:m:o:",
+                                   ["help", "set=", "cold", "compare=", "tolerance="])
+    except getopt.GetoptError, e:
+        print e
+        print usage()
+        return 2
+
+    arguments = {}
+    output = None
+    baseline = None
+    tolerance = 0.1
+    settings = []
+    directory = None
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            print usage()
+            return 0
+        elif opt == "-d":
+            directory = arg
+        elif opt == "-k":
+            arguments['kinds'] = arg.split(',')
+        elif opt == "-e":
+            arguments['entropy'] = float(arg)
+        elif opt == "-b":
+            arguments['buffer_sizes'] = _Sizes(arg)
+        elif opt == "-c":
+            arguments['chunk_counts'] = [int(count) for count in arg.split(',')]
+        elif opt == "-p":
+            arguments['operations'] = arg.split(',')
+        elif opt == "-r":
+            arguments['repeat'] = int(arg)
+        elif opt == "-s":
+            arguments['seed'] = int(arg)
+        elif opt == "-m":
+            arguments['maximum'] = _Sizes(arg)[0]
+        elif opt == "--set":
+            setter, value = arg.split('=', 1)
+            try:
+                value = int(value)
+            except ValueError:
+                pass
+            settings.append((setter, value))
+        elif opt == "--cold":
+            arguments['cold'] = True
+        elif opt == "-o":
+            output = arg
+        elif opt == "--compare":
+            with open(arg) as previous:
+                baseline = json.load(previous)
+        elif opt == "--tolerance":
+            tolerance = float(arg)
+
+    # The splicer's debug logging would be most of what got measured
+    logging.getLogger().setLevel(logging.WARNING)
+
+    report = Environment()
+    report['settings'] = settings
+    report['results'] = Run(directory or tempfile.gettempdir(), settings=settings, **arguments)
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if output is None:
+        print text
+    else:
+        with open(output, "w") as destination:
+            destination.write(text + "\n")
+
+    if baseline is not None:
+        slower = Compare(baseline, report, tolerance)
+        for key, old, new in slower:
+            sys.stderr.write("Slower: %s %s (was %.4fs, now %.4fs)\n" % (key[-1], key[:-1], old, new))
+        if slower:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
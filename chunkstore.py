@@ -0,0 +1,165 @@
+#! /usr/bin/env python
+
+''' Content-defined chunking, and somewhere to keep the chunks it finds.
+
+Fixed-size chunks only line up between two versions of a file if nothing
+ever got inserted or deleted. Cutting wherever a rolling hash of the last
+few bytes hits a magic value means the cuts move along with the content,
+so successive snapshots of the same image mostly produce the same chunks.
+Keeping those in one store, named by their digest, means each distinct
+chunk only ever gets written once. '''
+
+import hashlib, logging, os, tempfile
+
+try:
+    import numpy
+except ImportError:
+    # Content-defined chunking just runs a lot slower without it
+    numpy = None
+
+# Gear table for the rolling hash (as in FastCDC). Derived from sha256 rather
+# than random(), so it can never change out from under an existing store
+_GEAR = [int(hashlib.sha256(chr(i)).hexdigest()[:8], 16) for i in range(256)]
+
+def _Mask(bits):
+    ''' The top bits of the 32-bit hash. Those depend on the last 32 bytes '''
+    bits = max(1, min(31, bits))
+    return ((1 << bits) - 1) << (32 - bits)
+
+def _FindCut(data, start, end, minimum, average, maximum):
+    ''' Where does the chunk starting at start end? data is a bytearray '''
+    available = end - start
+    if available <= minimum:
+        return end
+    limit = start + min(available, maximum)
+    normal = start + min(available, average)
+
+    bits = max(1, average.bit_length() - 1)
+    # "Normalized" chunking: harder to cut before the average size, easier
+    # after, which keeps the sizes bunched up around the average
+    strict, loose = _Mask(bits + 1), _Mask(bits - 1)
+
+    if numpy is not None and average >= _NUMPY_AVERAGE:
+        return _NumpyCut(data, start + minimum, normal, limit, strict, loose)
+
+    gear = _GEAR
+    rolling = 0
+    i = start + minimum
+    while i < normal:
+        rolling = ((rolling << 1) + gear[data[i]]) & 0xFFFFFFFF
+        i += 1
+        if not rolling & strict:
+            return i
+    while i < limit:
+        rolling = ((rolling << 1) + gear[data[i]]) & 0xFFFFFFFF
+        i += 1
+        if not rolling & loose:
+            return i
+    return limit
+
+# How much of the source _NumpyCut hashes at a go
+_SCAN_SIZE = 64 * 1024
+# Smaller chunks than this cost numpy more in calls than it saves
+_NUMPY_AVERAGE = 4 * 1024
+
+def _NumpyCut(data, origin, normal, limit, strict, loose):
+    ''' _FindCut's loops, a whole stretch of hashes at a time.
+
+    The hash after any byte is the sum of the last 32 bytes' gear values,
+    each shifted left by how many bytes ago it was (anything older has been
+    shifted out the top). So every position's hash comes straight from the
+    bytes before it, by doubling: pairs, then fours, and so on up to 32.
+    The same cuts as the loops, down to the byte. '''
+    for begin, stop, mask in ((origin, normal, strict), (normal, limit, loose)):
+        for piece in xrange(begin, stop, _SCAN_SIZE):
+            end = min(stop, piece + _SCAN_SIZE)
+            # Hashing starts over at origin, so nothing before it counts
+            context = max(origin, piece - 31)
+            hashes = _GEAR_ARRAY[numpy.frombuffer(data, numpy.uint8, end - context, context)]
+            span = 1
+            while span < 32:
+                # uint32 drops whatever goes off the top, like & 0xFFFFFFFF
+                hashes[span:] += hashes[:-span] << span
+                span *= 2
+            hits = numpy.flatnonzero(hashes[piece - context:] & mask == 0)
+            if len(hits):
+                return piece + int(hits[0]) + 1
+    return limit
+
+if numpy is not None:
+    _GEAR_ARRAY = numpy.array(_GEAR, dtype=numpy.uint32)
+
+def ContentDefinedChunks(source, minimum, average, maximum):
+    ''' Yields the chunks of source (anything with a read()), as strings.
+
+    Never holds more than about twice maximum bytes at once, so it's fine
+    for pipes and for sources bigger than memory. '''
+    if not 0 < minimum <= average <= maximum:
+        raise ValueError("Chunk sizes need 0 < minimum <= average <= maximum")
+
+    pending = bytearray()
+    start = 0
+    at_eof = False
+    while True:
+        if not at_eof and len(pending) - start < maximum:
+            # Drop what's already been handed out, then top up
+            del pending[:start]
+            start = 0
+            bytes = source.read(maximum)
+            if bytes:
+                pending.extend(bytes)
+                continue
+            at_eof = True
+
+        if start >= len(pending):
+            return
+        cut = _FindCut(pending, start, len(pending), minimum, average, maximum)
+        yield str(pending[start:cut])
+        start = cut
+
+class ChunkStore:
+    ''' Directory of chunks named by their sha256, shared between splits.
+
+    Fanned out one level on the first two hex digits so no single
+    directory gets enormous. '''
+    def __init__(self, path):
+        self.__path = path
+        self.__logger = logging.getLogger("splice.ChunkStore")
+
+    def Path(self, digest=None):
+        if digest is None:
+            return self.__path
+        return os.path.join(self.__path, digest[:2], digest + '.chunk')
+
+    def Contains(self, digest, size=None):
+        path = self.Path(digest)
+        if not os.path.exists(path):
+            return False
+        # Cheap guard against leftovers that got truncated somehow
+        return size is None or os.path.getsize(path) == size
+
+    def Put(self, digest, block):
+        ''' Returns False if the store already had it. Thread safe '''
+        if self.Contains(digest, len(block)):
+            return False
+
+        directory = os.path.dirname(self.Path(digest))
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another writer beat us to it
+                if not os.path.isdir(directory):
+                    raise
+
+        # Write it under a temporary name first, so nobody else (including
+        # another split running at the same time) ever sees half a chunk
+        handle, temporary = tempfile.mkstemp(dir=directory, suffix='.partial')
+        try:
+            with os.fdopen(handle, "wb") as destination:
+                destination.write(block)
+            os.rename(temporary, self.Path(digest))
+        except:
+            os.remove(temporary)
+            raise
+        return True
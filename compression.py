@@ -0,0 +1,132 @@
+#! /usr/bin/env python
+
+''' Per-chunk compression, spread across processes.
+
+Compressing is about the only CPU-bound thing a split ever does, so it
+gets real processes instead of threads. Each chunk gets compressed on its
+own, which is what lets them all go in parallel (and lets a merge, or a
+validation, decompress any one chunk without the others). '''
+
+import bz2, multiprocessing, zlib
+
+try:
+    import lzma
+except ImportError:
+    # Not in the python 2 stdlib. The backport provides the same interface
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# name => (compress(bytes, level), decompress(bytes), default level)
+_CODECS = {
+    'zlib': (zlib.compress, zlib.decompress, 6),
+    'bz2': (bz2.compress, bz2.decompress, 9),
+}
+if lzma is not None:
+    _CODECS['lzma'] = (lambda bytes, level: lzma.compress(bytes, preset=level),
+                       lzma.decompress, 6)
+
+# What a chunk that wasn't worth compressing gets recorded as
+RAW = 'raw'
+
+# Anything that doesn't shrink by at least this much gets stored as is.
+# Saves every later read from paying for a decompression that buys nothing
+_WORTHWHILE = 0.97
+
+# How much of a chunk to test-compress (quickly) before bothering with the rest
+_SAMPLE = 64 * 1024
+
+def Available():
+    ''' Which codecs this python can actually use '''
+    return sorted(_CODECS)
+
+def _Compress(codec, level, block):
+    ''' Returns (codec actually used, bytes to store). Runs in a worker process '''
+    compress = _CODECS[codec][0]
+    if level is None:
+        level = _CODECS[codec][2]
+
+    if len(block) > 2 * _SAMPLE:
+        # Already compressed, or encrypted, or random. Find out cheaply
+        sample = block[:_SAMPLE]
+        if len(zlib.compress(sample, 1)) >= len(sample) * _WORTHWHILE:
+            return RAW, block
+
+    compressed = compress(block, level)
+    if len(compressed) >= len(block) * _WORTHWHILE:
+        return RAW, block
+    return codec, compressed
+
+def _Decompress(codec, data):
+    if codec == RAW:
+        return data
+    return _CODECS[codec][1](data)
+
+class Pool:
+    ''' Processes that compress and decompress chunks.
+
+    Compress and Decompress block until their chunk is done, and any number
+    of threads can call them at once, so a thread pool in front of this one
+    keeps every process busy. With 0 processes, everything runs inline. '''
+    def __init__(self, codec, level=None, processes=None):
+        if codec != RAW and codec not in _CODECS:
+            raise ValueError("Unknown compression '%s'. Have: %s" % (codec, ", ".join(Available())))
+        self.__codec = codec
+        self.__level = level
+
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.__pool = None
+        if processes:
+            self.__pool = multiprocessing.Pool(processes)
+
+    def Codec(self):
+        return self.__codec
+
+    def Compress(self, block):
+        ''' Returns (codec actually used, bytes to store) '''
+        if self.__codec == RAW:
+            return RAW, block
+        return self.__Call(_Compress, self.__codec, self.__level, str(block))
+
+    def Decompress(self, codec, data):
+        if codec == RAW:
+            return data
+        return self.__Call(_Decompress, codec, data)
+
+    def Decompressed(self, chunks, window):
+        ''' Decompress a stream of (index, codec, data), at most window chunks
+        at a time. Yields (index, bytes), in the original order '''
+        if self.__pool is None:
+            for index, codec, data in chunks:
+                yield index, _Decompress(codec, data)
+            return
+
+        pending = []
+        for index, codec, data in chunks:
+            if codec == RAW:
+                # No point shipping it off to another process and back
+                pending.append((index, None, data))
+            else:
+                pending.append((index, self.__pool.apply_async(_Decompress, (codec, data)), None))
+            if len(pending) > window:
+                yield self.__Finish(*pending.pop(0))
+        for item in pending:
+            yield self.__Finish(*item)
+
+    def Close(self):
+        if self.__pool is not None:
+            self.__pool.close()
+            self.__pool.join()
+            self.__pool = None
+
+    def __Finish(self, index, result, data):
+        if result is not None:
+            data = result.get()
+        return index, data
+
+    def __Call(self, function, *args):
+        if self.__pool is None:
+            return function(*args)
+        return self.__pool.apply(function, args)
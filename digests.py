@@ -0,0 +1,91 @@
+#! /usr/bin/env python
+
+''' Which digest a split records for each chunk (and the whole file).
+
+sha256 is what every splice used before there was a choice, and what a
+.details without a Digest header means. It's also the slowest part of a
+split on any decent disk. So the others:
+- blake2b and blake2s are cryptographic, and faster than sha256 in
+  software. hashlib has them from python 3.6. The pyblake2 package
+  provides them for python 2
+- sha1 is faster than sha256 most places. Fine for catching corruption,
+  not for standing up to somebody who's trying
+- crc32 and adler32 (and crc32c, with the crc32c package) only catch
+  accidents, but they're several times faster again
+
+Turning hashing off altogether is Splicer.Hashing(False). Everything here
+hands back something with update(), digest() and hexdigest(), the way
+hashlib does. '''
+
+import hashlib, struct, zlib
+
+try:
+    import pyblake2
+except ImportError:
+    pyblake2 = None
+
+try:
+    import crc32c
+except ImportError:
+    crc32c = None
+
+DEFAULT = 'sha256'
+
+class _Checksum:
+    ''' A running zlib-style checksum, dressed up as a hashlib object '''
+    def __init__(self, function):
+        self.__function = function
+        # adler32 starts at 1, the CRCs at 0
+        self.__value = function('')
+
+    def update(self, data):
+        if isinstance(data, (bytearray, memoryview)):
+            # zlib only takes strings and buffer objects
+            data = buffer(data.tobytes())
+        self.__value = self.__function(data, self.__value)
+
+    def digest(self):
+        # python 2's zlib hands back signed values
+        return struct.pack('>I', self.__value & 0xffffffff)
+
+    def hexdigest(self):
+        return self.digest().encode('hex')
+
+# name => (factory, cryptographic?)
+_ALGORITHMS = {
+    'md5': (hashlib.md5, True),
+    'sha1': (hashlib.sha1, True),
+    'sha256': (hashlib.sha256, True),
+    'sha512': (hashlib.sha512, True),
+    'crc32': (lambda: _Checksum(zlib.crc32), False),
+    'adler32': (lambda: _Checksum(zlib.adler32), False),
+}
+for name in ('blake2b', 'blake2s'):
+    if hasattr(hashlib, name):
+        _ALGORITHMS[name] = (getattr(hashlib, name), True)
+    elif pyblake2 is not None:
+        _ALGORITHMS[name] = (getattr(pyblake2, name), True)
+if crc32c is not None and hasattr(crc32c, 'crc32c'):
+    _ALGORITHMS['crc32c'] = (lambda: _Checksum(crc32c.crc32c), False)
+
+def Available():
+    ''' Which digests this python can actually compute '''
+    return sorted(_ALGORITHMS)
+
+def Check(name):
+    if name not in _ALGORITHMS:
+        raise ValueError("Unknown digest '%s'. Have: %s" % (name, ", ".join(Available())))
+
+def New(name, data=None):
+    ''' A fresh digest object. Raises ValueError for anything this python
+    can't compute (like blake2b, without python 3.6 or pyblake2) '''
+    Check(name)
+    digest = _ALGORITHMS[name][0]()
+    if data is not None:
+        digest.update(data)
+    return digest
+
+def IsCryptographic(name):
+    ''' Is it safe to name things by it? '''
+    Check(name)
+    return _ALGORITHMS[name][1]
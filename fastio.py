@@ -0,0 +1,302 @@
+#! /usr/bin/env python
+
+''' Kernel-side copies, for when the bytes don't need to visit Python at all '''
+
+# The os module only grew copy_file_range/sendfile in python 3. Until then,
+# go straight to libc for them. Everything degrades to plain reads and
+# writes when neither is available (or the filesystem refuses).
+
+import ctypes, errno, fcntl, logging, mmap, os, stat, struct, threading
+
+try:
+    from os import scandir as _scandir
+except ImportError:
+    # Python 3.5 and later. Older ones might have the backport
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
+_logger = logging.getLogger("splice.fastio")
+
+try:
+    _libc = ctypes.CDLL(None, use_errno=True)
+except OSError:
+    _libc = None
+
+def _LibcFunction(name, restype, argtypes):
+    function = getattr(_libc, name, None)
+    if function is not None:
+        function.restype = restype
+        function.argtypes = argtypes
+    return function
+
+_copy_file_range = _LibcFunction("copy_file_range", ctypes.c_ssize_t,
+                                 [ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+                                  ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+                                  ctypes.c_size_t, ctypes.c_uint])
+_sendfile = _LibcFunction("sendfile", ctypes.c_ssize_t,
+                          [ctypes.c_int, ctypes.c_int,
+                           ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t])
+
+# Errors that mean "this kernel/filesystem can't do that," as opposed to
+# genuine I/O problems
+_UNSUPPORTED = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP)
+
+# Flipped off the first time the kernel turns one down, so we don't keep asking
+_use_copy_file_range = _copy_file_range is not None
+_use_sendfile = _sendfile is not None
+
+# The fallbacks have to seek descriptors that other threads may be sharing
+_position_lock = threading.Lock()
+
+def _Raise():
+    code = ctypes.get_errno()
+    raise OSError(code, os.strerror(code))
+
+def _CopyFileRange(source_fd, destination_fd, offset, count, destination_offset):
+    source_position = ctypes.c_int64(offset)
+    destination_position = ctypes.c_int64(destination_offset)
+    copied = 0
+    while copied < count:
+        result = _copy_file_range(source_fd, ctypes.byref(source_position),
+                                  destination_fd, ctypes.byref(destination_position),
+                                  count - copied, 0)
+        if result < 0:
+            _Raise()
+        if result == 0:
+            # EOF
+            break
+        copied += result
+    return copied
+
+def _SendFile(source_fd, destination_fd, offset, count, destination_offset):
+    source_position = ctypes.c_int64(offset)
+    copied = 0
+    while copied < count:
+        with _position_lock:
+            # sendfile writes wherever the destination happens to be pointing
+            os.lseek(destination_fd, destination_offset + copied, os.SEEK_SET)
+            result = _sendfile(destination_fd, source_fd, ctypes.byref(source_position),
+                               count - copied)
+        if result < 0:
+            _Raise()
+        if result == 0:
+            break
+        copied += result
+    return copied
+
+def _ReadWrite(source_fd, destination_fd, offset, count, destination_offset):
+    copied = 0
+    while copied < count:
+        with _position_lock:
+            os.lseek(source_fd, offset + copied, os.SEEK_SET)
+            bytes = os.read(source_fd, min(count - copied, 1024 * 1024))
+        if not bytes:
+            break
+        while bytes:
+            with _position_lock:
+                os.lseek(destination_fd, destination_offset + copied, os.SEEK_SET)
+                written = os.write(destination_fd, bytes)
+            bytes = bytes[written:]
+            copied += written
+    return copied
+
+def CopyRange(source_fd, destination_fd, offset, count, destination_offset=0):
+    ''' Copy count bytes starting at offset in the source to destination_offset
+    in the destination. Neither descriptor's file position matters, so it's
+    safe to call from several threads sharing descriptors.
+
+    Returns the number of bytes actually copied, which is short at EOF. '''
+    global _use_copy_file_range, _use_sendfile
+
+    if _use_copy_file_range:
+        try:
+            return _CopyFileRange(source_fd, destination_fd, offset, count, destination_offset)
+        except OSError, e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+            _logger.info("copy_file_range unavailable (%s). Trying sendfile" % (e,))
+            _use_copy_file_range = False
+
+    if _use_sendfile:
+        try:
+            return _SendFile(source_fd, destination_fd, offset, count, destination_offset)
+        except OSError, e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+            _logger.info("sendfile unavailable (%s). Copying through user space" % (e,))
+            _use_sendfile = False
+
+    return _ReadWrite(source_fd, destination_fd, offset, count, destination_offset)
+
+def WriteAt(fd, offset, data):
+    ''' Write all of data at offset, without disturbing anybody else's writes
+    to the same descriptor (os.pwrite doesn't exist until python 3) '''
+    written = 0
+    while written < len(data):
+        with _position_lock:
+            os.lseek(fd, offset + written, os.SEEK_SET)
+            written += os.write(fd, buffer(data, written))
+    return written
+
+_posix_fallocate = _LibcFunction("posix_fallocate", ctypes.c_int,
+                                 [ctypes.c_int, ctypes.c_int64, ctypes.c_int64])
+
+def Preallocate(fd, size, offset=0):
+    ''' Reserve size bytes of the file, starting at offset, up front, so
+    writes can land anywhere in them, in any order, without fragmenting it.
+    Falls back to just making the file that long (which leaves it sparse)
+    when the filesystem won't. '''
+    if size <= 0:
+        return
+
+    if _posix_fallocate is not None:
+        # Returns the error number instead of setting errno
+        result = _posix_fallocate(fd, offset, size)
+        if result == 0:
+            return
+        if result not in _UNSUPPORTED:
+            raise OSError(result, os.strerror(result))
+        _logger.info("posix_fallocate unavailable (%s). Just setting the size" % (os.strerror(result),))
+
+    if os.fstat(fd).st_size < offset + size:
+        os.ftruncate(fd, offset + size)
+
+def ScanDirectory(directory):
+    ''' name => size of every regular file in directory, from a single pass
+    over it. Empty if there's no such directory '''
+    sizes = {}
+    try:
+        if _scandir is not None:
+            for entry in _scandir(directory):
+                if entry.is_file(follow_symlinks=False):
+                    sizes[entry.name] = entry.stat(follow_symlinks=False).st_size
+        else:
+            for name in os.listdir(directory):
+                status = os.lstat(os.path.join(directory, name))
+                if stat.S_ISREG(status.st_mode):
+                    sizes[name] = status.st_size
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+    return sizes
+
+# Linux only, and not on every filesystem (tmpfs says no, for one)
+O_DIRECT = getattr(os, 'O_DIRECT', None)
+
+# From <linux/fs.h>: the device's logical sector size
+_BLKSSZGET = 0x1268
+
+_pread = _LibcFunction("pread64", ctypes.c_ssize_t,
+                       [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int64])
+
+def SectorSize(fd):
+    ''' The alignment direct I/O on fd needs '''
+    status = os.fstat(fd)
+    if stat.S_ISBLK(status.st_mode):
+        try:
+            return struct.unpack('i', fcntl.ioctl(fd, _BLKSSZGET, struct.pack('i', 0)))[0]
+        except IOError:
+            pass
+    # The filesystem's block size is always a multiple of the device's sectors
+    return max(512, status.st_blksize)
+
+def _RoundUp(size, multiple):
+    return (size + multiple - 1) / multiple * multiple
+
+class DirectFile:
+    ''' Read-only file object whose reads bypass the page cache (O_DIRECT).
+
+    Nothing it reads gets cached, so it doesn't push anybody else's working
+    set out, and nothing gets read ahead, so a read that fails failed in
+    the sectors it asked for. Every read goes through one mmap'd buffer,
+    which is page aligned, and gets rounded out to whole sectors.
+
+    Raises IOError if the platform or the filesystem won't do direct I/O. '''
+    # Reads bigger than this get done in pieces
+    _LARGEST_READ = 8 * 1024 * 1024
+
+    def __init__(self, source, buffer_size=1024 * 1024):
+        if O_DIRECT is None or _pread is None:
+            raise IOError(errno.EINVAL, "Direct I/O isn't available on this platform")
+
+        # Open it again, so the caller's own descriptor doesn't change
+        # behavior out from under it
+        path = '/proc/self/fd/%d' % (source.fileno(),)
+        if not os.path.exists(path):
+            path = source.name
+        self.__fd = os.open(path, os.O_RDONLY | O_DIRECT)
+        try:
+            self.__sector_size = SectorSize(self.__fd)
+            size = min(max(buffer_size, self.__sector_size), self._LARGEST_READ)
+            # Room for a read of size bytes at any alignment
+            self.__piece_size = _RoundUp(size, self.__sector_size)
+            self.__buffer = mmap.mmap(-1, self.__piece_size + self.__sector_size)
+            self.__address = ctypes.addressof(ctypes.c_char.from_buffer(self.__buffer))
+        except:
+            os.close(self.__fd)
+            raise
+
+        self.__position = 0
+        self.name = getattr(source, 'name', path)
+
+        # Find out now if the filesystem's going to refuse
+        self.__ReadAt(0, 1)
+
+    def SectorSize(self):
+        return self.__sector_size
+
+    def __ReadAt(self, offset, count):
+        ''' A view of up to count bytes at offset. Only good until the next read '''
+        start = offset - offset % self.__sector_size
+        end = _RoundUp(offset + count, self.__sector_size)
+        result = _pread(self.__fd, self.__address, end - start, start)
+        if result < 0:
+            code = ctypes.get_errno()
+            raise IOError(code, "%s (reading %d bytes at %d)" % (os.strerror(code), end - start, start))
+        available = max(0, min(result - (offset - start), count))
+        return buffer(self.__buffer, offset - start, available)
+
+    def __Pieces(self, size):
+        ''' Read up to size bytes from the current position, a piece at a time '''
+        while size != 0:
+            wanted = self.__piece_size
+            if size > 0:
+                wanted = min(size, wanted)
+            piece = self.__ReadAt(self.__position, wanted)
+            if not len(piece):
+                return
+            self.__position += len(piece)
+            if size > 0:
+                size -= len(piece)
+            yield piece
+            if len(piece) < wanted:
+                # EOF
+                return
+
+    def read(self, size=-1):
+        return ''.join(str(piece) for piece in self.__Pieces(size))
+
+    def readinto(self, target):
+        done = 0
+        for piece in self.__Pieces(len(target)):
+            target[done:done + len(piece)] = piece
+            done += len(piece)
+        return done
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.__position
+        elif whence == 2:
+            offset += os.lseek(self.__fd, 0, os.SEEK_END)
+        self.__position = offset
+
+    def tell(self):
+        return self.__position
+
+    def close(self):
+        if self.__fd is not None:
+            self.__buffer.close()
+            os.close(self.__fd)
+            self.__fd = None
@@ -0,0 +1,333 @@
+#! /usr/bin/env python
+
+''' Run splits, merges and validations in the background.
+
+Meant for embedding in long-running services. Nothing here ever prompts
+anybody: a policy object (see ui.Unattended) answers instead. And however
+many jobs get queued up, they share a fixed number of threads.
+
+There's no asyncio in python 2. An event loop can still wait on a Job
+without blocking by handing AddDoneCallback something that does
+loop.call_soon_threadsafe(...), and progress can be drained from Events()
+the same way. '''
+
+import fnmatch, glob, logging, os, Queue, sys, threading, time
+import pools, splice, ui
+
+# Marks the end of a job's event stream
+_FINISHED = object()
+
+class Job:
+    ''' Handle on one queued operation. A bit like a future '''
+    def __init__(self, name, function):
+        self.__name = name
+        self.__function = function
+        self.__logger = logging.getLogger("splice.Job")
+
+        self.__events = Queue.Queue()
+        self.__finished = threading.Event()
+        self.__lock = threading.Lock()
+        self.__callbacks = []
+
+        self.__result = None
+        self.__failure = None
+
+        # When Run() started and stopped
+        self.__started = None
+        self.__stopped = None
+
+    def Name(self):
+        return self.__name
+
+    def Done(self):
+        return self.__finished.is_set()
+
+    def Wait(self, timeout=None):
+        ''' Returns whether the job finished '''
+        self.__finished.wait(timeout)
+        return self.Done()
+
+    def Result(self, timeout=None):
+        ''' Whatever the operation returned. Re-raises whatever it raised '''
+        if not self.Wait(timeout):
+            raise RuntimeError("Job '%s' is still running" % (self.__name,))
+        if self.__failure is not None:
+            exc_type, exc_value, traceback = self.__failure
+            raise exc_type, exc_value, traceback
+        return self.__result
+
+    def Succeeded(self):
+        ''' Finished without raising, and without returning False (which is
+        how merges and validations say the checksums didn't match) '''
+        return self.Done() and self.__failure is None and self.__result is not False
+
+    def Summary(self):
+        ''' What happened, as a dict that json can handle '''
+        summary = {'job': self.__name,
+                   'ok': self.Succeeded(),
+                   'result': self.__result,
+                   'error': None,
+                   'seconds': None}
+        if self.__failure is not None:
+            summary['error'] = str(self.__failure[1])
+        if self.__started is not None and self.__stopped is not None:
+            summary['seconds'] = round(self.__stopped - self.__started, 3)
+        return summary
+
+    def AddDoneCallback(self, callback):
+        ''' callback(job) runs once the job finishes, on the job's thread
+        (or right now, if it's already finished) '''
+        with self.__lock:
+            if not self.Done():
+                self.__callbacks.append(callback)
+                return
+        callback(self)
+
+    def Events(self):
+        ''' Iterate over the job's events until it finishes.
+
+        Each one is a dict with at least 'job' and 'event' keys. "progress"
+        events have everything a progress.Progress event does as well: bytes
+        done, the total, throughput, ETA, and so on. Only one consumer gets
+        to see any given event. '''
+        while True:
+            event = self.__events.get()
+            if event is _FINISHED:
+                # Leave it there for anyone else who's still listening
+                self.__events.put(_FINISHED)
+                return
+            yield event
+
+    def Post(self, event, **details):
+        details['job'] = self.__name
+        details['event'] = event
+        self.__events.put(details)
+
+    def Run(self):
+        ''' Where the work actually happens. The JobRunner calls this '''
+        self.__started = time.time()
+        self.Post("started")
+        try:
+            self.__result = self.__function(self)
+        except Exception, e:
+            self.__logger.exception("Job '%s' failed" % (self.__name,))
+            self.__failure = sys.exc_info()
+            self.Post("failed", error=str(e))
+        else:
+            self.Post("finished", result=self.__result)
+        self.__stopped = time.time()
+
+        with self.__lock:
+            self.__finished.set()
+            callbacks, self.__callbacks = self.__callbacks, []
+        self.__events.put(_FINISHED)
+
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                self.__logger.exception("Done callback for '%s' failed" % (self.__name,))
+
+class _JobInterface:
+    ''' What the Splicer sees as its UI: the policy answers, the job hears about it '''
+    def __init__(self, job, policy):
+        self.__job = job
+        self.__policy = policy
+
+    def PromptForYorN(self, msg):
+        answer = self.__policy.PromptForYorN(msg)
+        self.__job.Post("prompt", message=msg.strip(), answer=answer)
+        return answer
+
+    def UpdateProgress(self):
+        # The job hears about progress from _JobProgress, in bytes
+        self.__policy.UpdateProgress()
+
+class _JobProgress:
+    ''' A progress sink (see progress.Progress) that turns each event into
+    one of the job's "progress" events '''
+    def __init__(self, job):
+        self.__job = job
+
+    def Event(self, event):
+        self.__job.Post("progress", **event)
+
+    def Close(self):
+        pass
+
+class _IOSlots:
+    ''' A counting semaphore where each holder can take more than one slot '''
+    def __init__(self, limit):
+        self.__limit = limit
+        self.__free = limit
+        self.__condition = threading.Condition()
+
+    def Acquire(self, count):
+        ''' Returns how many slots it actually took '''
+        # Anything wanting more than there are would wait forever
+        count = max(1, min(count, self.__limit))
+        with self.__condition:
+            while self.__free < count:
+                self.__condition.wait()
+            self.__free -= count
+        return count
+
+    def Release(self, count):
+        with self.__condition:
+            self.__free += count
+            self.__condition.notify_all()
+
+class JobRunner:
+    ''' Queues up jobs on a fixed-size thread pool.
+
+    settings are Splicer setters and their values, applied to every job's
+    Splicer, e.g. {'BufferSize': 2**20, 'Workers': 2}. Each call can add more
+    of its own. configure(splicer), if there is one, gets first go at each.
+
+    io_limit caps how many threads do I/O at once, across every job: each
+    running job counts for its reading thread plus its Splicer's Workers.
+    Jobs wait their turn for enough of those, so a batch of big splits
+    doesn't turn into dozens of threads all seeking around the same disk. '''
+    def __init__(self, workers=4, policy=None, io_limit=None, configure=None, **settings):
+        if policy is None:
+            policy = ui.Unattended()
+        self.__policy = policy
+        self.__settings = settings
+        self.__configure = configure
+
+        self.__io_slots = None
+        if io_limit:
+            self.__io_slots = _IOSlots(io_limit)
+
+        # Where the merges that haven't finished yet are writing
+        self.__destinations = set()
+        self.__lock = threading.Lock()
+
+        # Unbounded backlog: queueing a job should never block the caller
+        self.__pool = pools.WorkerPool(workers, backlog=0)
+
+    def Close(self):
+        ''' Wait for every queued job to finish '''
+        self.__pool.Close()
+
+    def Split(self, source_path, working_directory='.', **settings):
+        ''' Split source_path into a .split directory under working_directory '''
+        def Operation(job):
+            splicer = self.__Splicer(job, working_directory, settings)
+            splicer.SourceFileName(source_path)
+            with open(source_path, "rb") as source:
+                splicer.Source(source)
+                self.__Operate(splicer)
+            return splicer.DestinationDirectory()
+        return self.__Submit("split " + source_path, Operation)
+
+    def Merge(self, details_path, destination=None, **settings):
+        ''' Merge the chunks next to details_path. Returns whether the checksum matched.
+
+        The merged file goes to destination, which defaults to the original
+        file's name in the same directory as the .details. That way two
+        splits of files with the same name can merge at the same time. A
+        merge whose destination another unfinished merge already has just
+        fails, rather than both of them writing the same file. '''
+        if destination is None:
+            destination = os.path.join(os.path.dirname(details_path),
+                                       os.path.basename(details_path)[:-len('.details')])
+        claimed = self.__Claim(destination)
+
+        def Operation(job):
+            if not claimed:
+                raise ValueError("'%s' is already where another merge is going" % (destination,))
+            splicer = self.__Splicer(job, os.path.dirname(details_path) or '.', settings)
+            splicer.SetMergeMode()
+            splicer.SourceFileName(os.path.basename(details_path))
+            splicer.MergeDestination(destination)
+            return self.__Operate(splicer)
+        job = self.__Submit("merge " + details_path, Operation)
+        if claimed:
+            job.AddDoneCallback(lambda job: self.__Release(destination))
+        return job
+
+    def Validate(self, details_path, thorough=False, chunks=None, level=None, sample=None, **settings):
+        ''' Returns whether everything's there (and intact, if thorough).
+        See Splicer.ValidationReport for the levels '''
+        def Operation(job):
+            splicer = self.__Splicer(job, os.path.dirname(details_path) or '.', settings)
+            splicer.SetValidateMode(thorough, chunks, level, sample)
+            splicer.SourceFileName(os.path.basename(details_path))
+            return self.__Operate(splicer)
+        return self.__Submit("validate " + details_path, Operation)
+
+    def __Claim(self, destination):
+        ''' Returns False if some other merge that hasn't finished is already
+        writing destination '''
+        key = os.path.realpath(destination)
+        with self.__lock:
+            if key in self.__destinations:
+                return False
+            self.__destinations.add(key)
+        return True
+
+    def __Release(self, destination):
+        with self.__lock:
+            self.__destinations.discard(os.path.realpath(destination))
+
+    def __Operate(self, splicer):
+        if self.__io_slots is None:
+            return splicer.Operate()
+        slots = self.__io_slots.Acquire(1 + splicer.Workers())
+        try:
+            return splicer.Operate()
+        finally:
+            self.__io_slots.Release(slots)
+
+    def __Splicer(self, job, working_directory, settings):
+        splicer = splice.Splicer(_JobInterface(job, self.__policy))
+        splicer.WorkingDirectory(working_directory)
+        splicer.Progress().AddSink(_JobProgress(job))
+        if self.__configure is not None:
+            self.__configure(splicer)
+        combined = dict(self.__settings)
+        combined.update(settings)
+        for setter, value in combined.items():
+            getattr(splicer, setter)(value)
+        return splicer
+
+    def __Submit(self, name, operation):
+        job = Job(name, operation)
+        self.__pool.Submit(job.Run)
+        return job
+
+def IsPattern(*paths):
+    ''' Do any of paths name more than one file: globs, or directories? '''
+    return any(glob.has_magic(path) or os.path.isdir(path) for path in paths)
+
+def ExpandInputs(patterns, manifests=False):
+    ''' Every file patterns name, in order, without duplicates.
+
+    Each pattern can be a file, a glob, or a directory. A directory means
+    every file directly inside it, or, when looking for manifests, every
+    .details file anywhere under it. Anything that matches nothing gets
+    passed through as is, so it fails as its own job instead of vanishing. '''
+    found = []
+    seen = set()
+    def Add(path):
+        if path not in seen:
+            seen.add(path)
+            found.append(path)
+
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) or [pattern]
+        for match in matches:
+            if not os.path.isdir(match):
+                Add(match)
+            elif manifests:
+                for directory, subdirectories, files in os.walk(match):
+                    subdirectories.sort()
+                    for name in sorted(fnmatch.filter(files, '*.details')):
+                        Add(os.path.join(directory, name))
+            else:
+                for name in sorted(os.listdir(match)):
+                    path = os.path.join(match, name)
+                    if os.path.isfile(path):
+                        Add(path)
+    return found
@@ -0,0 +1,62 @@
+#! /usr/bin/env python
+
+''' Checkpoints for splits that might not make it to the end '''
+
+import logging, os, threading
+
+class Journal:
+    ''' Append-only record of the chunks a split has finished writing.
+
+    One "index size digest" line per chunk (plus whatever else the split
+    needs to remember about it), appended only after the chunk itself is
+    safely written. Each line goes out in a single write(), so if
+    the process dies mid-append, the worst case is one torn line at the end,
+    which Load() throws away. A chunk file that isn't in the journal just
+    has to get checked the slow way. '''
+    def __init__(self, path):
+        self.__path = path
+        self.__logger = logging.getLogger("splice.Journal")
+        self.__lock = threading.Lock()
+        self.__fd = None
+
+    def Path(self):
+        return self.__path
+
+    def Load(self):
+        ''' Returns index => (size, digest, extra...) for every intact entry '''
+        entries = {}
+        if not os.path.exists(self.__path):
+            return entries
+
+        with open(self.__path, "r") as journal:
+            for line in journal:
+                if not line.endswith('\n'):
+                    self.__logger.warn("Ignoring torn journal entry: '%s'" % (line,))
+                    continue
+                pieces = line.split()
+                if len(pieces) < 3:
+                    self.__logger.warn("Ignoring malformed journal entry: '%s'" % (line.strip(),))
+                    continue
+                try:
+                    index, size = int(pieces[0]), int(pieces[1])
+                except ValueError:
+                    self.__logger.warn("Ignoring malformed journal entry: '%s'" % (line.strip(),))
+                    continue
+                # Later entries win. A chunk that got rewritten gets a new one
+                entries[index] = (size, pieces[2]) + tuple(pieces[3:])
+
+        return entries
+
+    def Record(self, index, size, digest, *extra):
+        ''' Thread safe. Call it after the chunk's been written '''
+        line = " ".join(["%d %d %s" % (index, size, digest)] + [str(piece) for piece in extra]) + "\n"
+        with self.__lock:
+            if self.__fd is None:
+                self.__fd = os.open(self.__path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+            os.write(self.__fd, line)
+
+    def Close(self):
+        with self.__lock:
+            if self.__fd is not None:
+                os.close(self.__fd)
+                self.__fd = None
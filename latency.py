@@ -0,0 +1,155 @@
+#! /usr/bin/env python
+
+''' How long each read of the source took, and where.
+
+A failing drive usually gets slow in the areas that are about to go bad
+well before it starts returning errors from them. So every read gets timed
+and remembered by offset, which gives:
+- a histogram of read latencies
+- the regions where reads took longer than a threshold
+- a heat map of the whole source, for spotting where the trouble's
+  spreading
+
+A rescue uses the threshold to leave slow areas for the end of the run
+(see rescue.Rescuer). Any other split only reports them. '''
+
+import array, json, threading
+
+# Histogram buckets: reads that took under 1us, under 2us, under 4us, ...
+# The last one catches everything over about 16 seconds
+_BUCKETS = 25
+
+# Darker is slower, relative to the threshold: '#' is over it, '@' is over
+# twice it. Blank cells never got read
+_SHADES = ' .:-=+*#@'
+# Any read in the cell failed
+_FAILED = 'X'
+
+class LatencyRecorder:
+    ''' Thread safe. Costs 21 bytes per read '''
+    def __init__(self, threshold=None, size=None):
+        ''' Reads over threshold seconds count as slow. size is how big the
+        source is, when that's known '''
+        self.__threshold = threshold
+        self.__size = size
+        self.__lock = threading.Lock()
+
+        self.__offsets = array.array('d')
+        self.__sizes = array.array('d')
+        self.__latencies = array.array('f')
+        self.__failures = array.array('B')
+        self.__histogram = [0] * _BUCKETS
+
+    def Threshold(self):
+        return self.__threshold
+
+    def IsSlow(self, seconds):
+        return self.__threshold is not None and seconds > self.__threshold
+
+    def Record(self, offset, size, seconds, failed=False):
+        bucket = min(_BUCKETS - 1, int(seconds * 1000000).bit_length())
+        with self.__lock:
+            self.__offsets.append(offset)
+            self.__sizes.append(size)
+            self.__latencies.append(seconds)
+            self.__failures.append(failed and 1 or 0)
+            self.__histogram[bucket] += 1
+
+    def Reads(self):
+        return len(self.__offsets)
+
+    def Histogram(self):
+        ''' [(upper bound in seconds, how many reads took less than that, but
+        more than the previous bound)], skipping the empty ones at either end '''
+        buckets = [(2 ** i / 1000000.0, count) for i, count in enumerate(self.__histogram)]
+        while buckets and not buckets[-1][1]:
+            buckets.pop()
+        while buckets and not buckets[0][1]:
+            buckets.pop(0)
+        return buckets
+
+    def SlowRegions(self):
+        ''' [(offset, size, slowest read)] of every run of slow (or failed)
+        reads, merging any that touch '''
+        if self.__threshold is None:
+            return []
+        with self.__lock:
+            slow = sorted((int(offset), int(size), latency)
+                          for offset, size, latency, failed
+                          in zip(self.__offsets, self.__sizes, self.__latencies, self.__failures)
+                          if failed or latency > self.__threshold)
+
+        regions = []
+        for offset, size, latency in slow:
+            if regions and offset <= regions[-1][0] + regions[-1][1]:
+                start, length, slowest = regions[-1]
+                regions[-1] = (start, max(length, offset + size - start), max(slowest, latency))
+            else:
+                regions.append((offset, size, latency))
+        return regions
+
+    def HeatMap(self, cells=64):
+        ''' The source cut into cells, each one
+        {'offset', 'size', 'reads', 'mean', 'max', 'failures'} '''
+        with self.__lock:
+            reads = zip(self.__offsets, self.__sizes, self.__latencies, self.__failures)
+        size = self.__size
+        if size is None:
+            size = max([int(offset + length) for offset, length, _, _ in reads] or [0])
+        if size <= 0:
+            return []
+
+        width = max(1, (size + cells - 1) / cells)
+        heat = [{'offset': i * width, 'size': min(width, size - i * width),
+                 'reads': 0, 'mean': 0.0, 'max': 0.0, 'failures': 0}
+                for i in range((size + width - 1) / width)]
+        for offset, length, latency, failed in reads:
+            cell = heat[min(len(heat) - 1, int(offset) / width)]
+            cell['reads'] += 1
+            cell['mean'] += latency
+            cell['max'] = max(cell['max'], latency)
+            cell['failures'] += failed
+        for cell in heat:
+            if cell['reads']:
+                cell['mean'] /= cell['reads']
+        return heat
+
+    def HeatMapText(self, cells=64):
+        ''' One character per cell. Compares each cell's slowest read with
+        the threshold (or the slowest read anywhere, without one) '''
+        heat = self.HeatMap(cells)
+        scale = self.__threshold or max([cell['max'] for cell in heat] or [0])
+        text = []
+        for cell in heat:
+            if cell['failures']:
+                text.append(_FAILED)
+            elif not cell['reads'] or not scale:
+                text.append(_SHADES[0])
+            else:
+                ratio = cell['max'] / scale
+                if ratio < 1:
+                    # '.' through '*': under the threshold
+                    text.append(_SHADES[1 + int(ratio * (len(_SHADES) - 3))])
+                elif ratio < 2:
+                    text.append(_SHADES[-2])
+                else:
+                    text.append(_SHADES[-1])
+        return ''.join(text)
+
+    def ToDict(self, cells=64):
+        latencies = self.__latencies
+        return {'reads': self.Reads(),
+                'threshold': self.__threshold,
+                'slowest': latencies and max(latencies) or None,
+                'mean': latencies and sum(latencies) / len(latencies) or None,
+                'histogram': [{'below_seconds': bound, 'count': count}
+                              for bound, count in self.Histogram()],
+                'slow_regions': [{'offset': offset, 'size': size, 'slowest': slowest}
+                                 for offset, size, slowest in self.SlowRegions()],
+                'heat_map': self.HeatMap(cells),
+                'heat_map_text': self.HeatMapText(cells)}
+
+    def Save(self, path, cells=64):
+        with open(path, "w") as report:
+            json.dump(self.ToDict(cells), report, indent=1, sort_keys=True)
+            report.write("\n")
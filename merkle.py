@@ -0,0 +1,32 @@
+#! /usr/bin/env python
+
+''' Merkle trees over chunk digests, for the 0.0.5 .details checksum.
+
+Each chunk's own digest is a leaf. Interior nodes are
+H('\x01' + left + right), where H is whatever hashed the chunks (sha256
+unless the .details says otherwise), with the split between left and right
+at the largest power of two below the number of leaves (the same shape
+RFC 6962 uses), so the tree for any given chunk count is unambiguous. '''
+
+import hashlib
+
+def _Split(count):
+    ''' Largest power of two strictly less than count '''
+    split = 1
+    while split * 2 < count:
+        split *= 2
+    return split
+
+def Root(leaves, digest=hashlib.sha256):
+    ''' leaves are raw (not hex) digests, in chunk order. digest(data) hands
+    back a hashlib-style object '''
+    if not leaves:
+        return digest('').digest()
+    if len(leaves) == 1:
+        return leaves[0]
+
+    split = _Split(len(leaves))
+    return digest('\x01' + Root(leaves[:split], digest) + Root(leaves[split:], digest)).digest()
+
+def HexRoot(hex_leaves, digest=hashlib.sha256):
+    return Root([leaf.decode('hex') for leaf in hex_leaves], digest).encode('hex')
@@ -0,0 +1,193 @@
+#! /usr/bin/env python
+
+''' Background worker threads for the I/O-heavy parts of splicing '''
+
+import logging, Queue, sys, threading
+
+class WorkerPool:
+    ''' Runs submitted jobs on a fixed number of background threads.
+
+    The job queue is bounded, so a producer that's faster than the workers
+    blocks instead of quietly buffering the entire source in memory.
+    With 0 workers, jobs just run inline on the caller's thread. '''
+    def __init__(self, workers, backlog=None):
+        self.__logger = logging.getLogger("splice.WorkerPool")
+
+        if backlog is None:
+            # Enough to keep everyone busy while the producer catches up
+            backlog = max(1, workers * 2)
+        self.__queue = Queue.Queue(backlog)
+
+        # The first failure wins. It gets re-raised on the producer's side
+        self.__failure = None
+
+        self.__threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.__Work, name="splice-worker-%d" % (i,))
+            thread.daemon = True
+            thread.start()
+            self.__threads.append(thread)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.Close()
+        else:
+            # Don't let a worker failure mask whatever's already propagating
+            try:
+                self.Close()
+            except Exception:
+                self.__logger.exception("Worker failure while unwinding")
+        return False
+
+    def Workers(self):
+        return len(self.__threads)
+
+    def Submit(self, function, *args):
+        ''' Queue up function(*args). Blocks while the backlog is full '''
+        self.__RaiseIfFailed()
+
+        if not self.__threads:
+            function(*args)
+        else:
+            self.__queue.put((function, args))
+
+    def Close(self):
+        ''' Wait for everything that's been submitted to finish '''
+        for thread in self.__threads:
+            self.__queue.put(None)
+        for thread in self.__threads:
+            thread.join()
+        self.__threads = []
+
+        self.__RaiseIfFailed()
+
+    def __RaiseIfFailed(self):
+        if self.__failure is not None:
+            exc_type, exc_value, traceback = self.__failure
+            raise exc_type, exc_value, traceback
+
+    def __Work(self):
+        while True:
+            job = self.__queue.get()
+            if job is None:
+                return
+
+            if self.__failure is not None:
+                # Something already broke. Just drain the queue so the
+                # producer doesn't block forever
+                continue
+
+            function, args = job
+            try:
+                function(*args)
+            except Exception:
+                self.__logger.exception("Background job failed")
+                self.__failure = sys.exc_info()
+
+class _Failure:
+    ''' Carries an exception from one pipeline stage down to the consumer '''
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+# Marks the end of a pipeline's stream
+_DONE = object()
+
+class Pipeline:
+    ''' Chains stages together, each on its own thread, with a bounded queue
+    between each pair.
+
+    producer is any iterable; it gets consumed on a background thread. Each
+    of stages is a function that takes one item and returns the next stage's
+    item. Iterating over the Pipeline yields the last stage's output, in
+    order, on the caller's thread.
+
+    So the whole thing runs at the speed of the slowest stage instead of the
+    sum of all of them, while holding at most depth items per queue. '''
+    def __init__(self, producer, stages=(), depth=2):
+        self.__logger = logging.getLogger("splice.Pipeline")
+
+        # Set when the consumer stops early (or something broke) so everything
+        # upstream can quit instead of blocking on a full queue forever
+        self.__abort = threading.Event()
+        self.__threads = []
+        # Every thread's output queue
+        self.__queues = []
+
+        upstream = Queue.Queue(max(1, depth))
+        self.__Start(self.__Produce, producer, upstream)
+        for stage in stages:
+            downstream = Queue.Queue(max(1, depth))
+            self.__Start(self.__Transform, stage, upstream, downstream)
+            upstream = downstream
+        self.__results = upstream
+
+    def __iter__(self):
+        try:
+            while True:
+                item = self.__results.get()
+                if item is _DONE:
+                    break
+                if isinstance(item, _Failure):
+                    exc_type, exc_value, traceback = item.exc_info
+                    raise exc_type, exc_value, traceback
+                yield item
+        finally:
+            self.__Shutdown()
+
+    def __Start(self, target, *args):
+        thread = threading.Thread(target=target, args=args,
+                                  name="splice-stage-%d" % (len(self.__threads),))
+        thread.daemon = True
+        thread.start()
+        self.__threads.append(thread)
+        self.__queues.append(args[-1])
+
+    def __Shutdown(self):
+        self.__abort.set()
+        for thread in self.__threads:
+            while thread.is_alive():
+                # Keep the queues empty so nobody stays stuck in a put()
+                for queue in self.__queues:
+                    try:
+                        while True:
+                            queue.get_nowait()
+                    except Queue.Empty:
+                        pass
+                thread.join(0.01)
+
+    def __Produce(self, producer, downstream):
+        try:
+            for item in producer:
+                downstream.put(item)
+                if self.__abort.is_set():
+                    break
+        except Exception:
+            self.__logger.exception("Pipeline producer failed")
+            downstream.put(_Failure(sys.exc_info()))
+            return
+        downstream.put(_DONE)
+
+    def __Transform(self, stage, upstream, downstream):
+        while True:
+            item = upstream.get()
+            if item is _DONE or isinstance(item, _Failure):
+                # Pass it along
+                downstream.put(item)
+                return
+            if self.__abort.is_set():
+                # Just waiting for the producer to wind down
+                continue
+
+            try:
+                result = stage(item)
+            except Exception:
+                self.__logger.exception("Pipeline stage failed")
+                downstream.put(_Failure(sys.exc_info()))
+                # Keep draining so the producer can finish up
+                self.__abort.set()
+                continue
+
+            downstream.put(result)
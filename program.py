@@ -2,8 +2,8 @@
 
 ''' Wrapper file for the UI to the splicer '''
 
-import getopt, logging, sys
-import splice
+import getopt, json, logging, os, sys, threading
+import jobs, progress, splice
 import ui
 
 logging.basicConfig(level=logging.DEBUG)
@@ -17,12 +17,40 @@ class Program:
         interface = ui.UI()
         self.__splicer = splice.Splicer(interface)
 
+        # Splitting whatever's getting piped in
+        self.__from_stdin = False
+
+        # Batch mode: every -f (and every other argument), each one possibly
+        # a glob or a directory, as a job of its own
+        self.__inputs = []
+        self.__batch = False
+        self.__job_count = 4
+        self.__io_limit = None
+        self.__summary = None
+        # Which of the runner's operations each job gets, and how validations go
+        self.__operation = "split"
+        self.__validation = {}
+        # (setter, arguments) of every setting, to hand each job's Splicer
+        self.__configuration = []
+
+        # Where progress events go: a terminal bar, JSON lines, Prometheus metrics
+        self.__progress_bar = False
+        self.__events = None
+        self.__metrics = None
+
     def main(self):
         try:
             self.__logger.debug("Checking options")
-            opts, args = getopt.getopt( self.__argv, "hrsmf:vb:d:", 
+            opts, args = getopt.getopt( self.__argv, "hrsmf:vb:d:w:a:o:", 
                                         ["help", "restart", "split", 
-                    "merge","file=", "version", "buffer=", 'directory='])
+                    "merge","file=", "version", "buffer=", 'directory=',
+                    "workers=", "read-ahead=", "validate", "verify", "verify-range=",
+                    "zero-copy", "no-hash", "preallocate", "format=", "name=", "output=",
+                    "store=", "cdc=", "compress=", "digest=", "sparse",
+                    "sample=", "report=", "retries=", "direct",
+                    "batch", "jobs=", "io-limit=", "summary=",
+                    "progress", "events=", "metrics=", "latency", "slow=",
+                    "io-size=", "chunks=", "max-chunk=", "auto"])
         except getopt.GetoptError:
             print "Option error"
             print self.usage()
@@ -36,43 +64,278 @@ class Program:
                     sys.exit()
                 elif opt in ("-m", "--merge"):
                     self.__splicer.SetMergeMode()
+                    self.__operation = "merge"
                     self.__logger.debug("Merging")
+                elif opt == "--validate":
+                    self.__Validate()
+                    self.__logger.debug("Validating")
+                elif opt == "--verify":
+                    self.__Validate(thorough=True)
+                    self.__logger.debug("Verifying every chunk")
+                elif opt == "--verify-range":
+                    first, last = arg.split(':')
+                    self.__Validate(thorough=True, chunks=range(int(first), int(last) + 1))
+                    self.__logger.debug("Verifying chunks %s" % (arg,))
+                elif opt == "--sample":
+                    self.__Validate(level="sample", sample=int(arg))
+                    self.__logger.debug("Verifying %s chunks, chosen at random" % (arg,))
+                elif opt == "--report":
+                    if arg == '-':
+                        self.__splicer.ReportDestination(sys.stdout)
+                    else:
+                        self.__splicer.ReportDestination(arg)
+                elif opt == "--zero-copy":
+                    self.__Configure("ZeroCopy", True)
+                elif opt == "--direct":
+                    self.__Configure("DirectIO", True)
+                elif opt == "--preallocate":
+                    self.__Configure("Preallocate", True)
+                elif opt == "--format":
+                    self.__Configure("Version", arg)
+                elif opt == "--store":
+                    self.__Configure("ChunkStore", arg)
+                elif opt == "--cdc":
+                    self.__Configure("ContentDefined", arg.split(':'))
+                elif opt == "--compress":
+                    codec, separator, level = arg.partition(':')
+                    self.__Configure("Compression", codec, level and int(level) or None)
+                elif opt == "--no-hash":
+                    self.__Configure("Hashing", False)
+                elif opt == "--sparse":
+                    self.__Configure("Sparse", True)
+                elif opt == "--digest":
+                    if arg == "none":
+                        self.__Configure("Hashing", False)
+                    else:
+                        self.__Configure("Digest", arg)
+                elif opt == "--latency":
+                    self.__Configure("ReadLatency", True)
+                elif opt == "--slow":
+                    self.__Configure("ReadLatency", True, float(arg) / 1000)
+                elif opt == "--retries":
+                    self.__Configure("RescueRetries", int(arg))
                 elif opt in ("-r", "--restart"):
-                    self.__splicer.SetRepairSplice(True)
+                    self.__Configure("SetRepairSplice", True)
                     self.__logger.info("Repairing")
                 elif opt in ("-f", "--file"):
-                    # Would be nice to loop through args and split them 1 at a time, creating
-                    # subdirectories as appropriate. Do that later, when I have time
-                    # (or merging multiple directories, of course)
-
-                    # Actually, that wouldn't be that hard. Just stick them in a list
-                    # and pass them into the Splicer one at a time. It probably
-                    # shouldn't be handling the source file i/o anyway.
-                    # Do that next
+                    # Several of them means batch mode. See __Batch
+                    self.__inputs.append(arg)
+                    if arg == '-':
+                        self.__from_stdin = True
+                        self.__logger.info("Splicing STDIN")
+                    else:
+                        self.__splicer.SourceFileName(arg)
+                        self.__logger.info("Splicing %s" % (arg,))
+                elif opt in ("-o", "--output"):
+                    if arg == '-':
+                        # Logging goes to stderr, so this is safe to pipe
+                        self.__splicer.MergeDestination(sys.stdout)
+                    else:
+                        self.__splicer.MergeDestination(arg)
+                elif opt == "--name":
+                    # What to call a split of STDIN
                     self.__splicer.SourceFileName(arg)
-                    self.__logger.info("Splicing %s" % (arg,))
                 elif opt in ("-v", "--version"):
                     print self.__splicer.Version()
                     sys.exit()
                 elif opt in ("-b", "--buffer"):
-                    self.__splicer.BufferSize(int(arg))
+                    self.__Configure("BufferSize", int(arg))
+                elif opt == "--io-size":
+                    self.__Configure("IOSize", int(arg))
+                elif opt == "--chunks":
+                    self.__Configure("ChunkCount", int(arg))
+                elif opt == "--max-chunk":
+                    self.__Configure("MaximumChunkSize", int(arg))
+                elif opt == "--auto":
+                    self.__Configure("AutoTune", True)
                 elif opt in ("-d", "--directory"):
                     self.__splicer.WorkingDirectory(arg)
+                elif opt in ("-w", "--workers"):
+                    self.__Configure("Workers", int(arg))
+                elif opt in ("-a", "--read-ahead"):
+                    self.__Configure("ReadAhead", int(arg))
+                elif opt == "--batch":
+                    self.__batch = True
+                elif opt == "--jobs":
+                    self.__job_count = int(arg)
+                elif opt == "--io-limit":
+                    self.__io_limit = int(arg)
+                elif opt == "--summary":
+                    self.__summary = arg
+                elif opt == "--progress":
+                    self.__progress_bar = True
+                elif opt == "--events":
+                    self.__events = progress.JSONLines(arg)
+                elif opt == "--metrics":
+                    self.__metrics = progress.PrometheusTextfile(arg)
+
+            self.__inputs.extend(args)
+            try:
+                if self.__batch or len(self.__inputs) > 1 or jobs.IsPattern(*self.__inputs):
+                    if not self.__Batch():
+                        sys.exit(1)
+                    return
+                self.__Operate(args)
+            finally:
+                if self.__events is not None:
+                    self.__events.Close()
 
-            self.__logger.debug("Operating")
+    def __Operate(self, args):
+        ''' Just the one operation '''
+        if args:
+            self.__splicer.SourceFileName(args[0])
+        for sink in (self.__progress_bar and progress.TerminalBar(), self.__events, self.__metrics):
+            if sink:
+                self.__splicer.Progress().AddSink(sink)
+
+        self.__logger.debug("Operating")
+        if self.__from_stdin:
+            # Splicer notices for itself when it can't seek
+            self.__splicer.Source(sys.stdin)
+            result = self.__splicer.Operate()
+        else:
             with open (self.__splicer.SourceFileName()) as src:
                 self.__splicer.Source(src)
-                self.__splicer.Operate()
-            self.__logger.debug("Done")
+                result = self.__splicer.Operate()
+        self.__logger.debug("Done")
+        if result is False:
+            # Validation (or the merge's checksum) failed
+            sys.exit(1)
+
+    def __Configure(self, setter, *args):
+        ''' Apply a setting, and remember it for batch jobs '''
+        getattr(self.__splicer, setter)(*args)
+        self.__configuration.append((setter, args))
+
+    def __Validate(self, **settings):
+        self.__splicer.SetValidateMode(**settings)
+        self.__operation = "validate"
+        self.__validation = settings
+
+    def __ApplyConfiguration(self, splicer):
+        for setter, args in self.__configuration:
+            getattr(splicer, setter)(*args)
+        if self.__events is not None:
+            # Each event says which job it's from
+            splicer.Progress().AddSink(self.__events)
+
+    def __Batch(self):
+        ''' Run every input as its own job, a few at a time, in this one process.
+
+        Writes a JSON line per job to the --summary file (or logs it) as each
+        one finishes. Returns whether they all worked. '''
+        if '-' in self.__inputs:
+            raise ValueError("STDIN can't be part of a batch")
+        # Merges go next to their .details, or into the -o directory
+        output_directory = self.__splicer.MergeDestination()
+        if output_directory is not None and (self.__operation != "merge" or
+                                             not isinstance(output_directory, str) or
+                                             not os.path.isdir(output_directory)):
+            self.__logger.warn("-o names a single file. Ignoring it in batch mode")
+            output_directory = None
+        if self.__splicer.ReportDestination() is not None:
+            self.__logger.warn("--report names a single file. Ignoring it in batch mode")
+        if self.__progress_bar or self.__metrics is not None:
+            self.__logger.warn("--progress and --metrics follow a single operation. Use --events in batch mode")
+
+        inputs = jobs.ExpandInputs(self.__inputs, manifests=self.__operation != "split")
+        self.__logger.info("%d jobs, %d at a time" % (len(inputs), self.__job_count))
+
+        summary = None
+        if self.__summary == '-':
+            summary = sys.stdout
+        elif self.__summary is not None:
+            summary = open(self.__summary, "w")
+        lock = threading.Lock()
+        def Report(job):
+            line = json.dumps(job.Summary(), sort_keys=True)
+            with lock:
+                if summary is None:
+                    self.__logger.info(line)
+                else:
+                    summary.write(line + "\n")
+                    summary.flush()
+
+        runner = jobs.JobRunner(self.__job_count, ui.Unattended(), io_limit=self.__io_limit,
+                                configure=self.__ApplyConfiguration)
+        try:
+            batch = []
+            for path in inputs:
+                if self.__operation == "merge":
+                    destination = None
+                    if output_directory is not None:
+                        destination = os.path.join(output_directory, os.path.basename(path)[:-len('.details')])
+                    job = runner.Merge(path, destination)
+                elif self.__operation == "validate":
+                    job = runner.Validate(path, **self.__validation)
+                else:
+                    job = runner.Split(path, self.__splicer.WorkingDirectory())
+                job.AddDoneCallback(Report)
+                batch.append(job)
+            runner.Close()
+        finally:
+            if summary not in (None, sys.stdout):
+                summary.close()
+
+        failed = [job.Name() for job in batch if not job.Succeeded()]
+        if failed:
+            self.__logger.error("%d of %d jobs failed: %s" % (len(failed), len(batch), ", ".join(failed)))
+        return not failed
 
     def usage(self):
-        instructions = """./splice.py [-h -m -s -r -v] [-d directory] [-f file]
+        instructions = """./splice.py [-h -m -s -r -v] [-d directory] [-w workers] [-a reads] [-o output] [-f file]
 -h: print this help message
 -m: switch to merge mode
--r: allow splitting to be incremental (i.e. if errors happen the first time around)
+--validate: check that a merge has all the chunks it needs, at the right sizes, without reading them (-f names the .details)
+--sample count: like --validate, but also check the digests of count chunks chosen at random
+--verify: like --validate, but also check every chunk's digest, in parallel
+--verify-range first:last: --verify, but only read chunks first through last
+--report file: where validating writes a JSON list of missing/short/corrupt chunks ("-" for STDOUT)
+--zero-copy: split by having the kernel copy chunks straight out of the source file
+--direct: split (or rescue) with O_DIRECT reads, bypassing the page cache, where the filesystem allows it
+--preallocate: merge by preallocating the output and copying chunks into place in parallel
+--format version: which .details version a split writes (0.0.2 through 0.0.5, default 0.0.5)
+--store directory: split into a content-addressed chunk store, shared between splits (implies --cdc)
+--cdc min:avg:max: cut chunks wherever the content says to, and skip any the store already has.
+    Finding the cuts is CPU-bound: several times slower than a fixed-size split with numpy installed
+    (and chunks averaging 4K or more), and only a few MB/s without it
+--compress codec[:level]: compress each chunk (zlib, bz2, or lzma where available), in parallel
+--no-hash: skip all checksums (only for trusted local copies)
+--sparse: don't write chunks that are all zeros, just mark them as holes. Merges leave them sparse
+--digest name: what a split hashes with: sha256 (the default), sha1, blake2b/blake2s (python 3.6, or
+    pyblake2), crc32 or adler32 (corruption only, but much faster), or none (--no-hash)
+-r: rescue a failing source. A map of what's been read (and what couldn't be) lives in the
+    split directory, so each run only spends reads on what's still unknown
+--retries count: how many extra times -r re-reads sectors that failed (default 1)
+--latency: time every read, and write a histogram, slow regions and a heat map to <name>.latency
+--slow ms: --latency, calling reads slower than ms slow. Only with -r does the split put off the
+    areas around those until last. Otherwise it reads straight through and just reports them
 -v: print version information
 -d directory: should specify where to find spliced files to merge. Doesn't seem to work
--f file: operate on file (STDIN by default...although that probably doesn't work)"""
+-w workers: how many background threads write chunk files (0, the default, writes them inline)
+-o output: where a merge goes. "-" streams it to STDOUT
+-a reads: how many reads a merge gets ahead of hashing and writing (0 merges serially). Each
+    is up to --io-size bytes (1M by default), or a whole chunk for compressed splits
+-b bytes: how big each chunk is. Without it, a split picks a size from --chunks and --max-chunk
+--chunks count: about how many chunks a split makes when it's picking the size (default 256)
+--max-chunk bytes: the biggest chunk a split makes when it's picking the size (default 64M)
+--io-size bytes: how much each read asks for. Without it, a split that's picking the chunk size
+    measures what the source likes (and otherwise reads a chunk at a time, up to 8M)
+--auto: measure the I/O size even with -b
+-f file: operate on file. "-" splits whatever gets piped in, streaming it
+--batch: operate on every -f (and every other argument) as a separate job. Globs work, and so do
+    directories: every file in it for splits, every .details under it for merges and validations.
+    More than one -f implies this. Each merge goes next to its .details, or into -o, if that's a
+    directory. Merges that would write the same file fail
+--jobs count: how many batch jobs run at once (default 4)
+--io-limit count: how many threads batch jobs can have reading and writing at once, in all.
+    Each job counts once, plus once per -w worker
+--summary file: where batch mode writes a JSON line about each job ("-" for STDOUT)
+--progress: show a progress bar on STDERR, with throughput, ETA and where the time's going
+--events file: append a JSON line about progress to file every second or so
+--metrics file.prom: keep file up to date with Prometheus metrics about the progress, for
+    node_exporter's textfile collector
+--name name: what to call a split of STDIN (defaults to STDIN)"""
         return instructions
 
     def Dispose(self):
@@ -0,0 +1,268 @@
+#! /usr/bin/env python
+
+''' How far along an operation is, how fast it's going, and where the time goes.
+
+A Splicer reports into its Progress as it works: bytes done, plus how long
+each stage (read, hash, write, fsync, ...) took. Every so often, and once
+more at the end, the Progress hands an event to each of its sinks:
+
+{'operation': 'split', 'name': what's being split, 'bytes_done': 123, 'bytes_total': 456 (or None),
+ 'elapsed': seconds, 'bytes_per_second': since the last event,
+ 'average_bytes_per_second': since the start, 'eta_seconds': or None,
+ 'stages': {'read': seconds, ...}, 'final': bool, 'time': unix time}
+
+Stage times get added up across every thread that spends them, so with
+background workers they can add up to more than the elapsed time.
+
+A sink is anything with Event(event) and Close(). '''
+
+import json, os, sys, tempfile, threading, time
+
+READ = 'read'
+HASH = 'hash'
+WRITE = 'write'
+FSYNC = 'fsync'
+# Compressing chunks, when a split does that
+COMPRESS = 'compress'
+
+STAGES = (READ, HASH, WRITE, FSYNC)
+
+class _Timer:
+    ''' Adds the time spent inside a with block to one stage '''
+    def __init__(self, progress, stage):
+        self.__progress = progress
+        self.__stage = stage
+        self.__started = None
+
+    def __enter__(self):
+        self.__started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.__progress.AddTime(self.__stage, time.time() - self.__started)
+        return False
+
+class _NotTiming:
+    ''' What Timing hands out when nobody's listening '''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NOT_TIMING = _NotTiming()
+
+class Progress:
+    ''' Thread safe. With no sinks, it costs next to nothing '''
+    def __init__(self, sinks=(), interval=1.0):
+        self.__sinks = list(sinks)
+        self.__interval = interval
+        self.__lock = threading.Lock()
+        self.Start(None)
+
+    def AddSink(self, sink):
+        with self.__lock:
+            self.__sinks.append(sink)
+
+    def Sinks(self):
+        return list(self.__sinks)
+
+    def Start(self, operation, total=None, name=None):
+        ''' Reset everything for a new operation. total is in bytes, if it's known '''
+        with self.__lock:
+            self.__operation = operation
+            self.__name = name
+            self.__total = total
+            self.__done = 0
+            self.__stages = dict((stage, 0.0) for stage in STAGES)
+            self.__started = time.time()
+            # What the last event said, for the instantaneous throughput
+            self.__last_time = self.__started
+            self.__last_done = 0
+
+    def Total(self, total):
+        ''' For operations that only find out how big they are part way in '''
+        with self.__lock:
+            self.__total = total
+
+    def Advance(self, count):
+        ''' count more bytes are done. Sends an event if one's due '''
+        with self.__lock:
+            self.__done += count
+            event = None
+            if self.__sinks and time.time() - self.__last_time >= self.__interval:
+                event = self.__Event(False)
+        if event is not None:
+            self.__Send(event)
+
+    def Done(self):
+        return self.__done
+
+    def Timing(self, stage):
+        ''' with progress.Timing(progress.READ): ... '''
+        if not self.__sinks:
+            return _NOT_TIMING
+        return _Timer(self, stage)
+
+    def AddTime(self, stage, seconds):
+        with self.__lock:
+            self.__stages[stage] = self.__stages.get(stage, 0.0) + seconds
+
+    def Finish(self):
+        ''' Send the final event '''
+        if not self.__sinks or self.__operation is None:
+            return
+        with self.__lock:
+            event = self.__Event(True)
+        self.__Send(event)
+
+    def __Event(self, final):
+        ''' Call with the lock held '''
+        now = time.time()
+        elapsed = now - self.__started
+        since = now - self.__last_time
+        average = elapsed > 0 and self.__done / elapsed or 0.0
+        current = since > 0 and (self.__done - self.__last_done) / since or average
+
+        eta = None
+        if self.__total is not None and average > 0:
+            eta = max(0.0, (self.__total - self.__done) / average)
+
+        self.__last_time = now
+        self.__last_done = self.__done
+        return {'operation': self.__operation,
+                'name': self.__name,
+                'bytes_done': self.__done,
+                'bytes_total': self.__total,
+                'elapsed': elapsed,
+                'bytes_per_second': current,
+                'average_bytes_per_second': average,
+                'eta_seconds': eta,
+                'stages': dict(self.__stages),
+                'final': final,
+                'time': now}
+
+    def __Send(self, event):
+        for sink in self.__sinks:
+            sink.Event(event)
+
+def _Megabytes(count):
+    return count / float(2 ** 20)
+
+def _Duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return "%d:%02d:%02d" % (hours, minutes, seconds)
+    return "%d:%02d" % (minutes, seconds)
+
+class TerminalBar:
+    ''' One line, redrawn in place, on a terminal (STDERR by default) '''
+    def __init__(self, stream=None, width=30):
+        self.__stream = stream or sys.stderr
+        self.__width = width
+
+    def Event(self, event):
+        done, total = event['bytes_done'], event['bytes_total']
+        if total:
+            fraction = min(1.0, done / float(total))
+            filled = int(fraction * self.__width)
+            line = "[%s%s] %3d%% %.1f/%.1f MB" % ('#' * filled, ' ' * (self.__width - filled),
+                                                  fraction * 100, _Megabytes(done), _Megabytes(total))
+        else:
+            line = "%.1f MB" % (_Megabytes(done),)
+
+        line += " %.1f MB/s" % (_Megabytes(event['bytes_per_second']),)
+        if event['final']:
+            line += " in %s" % (_Duration(event['elapsed']),)
+        elif event['eta_seconds'] is not None:
+            line += " ETA %s" % (_Duration(event['eta_seconds']),)
+
+        spent = sum(event['stages'].values())
+        if spent > 0:
+            line += " (%s)" % (" ".join("%s %d%%" % (stage, 100 * seconds / spent)
+                                        for stage, seconds in sorted(event['stages'].items())
+                                        if seconds),)
+
+        # Pad out whatever the last line left behind
+        self.__stream.write("\r" + line.ljust(79))
+        if event['final']:
+            self.__stream.write("\n")
+        self.__stream.flush()
+
+    def Close(self):
+        pass
+
+class JSONLines:
+    ''' Every event, as a line of JSON. destination is a path, or anything with a write() '''
+    def __init__(self, destination):
+        self.__owned = not hasattr(destination, 'write')
+        if self.__owned:
+            destination = open(destination, "a")
+        self.__destination = destination
+        self.__lock = threading.Lock()
+
+    def Event(self, event):
+        line = json.dumps(event, sort_keys=True) + "\n"
+        with self.__lock:
+            self.__destination.write(line)
+            self.__destination.flush()
+
+    def Close(self):
+        if self.__owned:
+            self.__destination.close()
+
+class PrometheusTextfile:
+    ''' The latest event, as metrics for node_exporter's textfile collector.
+
+    The collector only reads files named *.prom. Each update replaces the
+    whole file at once, so it never sees half of one. labels go on every
+    metric, e.g. {'job': 'nightly'} '''
+    def __init__(self, path, labels=None):
+        self.__path = path
+        self.__labels = dict(labels or {})
+
+    def __Labels(self, **extra):
+        labels = dict(self.__labels)
+        labels.update(extra)
+        return "{%s}" % (",".join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                                  for name, value in sorted(labels.items())),)
+
+    def Event(self, event):
+        labels = self.__Labels(operation=event['operation'], name=event['name'])
+        lines = []
+        def Metric(name, kind, help, value, labels=labels):
+            lines.append("# HELP splice_%s %s" % (name, help))
+            lines.append("# TYPE splice_%s %s" % (name, kind))
+            lines.append("splice_%s%s %s" % (name, labels, repr(float(value))))
+
+        Metric("bytes_done", "gauge", "Bytes processed so far", event['bytes_done'])
+        if event['bytes_total'] is not None:
+            Metric("bytes_total", "gauge", "Bytes the operation will process in all", event['bytes_total'])
+        Metric("throughput_bytes_per_second", "gauge", "Throughput since the last update",
+               event['bytes_per_second'])
+        Metric("average_throughput_bytes_per_second", "gauge", "Throughput since the start",
+               event['average_bytes_per_second'])
+        Metric("elapsed_seconds", "gauge", "How long the operation has been running", event['elapsed'])
+        Metric("finished", "gauge", "1 once the operation is over", event['final'] and 1 or 0)
+        Metric("last_update_timestamp_seconds", "gauge", "When this file was written", event['time'])
+
+        lines.append("# HELP splice_stage_seconds Time spent in each stage, across all threads")
+        lines.append("# TYPE splice_stage_seconds counter")
+        for stage, seconds in sorted(event['stages'].items()):
+            lines.append("splice_stage_seconds%s %s" % (self.__Labels(operation=event['operation'], name=event['name'], stage=stage),
+                                                        repr(float(seconds))))
+
+        directory = os.path.dirname(os.path.abspath(self.__path))
+        handle, temporary = tempfile.mkstemp(dir=directory, prefix='.splice-', suffix='.partial')
+        try:
+            with os.fdopen(handle, "w") as metrics:
+                metrics.write("\n".join(lines) + "\n")
+            os.chmod(temporary, 0644)
+            os.rename(temporary, self.__path)
+        except:
+            os.remove(temporary)
+            raise
+
+    def Close(self):
+        pass
@@ -0,0 +1,301 @@
+#! /usr/bin/env python
+
+''' Getting as much as possible off a source that's failing.
+
+Works the way GNU ddrescue does. The map file remembers which byte
+ranges have been read, which failed, and which haven't been tried, so
+every run (and every pass within a run) only spends reads on what's
+still unknown. A dying disk only has so many reads left in it.
+
+The map is in ddrescue's format, so ddrescuelog and friends can read it. '''
+
+import io, logging, os, stat, time
+
+# Range states. Same characters ddrescue uses
+UNTRIED = '?'
+UNTRIMMED = '*'   # A block that failed. Its edges still need trimming
+UNSCRAPED = '/'   # Trimmed. The middle still needs reading a sector at a time
+BAD = '-'         # A sector that failed on its own
+GOOD = '+'
+
+_STATES = (UNTRIED, UNTRIMMED, UNSCRAPED, BAD, GOOD)
+
+class RescueMap:
+    ''' Every byte of the source, in contiguous ranges by state '''
+    def __init__(self, path, size):
+        self.__path = path
+        self.__size = size
+        self.__logger = logging.getLogger("splice.RescueMap")
+
+        self.__ranges = []
+        if size > 0:
+            self.__ranges.append((0, size, UNTRIED))
+
+        # Where the rescue's up to, and what it's doing there
+        self.__position = 0
+        self.__phase = UNTRIED
+
+        self.__saved = time.time()
+
+    def Path(self):
+        return self.__path
+
+    def Load(self):
+        ''' Pick up where a previous run left off. Returns whether there was anything to pick up '''
+        if not os.path.exists(self.__path):
+            return False
+
+        ranges = []
+        status_line = True
+        with open(self.__path, "r") as rescue_map:
+            for line in rescue_map:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                pieces = line.split()
+                if status_line:
+                    # current_pos current_status
+                    status_line = False
+                    continue
+                start, size, state = int(pieces[0], 16), int(pieces[1], 16), pieces[2]
+                if state not in _STATES:
+                    raise ValueError("Unknown state '%s' in '%s'" % (state, self.__path))
+                ranges.append((start, size, state))
+
+        end = 0
+        for start, size, state in ranges:
+            if start != end:
+                raise ValueError("'%s' has a gap at 0x%X" % (self.__path, end))
+            end = start + size
+        if end != self.__size:
+            raise ValueError("'%s' covers %d bytes. The source has %d" % (self.__path, end, self.__size))
+
+        self.__ranges = ranges
+        return True
+
+    def Save(self):
+        ''' Write it out. Never leaves a half-written map behind '''
+        temporary = self.__path + '.partial'
+        with open(temporary, "w") as rescue_map:
+            rescue_map.write("# Rescue map. Written by splice, in ddrescue's format\n")
+            rescue_map.write("# current_pos  current_status\n")
+            rescue_map.write("0x%08X     %s\n" % (self.__position, self.__phase))
+            rescue_map.write("#      pos        size  status\n")
+            for start, size, state in self.__ranges:
+                rescue_map.write("0x%08X  0x%08X  %s\n" % (start, size, state))
+            rescue_map.flush()
+            os.fsync(rescue_map.fileno())
+        os.rename(temporary, self.__path)
+        self.__saved = time.time()
+
+    def Checkpoint(self, position, phase, interval=5):
+        ''' Save, if it's been a while '''
+        self.__position = position
+        self.__phase = phase
+        if time.time() - self.__saved >= interval:
+            self.Save()
+
+    def Mark(self, start, size, state):
+        ''' Everything from start to start + size is now in state '''
+        if size <= 0:
+            return
+        end = start + size
+
+        before, after = [], []
+        for range_start, range_size, range_state in self.__ranges:
+            range_end = range_start + range_size
+            if range_end <= start:
+                before.append((range_start, range_size, range_state))
+            elif range_start >= end:
+                after.append((range_start, range_size, range_state))
+            else:
+                if range_start < start:
+                    before.append((range_start, start - range_start, range_state))
+                if range_end > end:
+                    after.append((end, range_end - end, range_state))
+
+        merged = []
+        for piece in before + [(start, size, state)] + after:
+            if merged and merged[-1][2] == piece[2]:
+                merged[-1] = (merged[-1][0], merged[-1][1] + piece[1], piece[2])
+            else:
+                merged.append(piece)
+        self.__ranges = merged
+
+    def Ranges(self, *states):
+        ''' (start, size, state) of every range in one of states '''
+        return [piece for piece in self.__ranges if piece[2] in states]
+
+    def Total(self, *states):
+        return sum(size for _, size, _ in self.Ranges(*states))
+
+    def Finished(self, start, size):
+        ''' Has every byte in there been read? '''
+        end = start + size
+        for range_start, range_size, range_state in self.__ranges:
+            if range_start < end and range_start + range_size > start and range_state != GOOD:
+                return False
+        return True
+
+class Rescuer:
+    ''' Reads everything it can out of source, handing it to sink(offset, data).
+
+    Passes, in order, each only over what the ones before it couldn't read:
+    1. Copy big blocks, skipping further and further ahead after each error,
+       to get the easy parts of a damaged area before touching the hard ones
+    2. Copy again, without skipping, over what that skipped
+    3. Trim each failed block from both ends, a sector at a time, until
+       hitting an error
+    4. Scrape what's left in the middle of each one, a sector at a time
+    5. Retry the bad sectors, however many times retries says
+
+    Given a latency.LatencyRecorder, every read gets timed into it. When it
+    has a threshold, pass 1 treats a read that took longer than that the way
+    it treats an error (apart from keeping the data), skipping ahead. So the
+    slow areas, which are likely the next to fail, wait until the healthy
+    ones are safe.
+
+    sink gets handed a view into a buffer that gets reused for the next
+    read, so it has to be finished with the data by the time it returns. '''
+    def __init__(self, source, rescue_map, sink, block_size=64 * 1024, sector_size=512, retries=1,
+                 latency=None):
+        self.__map = rescue_map
+        self.__latency = latency
+        # How long the last read took
+        self.__last_latency = 0.0
+        self.__sink = sink
+        self.__sector_size = sector_size
+        # Blocks have to be whole sectors
+        self.__block_size = max(sector_size, block_size - block_size % sector_size)
+        self.__retries = retries
+        self.__logger = logging.getLogger("splice.Rescuer")
+
+        self.__source = source
+        try:
+            fd = source.fileno()
+            if stat.S_ISREG(os.fstat(fd).st_mode) or stat.S_ISBLK(os.fstat(fd).st_mode):
+                # Unbuffered, so a bad sector only fails the read that asked for it,
+                # not whatever the file object's buffering decided to read ahead
+                self.__source = io.FileIO(fd, 'r', closefd=False)
+        except (AttributeError, IOError, ValueError):
+            pass
+
+        # The only read buffer there ever is
+        self.__buffer = bytearray(self.__block_size)
+        self.__view = memoryview(self.__buffer)
+
+    def Run(self):
+        ''' Returns how many bytes are still unreadable '''
+        self.__Copy(skipping=True)
+        self.__Copy(skipping=False)
+        self.__Trim()
+        self.__Scrape()
+        for attempt in range(self.__retries):
+            self.__Retry()
+        self.__map.Checkpoint(0, GOOD, interval=0)
+
+        unreadable = self.__map.Total(UNTRIED, UNTRIMMED, UNSCRAPED, BAD)
+        if unreadable:
+            self.__logger.error("%d bytes are still unreadable. Run it again to retry them" % (unreadable,))
+        return unreadable
+
+    def __Read(self, offset, size):
+        ''' Returns a view of what got read. None if the read failed '''
+        view = self.__view[:size]
+        started = time.time()
+        try:
+            self.__source.seek(offset)
+            done = 0
+            while done < size:
+                count = self.__source.readinto(view[done:])
+                if not count:
+                    break
+                done += count
+        except (IOError, OSError), e:
+            self.__Timed(offset, size, started, True)
+            self.__logger.debug("Read of %d bytes at 0x%X failed: %s" % (size, offset, e))
+            return None
+        self.__Timed(offset, size, started, done < size)
+        if done < size:
+            # The source shrank out from under us. Call the rest bad
+            self.__logger.error("Unexpected EOF at 0x%X" % (offset + done,))
+            return None
+        return view
+
+    def __Timed(self, offset, size, started, failed):
+        self.__last_latency = time.time() - started
+        if self.__latency is not None:
+            self.__latency.Record(offset, size, self.__last_latency, failed)
+
+    def __Attempt(self, offset, size, failed_state):
+        ''' Read one piece. Returns whether it worked '''
+        data = self.__Read(offset, size)
+        if data is None:
+            self.__map.Mark(offset, size, failed_state)
+            return False
+        self.__sink(offset, data)
+        self.__map.Mark(offset, size, GOOD)
+        return True
+
+    def __Copy(self, skipping):
+        phase = UNTRIED
+        for start, size, _ in self.__map.Ranges(UNTRIED):
+            position, end = start, start + size
+            skip = self.__block_size
+            while position < end:
+                count = min(self.__block_size, end - position)
+                if self.__Attempt(position, count, UNTRIMMED):
+                    position += count
+                    if skipping and self.__latency is not None and self.__latency.IsSlow(self.__last_latency):
+                        # Got it, but the area around it can wait for pass 2
+                        self.__logger.debug("Slow read (%.3fs) at 0x%X" % (self.__last_latency, position - count))
+                        position += min(skip, end - position)
+                        skip *= 2
+                    else:
+                        skip = self.__block_size
+                else:
+                    position += count
+                    if skipping:
+                        # Leave the next stretch for pass 2. Errors tend to cluster
+                        position += min(skip, end - position)
+                        skip *= 2
+                self.__map.Checkpoint(position, phase)
+
+    def __Trim(self):
+        for start, size, _ in self.__map.Ranges(UNTRIMMED):
+            end = start + size
+            low = start
+            while low < end:
+                count = min(self.__sector_size, end - low)
+                succeeded = self.__Attempt(low, count, BAD)
+                low += count
+                if not succeeded:
+                    break
+
+            high = end
+            while high > low:
+                count = (high - start) % self.__sector_size or self.__sector_size
+                count = min(count, high - low)
+                succeeded = self.__Attempt(high - count, count, BAD)
+                high -= count
+                if not succeeded:
+                    break
+
+            # Whatever's left in the middle waits for the scraping
+            self.__map.Mark(low, high - low, UNSCRAPED)
+            self.__map.Checkpoint(high, UNTRIMMED)
+
+    def __Sectors(self, state, failed_state):
+        for start, size, _ in self.__map.Ranges(state):
+            position, end = start, start + size
+            while position < end:
+                count = min(self.__sector_size, end - position)
+                self.__Attempt(position, count, failed_state)
+                position += count
+                self.__map.Checkpoint(position, state)
+
+    def __Scrape(self):
+        self.__Sectors(UNSCRAPED, BAD)
+
+    def __Retry(self):
+        self.__Sectors(BAD, BAD)
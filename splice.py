@@ -13,9 +13,9 @@
 
 from __future__ import with_statement
 
-import hashlib, logging, os, sys
-import random # debugging only
-import myexceptions
+import binascii, errno, hashlib, io, itertools, logging, mmap, multiprocessing, os, random, stat, sys, time
+import chunkstore, compression, digests, fastio, journal, latency, merkle, myexceptions, pools, progress, rescue, tuning
+import validation
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -27,6 +27,29 @@ _DEBUG = False
 def SwitchToDebug(d = True):
     _DEBUG = d
 
+# Each level of chunk directories takes this many digits of the chunk index,
+# so no directory ever holds more than 1000 chunks (or 1000 subdirectories),
+# however many chunks there are
+_FANOUT_DIGITS = 3
+# Versions whose readers only ever look for chunks in the split directory
+# itself, which caps them at 99,999 chunks
+_FLAT_VERSIONS = ('0.0.1', '0.0.2', '0.0.3', '0.0.4')
+_FLAT_DIGITS = 5
+
+# How much a merge reads of each chunk at a time, unless there's an IOSize
+_MERGE_READ_SIZE = 1024 * 1024
+
+# What a sparse split records instead of a codec for an all-zero chunk it
+# never wrote a file for (see Sparse)
+HOLE = 'hole'
+# For spotting zeros, and writing them, a piece at a time
+_ZEROS = '\0' * _MERGE_READ_SIZE
+
+class _Hole:
+    ''' What a merge passes along in place of a hole's bytes '''
+    def __init__(self, size):
+        self.size = size
+
 class Splicer:
     # FIXME: Really should have two seperate classes for merging and splitting
     # instead of handling it this way
@@ -38,17 +61,40 @@ class Splicer:
 
         # Since this is what we almost always want
         self.__repairing = False
+        # How many more times a repair goes back over sectors that failed
+        self.__rescue_retries = 1
+
+        # Only meaningful in validate mode
+        self.__validation_level = validation.STAT
+        self.__chunks_to_validate = None
+        self.__sample_size = None
+        # Where the validate mode's report goes: a path, or anything with a
+        # write(). None means nowhere
+        self.__report_destination = None
 
         # Should declare the variables that get created here for the sake of pickling.
         # Wonder if it still works that way?
         # Oh well. This class should pretty much *never* be pickled
         self.ResetSource()
 
-        self.__version = "0.0.2"
-
-        # This pretty much forces the user to specify a size. It's tempting
-        # to set it to 0 or None and change it into a required option
-        self.__buffer_size = 1
+        # 0.0.4 and later derive the checksum from the chunk digests, so a
+        # restarted split doesn't have to re-read everything it's already
+        # written. 0.0.5 makes that a Merkle tree
+        self.__version = "0.0.5"
+
+        # How big each chunk is. None means pick something that makes sense
+        # for the source (see __Tune)
+        self.__buffer_size = None
+        # How much each read of the source asks for. None means pick it too
+        self.__io_size = None
+        # What a split actually reads at a time, once that's been worked out
+        self.__read_size = None
+        # What picking the chunk size aims for: how many chunks, and how big
+        # one can get. Only matters when nobody set the BufferSize
+        self.__target_chunk_count = None
+        self.__maximum_chunk_size = None
+        # Measure the I/O size even when the chunk size is already settled
+        self.__auto_tune = False
     
         self.__logger = logging.getLogger("splice.Splicer")
         # FIXME: Configure the logger to send its output to self.__ui
@@ -57,13 +103,141 @@ class Splicer:
 
         # Note that this is Merger-specific
         self.__chunk_count = None
+        self.__expected_checksum = None
+
+        # Index => (size, hex digest) of every chunk. The splitter fills this
+        # in as chunks land. The merger loads it from a 0.0.3+ .details file
+        self.__chunk_details = {}
+
+        # Checkpoints for the split that's currently running
+        self.__journal = None
+
+        # How many pieces the merge reads ahead of the digest and the writes.
+        # A piece is one read's worth of a chunk (or a whole chunk, once it's
+        # been decompressed). 0 means do everything serially on one thread
+        self.__read_ahead = 4
+
+        # How many background threads write chunk files. 0 means the reading
+        # thread writes each one itself, the way it always has
+        self.__workers = 0
+
+        # Let the kernel copy chunks straight out of the source file
+        self.__zero_copy = False
+
+        # Read the source around the page cache (O_DIRECT)
+        self.__direct_io = False
+
+        # What chunks bigger than one read get streamed through (see
+        # __StreamChunk). Allocated once, the first time it's needed
+        self.__chunk_buffer = None
+
+        # Skipping the checksums is only sane for trusted local copies
+        self.__hashing = True
+        # What the chunks (and the whole file, for older versions) get hashed
+        # with. A merge or validation gets it from the .details
+        self.__digest = digests.DEFAULT
+
+        # Merge by preallocating the output and copying every chunk straight
+        # to its offset, in parallel
+        self.__preallocate = False
+
+        # Where a merge goes: a path, or anything with a write(). None means
+        # a file named after the .details
+        self.__merge_destination = None
+
+        # Content-defined chunking: (minimum, average, maximum) chunk sizes,
+        # and the store the chunks go into. Either one turns it on
+        self.__content_defined = None
+        self.__store_path = None
+
+        # Where a content-defined splice's chunks are. Merger-specific
+        self.__store = None
+
+        # How the loaded splice's chunk files are laid out: ('nested', how many
+        # digits their indices get padded to, or None for streamed splits).
+        # None for older splices that can only be found by listing the directory
+        self.__layout = None
+
+        # The last directory a split put a chunk in. Splitter-specific
+        self.__chunk_directory = None
+
+        # Which codec a split compresses its chunks with. None writes them raw
+        self.__compression = None
+        self.__compression_level = None
+        # The processes doing the (de)compressing, while an operation runs
+        self.__compressor = None
+        # Index => (codec, stored size) of every chunk that went through it.
+        # Anything missing is stored raw
+        self.__chunk_codecs = {}
+
+        # Leave all-zero chunks out, and just note them in the .details
+        self.__sparse = False
+        # Whether the split that's running actually is (see __CheckSparse)
+        self.__making_holes = False
+        # Indices of the chunks that got left out
+        self.__holes = set()
+        # Size => hex digest of that many zeros
+        self.__zero_digests = {}
+
+        # Where bytes done, throughput and the time spent in each stage get reported
+        self.__progress = progress.Progress()
+
+        # Time every read of the source, and call any over the threshold
+        # (in seconds) slow. The recorder only exists while a split runs
+        self.__track_latency = False
+        self.__slow_threshold = None
+        self.__latency = None
 
     def Operate(self):
         ''' Effectively, this is main() '''
+        source = self.__source
+        total = None
+        if self.__mode == "split":
+            self.__Tune()
+            self.__source = self.__DirectSource()
+            if not self.__streaming:
+                total = self.__source_size
+            if self.__track_latency:
+                self.__latency = latency.LatencyRecorder(self.__slow_threshold, total)
+                if self.__slow_threshold is not None and not self.__repairing:
+                    self.__logger.info("Only a rescue leaves slow areas for last. Just reporting them")
+            self.__making_holes = self.__CheckSparse()
+            self.__holes = set()
+        self.__progress.Start(self.__mode, total, self.__source_file_name)
+        try:
+            return self.__Operate()
+        finally:
+            self.__progress.Finish()
+            self.__CloseCompressor()
+            self.__SaveLatencyReport()
+            if self.__source is not source:
+                self.__source.close()
+                self.__source = source
+
+    def __Operate(self):
+        self.__chunk_directory = None
         if self.__mode == "merge":
-            self._Merge()
+            return self._Merge()
+        elif self.__mode == "split" and self.__repairing and not self.__streaming:
+            return self.__RescueSplitter()
+        elif self.__mode == "split" and self.__ContentDefinedSizes() is not None:
+            # Works the same whether or not the source can seek
+            self.__ContentDefinedSplitter()
+        elif self.__mode == "split" and self.__streaming:
+            self.__StreamingSplitter()
         elif self.__mode == "split":
-            self.__ActualSplitter()
+            source_fd = None
+            if self.__zero_copy:
+                source_fd = self.__ZeroCopySource()
+            if source_fd is not None:
+                self.__ZeroCopySplitter(source_fd)
+            else:
+                self.__ActualSplitter()
+        elif self.__mode == "validate":
+            report = self.ValidationReport(self.__validation_level, self.__chunks_to_validate,
+                                           self.__sample_size)
+            self.__SaveReport(report)
+            return report.Ok()
         else:
             raise NotImplementedError("Unknown mode: " + str(self.__mode))
 
@@ -74,9 +248,36 @@ class Splicer:
     def SetMergeMode(self):
         self.__mode = "merge"
 
+    def SetValidateMode(self, thorough=False, chunks=None, level=None, sample=None):
+        ''' See ValidationReport for the levels. thorough is short for 'full' '''
+        if level is None:
+            level = thorough and validation.FULL or validation.STAT
+        if level not in validation.LEVELS:
+            raise ValueError("Unknown validation level '%s'" % (level,))
+        self.__mode = "validate"
+        self.__validation_level = level
+        self.__chunks_to_validate = chunks
+        self.__sample_size = sample
+
     def SetRepairSplice(self, mode):
+        ''' Split a failing source the careful way. See __RescueSplitter '''
         self.__repairing = mode
 
+    def RescueRetries(self, count=None):
+        ''' How many extra times a repair re-reads sectors that failed '''
+        if count is not None:
+            count = int(count)
+            if count < 0:
+                raise ValueError("Can't retry a negative number of times")
+            self.__rescue_retries = count
+
+        return self.__rescue_retries
+
+    def Progress(self):
+        ''' The progress.Progress operations report into. Add sinks to it to
+        hear about bytes done, throughput, and where the time's going '''
+        return self.__progress
+
     def SourceFileName(self, name=None):
         if name is not None:
             self.__source_file_name = name
@@ -90,6 +291,8 @@ class Splicer:
         self.__source_file_name = "STDIN"
         # Start with a default that kind of makes sense for piping from STDIN
         self.__source_size = sys.maxint
+        # i.e. we have no idea how big it is, and can't seek around in it
+        self.__streaming = True
 
     def Source(self, src=None):
         if src is not None:
@@ -97,22 +300,219 @@ class Splicer:
                 src.seek(0, 2)
                 self.__source_size = src.tell()
                 src.seek(0, 0)
+                self.__streaming = False
             except AttributeError:
-                self.__logger.error("Currently only supporting seekable objects for splicing")
+                self.__logger.error("Need a file-like object for splicing")
                 raise
+            except IOError:
+                # Pipes, sockets, terminals...
+                self.__logger.info("Source isn't seekable. Streaming it")
+                self.__source_size = sys.maxint
+                self.__streaming = True
             self.__source = src
 
         return self.__source
 
-    def Version(self):
+    def Streaming(self):
+        ''' Is the source something we can only read straight through once? '''
+        return self.__streaming
+
+    def Version(self, version=None):
+        ''' Which .details format to write. Merging reads it from the .details '''
+        if version is not None:
+            if version not in ('0.0.2', '0.0.3', '0.0.4', '0.0.5'):
+                raise myexceptions.VersionError("Can't write version " + str(version))
+            self.__CheckDigest(version, self.__digest)
+            self.__version = version
+
         return self.__version
 
     def BufferSize(self, size=None):
+        ''' How big each chunk is. Leave it alone to have a split pick one
+        (see ChunkCount and MaximumChunkSize) '''
         if size is not None:
             self.__buffer_size = int(size)
 
         return self.__buffer_size
 
+    def IOSize(self, size=None):
+        ''' How much each read of the source asks for. Leave it alone to have
+        a split measure what the source likes '''
+        if size is not None:
+            size = int(size)
+            if size <= 0:
+                raise ValueError("Reads have to ask for something")
+            self.__io_size = size
+
+        return self.__io_size
+
+    def ChunkCount(self, count=None):
+        ''' Roughly how many chunks a split should make, when it's picking the size '''
+        if count is not None:
+            count = int(count)
+            if count <= 0:
+                raise ValueError("Need at least one chunk")
+            self.__target_chunk_count = count
+
+        return self.__target_chunk_count
+
+    def MaximumChunkSize(self, size=None):
+        ''' The biggest chunk a split should make, when it's picking the size '''
+        if size is not None:
+            size = int(size)
+            if size <= 0:
+                raise ValueError("Chunks have to hold something")
+            self.__maximum_chunk_size = size
+
+        return self.__maximum_chunk_size
+
+    def AutoTune(self, enabled=None):
+        ''' Measure the I/O size, whether or not the chunk size got set '''
+        if enabled is not None:
+            self.__auto_tune = bool(enabled)
+
+        return self.__auto_tune
+
+    def Workers(self, count=None):
+        if count is not None:
+            count = int(count)
+            if count < 0:
+                raise ValueError("Can't have a negative number of workers")
+            self.__workers = count
+
+        return self.__workers
+
+    def ZeroCopy(self, enabled=None):
+        if enabled is not None:
+            self.__zero_copy = bool(enabled)
+
+        return self.__zero_copy
+
+    def DirectIO(self, enabled=None):
+        ''' Split (or rescue) by reading the source with O_DIRECT, so a big
+        split doesn't flush everything else out of the page cache, and a
+        rescue's reads only ever touch the sectors it asked for '''
+        if enabled is not None:
+            self.__direct_io = bool(enabled)
+
+        return self.__direct_io
+
+    def ReadLatency(self, enabled=None, threshold=None):
+        ''' Time every read a split makes, and leave a report of it next to the
+        .details: a histogram, the slow regions, and a heat map of the source.
+
+        Reads that take over threshold seconds count as slow. A rescue
+        (SetRepairSplice) gets everything else first, and comes back to the
+        areas around those at the end. Any other split reads straight
+        through, in order, and only reports them: its chunks (and, before
+        0.0.4, its checksum) have to come out in order. Setting a threshold
+        turns this on. '''
+        if threshold is not None:
+            self.__slow_threshold = float(threshold)
+            enabled = True
+        if enabled is not None:
+            self.__track_latency = bool(enabled)
+
+        return self.__track_latency
+
+    def Hashing(self, enabled=None):
+        if enabled is not None:
+            self.__hashing = bool(enabled)
+
+        return self.__hashing
+
+    def Digest(self, name=None):
+        ''' What a split hashes with: 'sha256', 'blake2b', 'sha1', 'crc32', ...
+        (see digests). The .details records it, so merges and validations
+        ignore this and go by that '''
+        if name is not None:
+            digests.Check(name)
+            self.__CheckDigest(self.__version, name)
+            self.__digest = name
+
+        return self.__digest
+
+    def __CheckDigest(self, version, name):
+        ''' Only 0.0.3 and later have a Digest header. Anything reading a
+        0.0.2 .details checks it with sha256 '''
+        if version == '0.0.2' and name != digests.DEFAULT:
+            raise myexceptions.VersionError("Version 0.0.2 splits always use %s. %s needs 0.0.3 or later" %
+                                            (digests.DEFAULT, name))
+
+    def Sparse(self, enabled=None):
+        ''' Split without writing (or hashing) any chunk that's all zeros.
+        The .details marks each one as a hole, and a merge seeks past it, so
+        the merged file comes out sparse too. Needs 0.0.3 or later '''
+        if enabled is not None:
+            self.__sparse = bool(enabled)
+
+        return self.__sparse
+
+    def Preallocate(self, enabled=None):
+        if enabled is not None:
+            self.__preallocate = bool(enabled)
+
+        return self.__preallocate
+
+    def MergeDestination(self, destination=None):
+        ''' A path, or any writable file-like object (like sys.stdout) '''
+        if destination is not None:
+            self.__merge_destination = destination
+
+        return self.__merge_destination
+
+    def Compression(self, codec=None, level=None):
+        ''' Compress each chunk a split writes with codec ('zlib', 'bz2', or
+        'lzma' where it's available), across as many processes as there are
+        workers (or cores). Chunks that don't shrink get stored raw anyway '''
+        if codec is not None:
+            if codec not in compression.Available():
+                raise ValueError("Unknown compression '%s'. Have: %s" % (codec, ", ".join(compression.Available())))
+            self.__compression = codec
+            self.__compression_level = level
+
+        return self.__compression
+
+    def ReportDestination(self, destination=None):
+        ''' Where validate mode writes its report, as JSON: a path, or
+        anything with a write() (like sys.stdout) '''
+        if destination is not None:
+            self.__report_destination = destination
+
+        return self.__report_destination
+
+    def ReadAhead(self, pieces=None):
+        ''' How many reads a merge gets ahead of hashing and writing. Each one
+        is up to IOSize bytes of a chunk, or a whole chunk that's compressed '''
+        if pieces is not None:
+            pieces = int(pieces)
+            if pieces < 0:
+                raise ValueError("Can't read ahead a negative number of pieces")
+            self.__read_ahead = pieces
+
+        return self.__read_ahead
+
+    def ChunkStore(self, path=None):
+        ''' Where content-defined splits keep their chunks. Any number of
+        splits can share one. Setting it turns on content-defined chunking '''
+        if path is not None:
+            self.__store_path = path
+
+        return self.__store_path
+
+    def ContentDefined(self, sizes=None):
+        ''' (minimum, average, maximum) chunk sizes for content-defined chunking.
+
+        Setting them turns it on. Without a ChunkStore, the chunks go into a
+        store inside the split's own directory. '''
+        if sizes is not None:
+            minimum, average, maximum = [int(size) for size in sizes]
+            if not 0 < minimum <= average <= maximum:
+                raise ValueError("Chunk sizes need 0 < minimum <= average <= maximum")
+            self.__content_defined = (minimum, average, maximum)
+
+        return self.__content_defined
+
     def WorkingDirectory(self, pwd=None):
         if pwd is not None:
             self.__working_directory = pwd
@@ -127,8 +527,9 @@ class Splicer:
         # directory
         base_name = self.__PickBaseName()
 
-        # Somewhere to put the pieces
-        destination_directory = base_name + '.split'
+        # Somewhere to put the pieces. Under the working directory, so
+        # splitting doesn't depend on whatever the process's cwd happens to be
+        destination_directory = os.path.join(self.__working_directory, base_name + '.split')
 
         return destination_directory
 
@@ -136,6 +537,30 @@ class Splicer:
     # Merging
     ##################################################################################
 
+    def __OpenCompressor(self, codec):
+        ''' Start the (de)compressing processes. Before any worker threads,
+        so the processes don't get forked in the middle of anything '''
+        self.__compressor = compression.Pool(codec, self.__compression_level,
+                                             self.__workers or None)
+
+    def __CloseCompressor(self):
+        if self.__compressor is not None:
+            self.__compressor.Close()
+            self.__compressor = None
+
+    def __Compressed(self):
+        ''' Did any of the loaded splice's chunks get compressed? '''
+        return any(codec != compression.RAW for codec, _ in self.__chunk_codecs.values())
+
+    def __ReadStoredChunk(self, index, file_path):
+        ''' The chunk's actual contents, decompressed if need be '''
+        with self.__progress.Timing(progress.READ):
+            with open(file_path, "rb") as chunk:
+                data = chunk.read()
+        codec = self.__chunk_codecs.get(index, (compression.RAW, None))[0]
+        with self.__progress.Timing(progress.COMPRESS):
+            return self.__compressor.Decompress(codec, data)
+
     def __PickDigest(self, version):
         ''' An unfortunate leftover from the way I'm currently handling version details '''
         # Returns the hashing style. Sets internal buffer size property
@@ -147,8 +572,11 @@ class Splicer:
 
         if version == '0.0.1':
             digest = hashlib.md5()
-        elif version == '0.0.2':
-            digest = hashlib.sha256()
+        elif version == '0.0.2' or version == '0.0.3':
+            digest = digests.New(self.__digest)
+        elif version == '0.0.4' or version == '0.0.5':
+            # No whole-file digest. The checksum comes from the chunk digests
+            pass
         else:
             raise myexceptions.VersionError("Unknown version")
 
@@ -202,42 +630,615 @@ class Splicer:
 
         self.__logger.debug("Pulling details out of the directory file '" + self.__source_file_name + "'")
 
-        # the files that might be interesting
-        list_of_file_names = os.listdir(self.__working_directory)
-
         details_file_name = os.path.join(self.__working_directory, self.__source_file_name)
+        details = {}
+        self.__chunk_details = {}
+        self.__chunk_codecs = {}
+        self.__holes = set()
         with open(details_file_name, "r") as details_file:
             # FIXME: This really should be a YAML file
-            # Version:
-            self.__version = details_file.readline().split(' ')[1].strip()
-
-            # Chunk Count:
-            self.__chunk_count = int(details_file.readline().split(' ')[2].strip())
-
-            # stash this for later
-            expected_checksum = details_file.readline().split(' ')[1].strip()
-
-            if self.__version == '0.0.1':
-                # This really isn't justified. The -b parameter was available then. I just
-                # don't recall it ever being used. Does this actually matter on the
-                # merge? I'm just reading 'destination' files until the end, then merging
-                # them back into the 'source'.
-                # Actually, that's a *really* important detail for dealing with trying to
-                # work around bad sectors
-                self.__buffer_size = 1024
-            elif self.__version == '0.0.2':
-                self.__buffer_size = int(details_file.readline().split(' ')[1].strip())
-
-    def Validate(self):
-        # Copy/pasted from _Merge. Smells!
-        list_of_file_names = os.listdir(self.__working_directory)
+            for line in details_file:
+                key, separator, value = line.partition(':')
+                if not separator:
+                    continue
+                value = value.strip()
+                if key == 'Chunk':
+                    # 0.0.3 and later: index size digest [codec stored-size | hole]
+                    pieces = value.split()
+                    index, size, chunk_digest = pieces[:3]
+                    self.__chunk_details[int(index)] = (int(size), chunk_digest)
+                    if pieces[3:] == [HOLE]:
+                        self.__holes.add(int(index))
+                    elif len(pieces) > 3:
+                        self.__chunk_codecs[int(index)] = (pieces[3], int(pieces[4]))
+                else:
+                    details[key] = value
+
+        self.__version = details['Version']
+        self.__chunk_count = int(details['Chunk Count'])
+        self.__layout = None
+        if 'Layout' in details:
+            style, width = details['Layout'].split()
+            if style != 'nested':
+                raise myexceptions.VersionError("Unknown chunk layout: " + details['Layout'])
+            self.__layout = (style, (width != 'streamed') and int(width) or None)
+        self.__store = None
+        if 'Store' in details:
+            # Content-defined. Relative to the .details
+            self.__store = chunkstore.ChunkStore(os.path.join(self.__working_directory,
+                                                              details['Store']))
+        # stash this for later
+        self.__expected_checksum = details['Checksum']
+        self.__digest = details.get('Digest', digests.DEFAULT)
+        if self.__digest not in digests.Available():
+            raise myexceptions.VersionError("Split with a '%s' digest, which this python doesn't have" % (self.__digest,))
+        if int(details.get('Unreadable', 0)):
+            self.__logger.warn("%s bytes of the source were unreadable. They'll be zeros" % (details['Unreadable'],))
+
+        if self.__version == '0.0.1':
+            # This really isn't justified. The -b parameter was available then. I just
+            # don't recall it ever being used. Does this actually matter on the
+            # merge? I'm just reading 'destination' files until the end, then merging
+            # them back into the 'source'.
+            # Actually, that's a *really* important detail for dealing with trying to
+            # work around bad sectors
+            self.__buffer_size = 1024
+        else:
+            self.__buffer_size = int(details['BlockSize'])
+
+    def __ChunkFiles(self, sizes=None, extras=None):
+        ''' (index, path) of each chunk file that belongs to this splice, in merge order.
+
+        Fills in sizes (if there is one) with index => size on disk. Without
+        a Layout header, that comes for free from the one directory scan.
+        With one, every chunk's path comes straight from its index, and gets
+        a stat() of its own: no directory gets listed at all.
+
+        Which means nothing notices chunk files that shouldn't be there. If
+        extras is a set, it gets the index of every one of those, from a walk
+        over the whole split directory. Without a Layout header, they're
+        already in the list '''
+        if sizes is None:
+            sizes = {}
+
+        if self.__layout is not None:
+            # Every chunk's exactly where the .details says. Nothing to parse
+            base_name = os.path.basename(self.__PickSourceRootName())
+            files_to_merge = []
+            for index in xrange(self.__chunk_count):
+                if index in self.__holes:
+                    continue
+                file_path = self.__ChunkPath(self.__working_directory, base_name, index, self.__layout[1])
+                try:
+                    status = os.stat(file_path)
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    continue
+                files_to_merge.append((index, file_path))
+                sizes[index] = status.st_size
+            if extras is not None:
+                extras.update(self.__StrayChunks(base_name))
+            return files_to_merge
+
+        if self.__store is not None:
+            # The .details says where everything is. The same chunk can show
+            # up at more than one index. Store directories can hold far more
+            # than this one splice, so they don't get scanned
+            files_to_merge = []
+            for index in sorted(self.__chunk_details):
+                file_path = self.__store.Path(self.__chunk_details[index][1])
+                try:
+                    sizes[index] = os.stat(file_path).st_size
+                except OSError:
+                    continue
+                files_to_merge.append((index, file_path))
+            return files_to_merge
+
+        listing = fastio.ScanDirectory(self.__working_directory)
         source_root_name = self.__PickSourceRootName()
 
-        files_to_merge = self.__Chunks(list_of_file_names, source_root_name)
-        return len(files_to_merge) == self.__chunk_count
+        files_to_merge = []
+        for file_name in self.__Chunks(listing.keys(), source_root_name):
+            index = self.__ChunkIndex(file_name)
+            files_to_merge.append((index, os.path.join(self.__working_directory, file_name)))
+            sizes[index] = listing[file_name]
+        files_to_merge.sort()
+        return files_to_merge
+
+    def __StrayChunks(self, base_name):
+        ''' Indices of this splice's chunk files that aren't where the Layout
+        says any chunk should be: past the end, or in the wrong directory '''
+        strays = set()
+        for directory, subdirectories, files in os.walk(self.__working_directory):
+            for file_name in self.__Chunks(files, base_name):
+                try:
+                    index = self.__ChunkIndex(file_name)
+                except ValueError:
+                    continue
+                expected = self.__ChunkPath(self.__working_directory, base_name, index, self.__layout[1])
+                if (index >= self.__chunk_count or
+                        os.path.normpath(expected) != os.path.normpath(os.path.join(directory, file_name))):
+                    strays.add(index)
+        return strays
+
+    def __MergeFiles(self, sizes=None):
+        ''' __ChunkFiles, plus (index, None) for each hole '''
+        files = [(index, file_path) for index, file_path in self.__ChunkFiles(sizes)
+                 if index not in self.__holes]
+        files.extend((index, None) for index in self.__holes)
+        files.sort()
+        return files
+
+    def __ExpectedStoredSize(self, index):
+        ''' How big the chunk's file should be. None if there's no telling '''
+        if index in self.__chunk_codecs:
+            return self.__chunk_codecs[index][1]
+        if index in self.__chunk_details:
+            return self.__chunk_details[index][0]
+        if index < self.__chunk_count - 1 and self.__store is None:
+            # Older versions only know that everything but the last chunk is full size
+            return self.__buffer_size
+        return None
+
+    def __ChunkIndex(self, file_name):
+        ''' Which chunk does this file hold? '''
+        index = file_name.split('.')[-2]
+        if index[:1].isalpha():
+            # Streamed split. See __ChunkPath
+            index = index[1:]
+        return int(index)
+
+    def __HashChunk(self, file_path, index=None):
+        ''' (size, hex digest) of a chunk file as it is on disk (or once it's
+        decompressed, if it's a compressed chunk) '''
+        if index in self.__chunk_codecs:
+            block = self.__ReadStoredChunk(index, file_path)
+            self.__progress.Advance(len(block))
+            return len(block), self.__Digest(block)
+
+        digest = digests.New(self.__digest)
+        size = 0
+        with open(file_path, "rb") as chunk:
+            while True:
+                # Big enough that hashlib lets go of the GIL
+                with self.__progress.Timing(progress.READ):
+                    bytes = chunk.read(1024 * 1024)
+                if not bytes:
+                    break
+                size += len(bytes)
+                self.__Hash(digest, bytes)
+                self.__progress.Advance(len(bytes))
+
+        return size, digest.hexdigest()
+
+    def __VerifyChunk(self, file_path, index, actual_digests):
+        ''' Does the chunk on disk match what the .details recorded? '''
+        expected_size, expected_digest = self.__chunk_details[index]
+        size, actual_digests[index] = self.__HashChunk(file_path, index)
+
+        if size != expected_size:
+            self.__logger.error("Chunk %d is %d bytes. Expected %d" % (index, size, expected_size))
+            return False
+        if expected_digest != 'none' and actual_digests[index] != expected_digest:
+            self.__logger.error("Chunk %d is corrupt" % (index,))
+            return False
+        return True
+
+    def ChunkMap(self):
+        ''' [(index, path, size, codec)] of every chunk in the splice the
+        .details (SourceFileName) describes, in order. size is how much of the
+        original file the chunk holds. A hole's path is None, and its codec
+        is HOLE. For reading a splice in place (see splicedfile). Raises
+        IOError if any chunk's missing '''
+        self.__LoadDetails()
+        sizes = {}
+        files = self.__MergeFiles(sizes)
+        if len(files) != self.__chunk_count:
+            raise IOError("Wrong chunk count. Expected %d. Have %d" % (self.__chunk_count, len(files)))
+
+        chunks = []
+        for index, file_path in files:
+            if file_path is None:
+                # No file at all. See Sparse
+                chunks.append((index, None, self.__chunk_details[index][0], HOLE))
+                continue
+            if index in self.__chunk_details:
+                size = self.__chunk_details[index][0]
+            else:
+                # Older versions don't say. Never compressed, though
+                size = sizes[index]
+            codec = self.__chunk_codecs.get(index, (compression.RAW, None))[0]
+            chunks.append((index, file_path, size, codec))
+        return chunks
+
+    def Validate(self, thorough=False, chunks=None, level=None, sample=None):
+        ''' Is everything there that a merge needs? Returns True or False.
+
+        By default, this checks that every chunk file exists and is the right
+        size, without reading any of them. A thorough validation (level 'full')
+        reads and hashes every chunk too. See ValidationReport '''
+        if level is None:
+            level = thorough and validation.FULL or validation.STAT
+        report = self.ValidationReport(level, chunks, sample)
+        if not report.Ok():
+            self.__logger.error(report.Summary())
+        return report.Ok()
+
+    def ValidationReport(self, level=validation.STAT, chunks=None, sample=None):
+        ''' What's missing, short, or corrupt? Returns a validation.Report.
+
+        'count' just looks for every chunk file. 'stat' also compares each
+        one's size with the .details, from one directory scan per directory:
+        no chunk gets read, so it's fast enough to gate every merge on.
+        'sample' hashes sample randomly chosen chunks as well (a few dozen
+        by default), and 'full' hashes every one of them, as many at a time
+        as there are workers (or cores, if there aren't any workers).
+        Hashing needs a 0.0.3 or later splice.
+
+        chunks limits the hashing to just those chunk indices. For 0.0.4 and
+        later, the chunks that do get read are still tied back to the
+        top-level checksum, with the .details standing in for the rest. '''
+        if self.__chunk_count is None:
+            self.__LoadDetails()
+
+        report = validation.Report(level, self.__chunk_count)
+        sizes = {}
+        strays = set()
+        files_to_merge = self.__ChunkFiles(sizes, strays)
+
+        # Holes never had files
+        found = set(index for index, _ in files_to_merge) | self.__holes
+        expected = set(xrange(self.__chunk_count))
+        report.missing = sorted(expected - found)
+        report.extra = sorted((found - expected) | strays)
+        if level == validation.COUNT:
+            return report
+
+        for index in sorted(found & expected - self.__holes):
+            expected_size = self.__ExpectedStoredSize(index)
+            if expected_size is None:
+                continue
+            if sizes[index] < expected_size:
+                report.short.append(index)
+            elif sizes[index] > expected_size:
+                report.oversized.append(index)
+        if level == validation.STAT:
+            return report
+
+        if self.__version not in ('0.0.3', '0.0.4', '0.0.5'):
+            # An empty split of a later version has no Chunk lines either, but
+            # then there's nothing to check
+            raise myexceptions.VersionError("Version %s splices don't record per-chunk digests" % (self.__version,))
+
+        wanted = set(self.__chunk_details)
+        if chunks is not None:
+            wanted &= set(chunks)
+        # No point hashing what's already known to be wrong
+        wanted -= set(report.short + report.oversized + report.extra)
+        to_check = [(index, file_path) for index, file_path in files_to_merge
+                    if index in wanted and index not in self.__holes]
+        if level == validation.SAMPLE:
+            if sample is None:
+                sample = validation.DEFAULT_SAMPLE
+            to_check = sorted(random.sample(to_check, min(sample, len(to_check))))
+
+        results = {}
+        actual_digests = {}
+        for index in wanted & self.__holes:
+            # Nothing to read. The .details just has to agree that it's zeros
+            size, expected_digest = self.__chunk_details[index]
+            actual_digests[index] = self.__ZeroDigest(size)
+            results[index] = expected_digest in ('none', actual_digests[index])
+        def Verify(file_path, index):
+            results[index] = self.__VerifyChunk(file_path, index, actual_digests)
+
+        decompressing = self.__Compressed() and self.__compressor is None
+        if decompressing:
+            self.__OpenCompressor(compression.RAW)
+        try:
+            with pools.WorkerPool(self.__workers or multiprocessing.cpu_count()) as checkers:
+                for index, file_path in to_check:
+                    checkers.Submit(Verify, file_path, index)
+        finally:
+            if decompressing:
+                self.__CloseCompressor()
+
+        report.checked = sorted(results)
+        report.corrupt = sorted(index for index, intact in results.items() if not intact)
+        if report.Ok() and self.__PickDigest(self.__version) is None:
+            leaves = dict(self.__chunk_details)
+            for index, actual_digest in actual_digests.items():
+                leaves[index] = (leaves[index][0], actual_digest)
+            report.checksum_matches = self.__ChecksumMatches(self.__DerivedChecksum(leaves))
+        return report
+
+    def __SaveReport(self, report):
+        destination = self.__report_destination
+        if destination is None:
+            return
+        if hasattr(destination, 'write'):
+            destination.write(report.ToJSON() + '\n')
+            destination.flush()
+        else:
+            with open(destination, "w") as sink:
+                sink.write(report.ToJSON() + '\n')
+
+    def __ReadChunks(self, files_to_merge, ring=None):
+        ''' Producer half of the merge pipeline. Yields (index, codec, bytes)
+
+        With a ring, uncompressed chunks come out a read at a time, as views
+        into ring buffers that get reused round robin. So ring has to be more
+        than however many pieces can be in flight downstream at once. Without
+        one, every chunk comes out whole. The views are buffer objects, which
+        everything from file.write() to zlib.crc32() takes '''
+        buffers = [bytearray(self.__io_size or _MERGE_READ_SIZE) for i in range(ring or 0)]
+        next_buffer = 0
+        for index, file_path in files_to_merge:
+            #self.__logger.info("# " + file_path)
+            if file_path is None:
+                yield index, compression.RAW, _Hole(self.__chunk_details[index][0])
+                continue
+            codec = self.__chunk_codecs.get(index, (compression.RAW, None))[0]
+
+            # Note the major distinction here between source and self.__source.
+            # Much ugliness has entered this code!
+            with open(file_path, "rb") as source:
+                while True:
+                    if buffers and codec == compression.RAW:
+                        with self.__progress.Timing(progress.READ):
+                            count = source.readinto(buffers[next_buffer])
+                        bytes = buffer(buffers[next_buffer], 0, count)
+                        if count:
+                            next_buffer = (next_buffer + 1) % len(buffers)
+                    else:
+                        # Decompressing takes the whole chunk
+                        with self.__progress.Timing(progress.READ):
+                            bytes = source.read()
+                    if not len(bytes):
+                        break
+                    yield index, codec, bytes
+
+    def __ChecksumMatches(self, actual_checksum):
+        if self.__expected_checksum == 'none':
+            self.__logger.warn("Split without a checksum. Nothing to verify the merge against")
+        elif actual_checksum != self.__expected_checksum:
+            # Should probably go ahead and throw an exception here
+            self.__logger.error("Checksums don't match!")
+            return False
+        else:
+            self.__logger.debug("Merge succeeded (checksum: '" + actual_checksum + "')") 
+        return True
+
+    def __DerivedChecksum(self, chunk_details):
+        ''' The 0.0.4 and later checksum, which only needs the chunk digests.
+
+        0.0.4 is a digest of all the chunk digests, in order. 0.0.5 is the root
+        of a Merkle tree over them '''
+        leaves = [chunk_details[index][1] for index in sorted(chunk_details)]
+        if 'none' in leaves:
+            return 'none'
+
+        if self.__version == '0.0.4':
+            digest = digests.New(self.__digest)
+            for leaf in leaves:
+                digest.update(binascii.unhexlify(leaf))
+            return digest.hexdigest()
+        return merkle.HexRoot(leaves, lambda data: digests.New(self.__digest, data))
+
+    def __DerivedChecksumMatches(self):
+        ''' Do the chunk digests in the .details add up to its checksum? '''
+        return self.__ChecksumMatches(self.__DerivedChecksum(self.__chunk_details))
+
+    def __ChunkDigestsMatch(self, actual_digests):
+        ''' actual_digests is index => hex digest of what actually got merged '''
+        matches = True
+        for index in sorted(self.__chunk_details):
+            expected_digest = self.__chunk_details[index][1]
+            if expected_digest != 'none' and actual_digests.get(index) != expected_digest:
+                self.__logger.error("Chunk %d is corrupt" % (index,))
+                matches = False
+        if not matches:
+            self.__logger.error("Checksums don't match!")
+            return False
+        return self.__DerivedChecksumMatches()
+
+    def __StreamedMerge(self, files_to_merge, destination, digest):
+        ''' Append every chunk to the destination, in order.
+
+        destination is either a file name or something to write() to. Either
+        way, memory use is capped by the read-ahead. Uncompressed chunks go
+        through a fixed set of buffers a read at a time, so it doesn't depend
+        on how big the chunks are either '''
+        # Older versions hash the whole file. 0.0.4 and later hash each chunk
+        chunk_digests = {}
+        current = {}
+        def Hash(item):
+            index, bytes = item
+            hole = isinstance(bytes, _Hole)
+            if digest is not None:
+                if hole:
+                    self.__HashZeros(digest, bytes.size)
+                else:
+                    self.__Hash(digest, bytes)
+            else:
+                if index not in current:
+                    # Finished with the previous chunk
+                    for previous, chunk_digest in current.items():
+                        chunk_digests[previous] = chunk_digest.hexdigest()
+                    current.clear()
+                    if hole:
+                        chunk_digests[index] = self.__ZeroDigest(bytes.size)
+                        return bytes
+                    current[index] = digests.New(self.__digest)
+                self.__Hash(current[index], bytes)
+            return bytes
+
+        # Pieces that can be waiting on the hashing and writing stages, or
+        # on their way between them
+        in_flight = 2 * self.__read_ahead + 4
+        if hasattr(destination, 'write') and not isinstance(destination, (file, io.IOBase)):
+            # No telling whether it can write() a buffer
+            ring = None
+        else:
+            ring = in_flight
+
+        if self.__compressor is not None:
+            # Decompressing as many chunks at once as there are processes
+            window = max(self.__read_ahead, multiprocessing.cpu_count())
+            chunks = self.__compressor.Decompressed(self.__ReadChunks(files_to_merge, ring and ring + window + 1),
+                                                    window)
+        else:
+            chunks = ((index, bytes) for index, codec, bytes in self.__ReadChunks(files_to_merge, ring))
+
+        if self.__read_ahead:
+            # Reading, hashing and writing all overlap. The digest still
+            # sees every byte in order, since each stage is one thread. Each
+            # queue holds up to read_ahead pieces, not whole chunks
+            blocks = pools.Pipeline(chunks, [Hash], self.__read_ahead)
+        else:
+            blocks = (Hash(item) for item in chunks)
+
+        if hasattr(destination, 'write'):
+            # Somebody else's sink. Not ours to close
+            self.__WriteAll(blocks, destination)
+            destination.flush()
+        else:
+            with open(destination, "wb") as sink:
+                self.__WriteAll(blocks, sink, True)
+
+        if digest is not None:
+            return self.__ChecksumMatches(digest.hexdigest())
+        for index, chunk_digest in current.items():
+            chunk_digests[index] = chunk_digest.hexdigest()
+        return self.__ChunkDigestsMatch(chunk_digests)
+
+    def __WriteAll(self, blocks, sink, seekable=False):
+        ''' With seekable, holes get seeked over rather than written, which
+        leaves them as holes in sink too '''
+        skipped = False
+        for bytes in blocks:
+            if isinstance(bytes, _Hole):
+                size = bytes.size
+                with self.__progress.Timing(progress.WRITE):
+                    if seekable:
+                        sink.seek(size, os.SEEK_CUR)
+                        skipped = True
+                    else:
+                        for offset in xrange(0, size, len(_ZEROS)):
+                            sink.write(buffer(_ZEROS, 0, min(len(_ZEROS), size - offset)))
+                self.__progress.Advance(size)
+                continue
+            with self.__progress.Timing(progress.WRITE):
+                sink.write(bytes)
+            self.__progress.Advance(len(bytes))
+        if skipped:
+            # In case it ended on a hole
+            sink.truncate()
+
+    def __PlaceChunk(self, index, file_path, destination_fd, offset, size, expected_digest):
+        ''' Runs on a worker thread. Returns False if the chunk's corrupt '''
+        if index in self.__chunk_codecs:
+            # Has to come through here to get decompressed
+            block = self.__ReadStoredChunk(index, file_path)
+            if len(block) != size:
+                raise IOError("'%s' holds %d bytes. Expected %d" % (file_path, len(block), size))
+            with self.__progress.Timing(progress.WRITE):
+                fastio.WriteAt(destination_fd, offset, block)
+            self.__progress.Advance(size)
+            if expected_digest is None or self.__Digest(block) == expected_digest:
+                return True
+            self.__logger.error("Chunk '%s' is corrupt" % (file_path,))
+            return False
+
+        with open(file_path, "rb") as chunk:
+            with self.__progress.Timing(progress.WRITE):
+                copied = fastio.CopyRange(chunk.fileno(), destination_fd, 0, size, offset)
+            if copied != size:
+                raise IOError("Only copied %d of %d bytes from '%s'" % (copied, size, file_path))
+            self.__progress.Advance(size)
+
+            if expected_digest is None or size == 0:
+                return True
+            mapped = mmap.mmap(chunk.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                actual_digest = self.__Digest(buffer(mapped))
+            finally:
+                mapped.close()
+
+        if actual_digest != expected_digest:
+            self.__logger.error("Chunk '%s' is corrupt" % (file_path,))
+            return False
+        return True
+
+    def __PlacedMerge(self, files_to_merge, source_root_name, digest):
+        ''' Preallocate the destination, then copy every chunk to its final
+        offset, in parallel and in whatever order the workers get to them.
+
+        With per-chunk digests (0.0.3 and later), each worker checks its own
+        chunks. Otherwise the whole-file checksum comes from one more pass
+        over the finished destination. '''
+        # Every chunk's offset has to be known up front
+        sizes = []
+        expected_digests = []
+        for index, file_path in files_to_merge:
+            if index in self.__chunk_details:
+                size, expected_digest = self.__chunk_details[index]
+            else:
+                size = os.path.getsize(file_path)
+                expected_digest = None
+            if expected_digest == 'none':
+                expected_digest = None
+            sizes.append(size)
+            expected_digests.append(expected_digest)
+        total_size = sum(sizes)
+
+        results = []
+        def Place(*args):
+            results.append(self.__PlaceChunk(*args))
+
+        with open(source_root_name, "wb") as destination:
+            # Holes just need the file to be long enough. Only what's between
+            # them gets any space
+            os.ftruncate(destination.fileno(), total_size)
+            offset = 0
+            for hole, run in itertools.groupby(zip(files_to_merge, sizes), lambda entry: entry[0][1] is None):
+                size = sum(size for _, size in run)
+                if not hole:
+                    fastio.Preallocate(destination.fileno(), size, offset)
+                offset += size
+
+            with pools.WorkerPool(self.__workers or multiprocessing.cpu_count()) as placers:
+                offset = 0
+                for (index, file_path), size, expected_digest in zip(files_to_merge, sizes, expected_digests):
+                    if file_path is None:
+                        results.append(expected_digest in (None, self.__ZeroDigest(size)))
+                        self.__progress.Advance(size)
+                    else:
+                        placers.Submit(Place, index, file_path, destination.fileno(), offset, size, expected_digest)
+                    offset += size
+
+        if None not in expected_digests:
+            if all(results) and (digest is not None or self.__DerivedChecksumMatches()):
+                self.__logger.debug("Merge succeeded (every chunk matched its digest)")
+                return True
+            self.__logger.error("Checksums don't match!")
+            return False
+        if digest is None:
+            # 0.0.4 or later, split without any checksums at all
+            return self.__DerivedChecksumMatches()
+
+        if self.__expected_checksum != 'none' and total_size > 0:
+            with open(source_root_name, "rb") as destination:
+                mapped = mmap.mmap(destination.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    self.__Hash(digest, buffer(mapped))
+                finally:
+                    mapped.close()
+        return self.__ChecksumMatches(digest.hexdigest())
 
     def _Merge(self):
-        ''' Restore a splice to a single file '''
+        ''' Restore a splice to a single file. Returns whether it worked '''
 
         # FIXME: Break this into multiple methods. Maybe even its own class
 
@@ -257,42 +1258,32 @@ class Splicer:
         # Though I just realized that I've committed a fairly major sin by breaking
         # the interface between 0.0.1 and 0.0.2. Oh, well. It isn't like anyone but
         # me has ever seen this code yet
-        if self.__version == '0.0.1' or self.__version == '0.0.2':
-            self.__logger.debug("Have a version '" + version + "' splice that I can handle")
+        if self.__version in ('0.0.1', '0.0.2', '0.0.3', '0.0.4', '0.0.5'):
+            self.__logger.debug("Have a version '" + self.__version + "' splice that I can handle")
 
-            source_root_name = self.__PickSourceRootName()
+            destination = self.__merge_destination
+            if destination is None:
+                destination = self.__PickSourceRootName()
 
-            if self.Validate():
-                self.__logger.debug("Merging " + str(chunk_count) + " chunks into '" + source_root_name + "'")
+            if self.__Compressed():
+                self.__OpenCompressor(compression.RAW)
+
+            files_to_merge = self.__MergeFiles()
+            if len(self.__chunk_details) == self.__chunk_count:
+                self.__progress.Total(sum(size for size, _ in self.__chunk_details.values()))
+            if len(files_to_merge) == self.__chunk_count:
+                self.__logger.debug("Merging " + str(self.__chunk_count) + " chunks into '" + str(destination) + "'")
                 # OK, we can at least try to merge the pieces
-                files_to_merge.sort() # Seems reasonable to require them to be in alphabetical order
-
-                # FIXME: Allow the user to specify a destination file? What about
-                # piping to STDOUT?
-
-                with open(source_root_name, "wb") as destination:
-                    for file_name in files_to_merge:
-                        file_path = os.path.join(self.__working_directory, file_name)
-                        #self.__logger.info("# " + file_path)
-
-                        # Note the major distinction here between source and self.__source.
-                        # Much ugliness has entered this code!
-                        with open(file_path, "rb") as source:
-                            while True:
-                                bytes = source.read()
-                                if not bytes:
-                                    break
-                                digest.update(bytes)
-                                destination.write(bytes)
-                actual_checksum = digest.hexdigest()
-
-                if actual_checksum != expected_checksum:
-                    # Should probably go ahead and throw an exception here
-                    self.__logger.error("Checksums don't match!")
-                else:
-                    self.__logger.debug("Merge succeeded (checksum: '" + actual_checksum + "')") 
+
+                if self.__preallocate:
+                    if not hasattr(destination, 'write'):
+                        return self.__PlacedMerge(files_to_merge, destination, digest)
+                    self.__logger.warn("Can only preallocate a merge into a named file. Streaming it instead")
+                return self.__StreamedMerge(files_to_merge, destination, digest)
             else:
-                self.__logger.error("Wrong chunk count. Expected %d. Have %d" % (chunk_count, count))
+                self.__logger.error("Wrong chunk count. Expected %d. Have %d" % (self.__chunk_count,
+                                                                                len(files_to_merge)))
+        return False
 
     #################################################################
     # Splitting
@@ -336,75 +1327,93 @@ class Splicer:
             self.__logger.error("Destination directory already exists")
             raise
         
-    def __PickChunkDigits(self, memo=[]):
+    def __PickChunkDigits(self):
         ''' How many digits do we need to account for all the chunks? '''
         # Since there really isn't anything we can do with this that isn't
         # obnoxious
         if self.__source == sys.stdin:
             return 1
 
-        # Note that memoizing this makes re-using a splicer much more problematic
-        if not memo:
-            # Horrible way to do this
-            chunk_count = self.__source_size / self.__buffer_size
-            if self.__source_size % self.__buffer_size != 0:
-                # Account for the final fragmentary chunk
-                chunk_count += 1
-
-            result = 0
-
-            if chunk_count < 10:
-                result = 1
-            elif chunk_count < 100:
-                result = 2
-            elif chunk_count < 1000:
-                result = 3
-            elif chunk_count < 10000:
-                result = 4
-            elif chunk_count < 100000:
-                result = 5
-            else:
-                self.__logger.debug( "Source Size: %d BufferSize: %d Chunk Count: %d" % 
-                                   (self.__source_size,
-                                    self.__buffer_size, chunk_count,))
-
-                # Getting more than 10000 files in a single directory used
-                # to be a horribly bad idea in windows. No idea whether that's
-                # still true, but it still seems like a bad idea
-                assert False, "Adjust buffer size"
-
-            memo.append(result)
-
-        return memo[0]
-
-    def __FileNameFormatString(self):
-        "What format string should be used for building the destintion file names?"
-        chunk_count = self.__PickChunkDigits()
-        return '%s.%0' + str(chunk_count) + 'd.chunk'
-
-    def __PickDestinationFileName(self, destination_directory, count):
-        # I really don't want to do this every time. But it isn't like
-        # this sucker's CPU-bound
-        base_name = self.__PickBaseName()
-
-        # How many digits do we need to accomodate?
-        format_string = self.__FileNameFormatString()
-    
-        # FIXME: Be smarter than this.  Could very well have more than 1000
-        # chunks.  Not that hard to figure out. file size / chunk size.
-        # But get this working first
-        destination_name = format_string % (base_name, count)
+        # Horrible way to do this
+        chunk_count = self.__source_size / self.__buffer_size
+        if self.__source_size % self.__buffer_size != 0:
+            # Account for the final fragmentary chunk
+            chunk_count += 1
+
+        # No limit for 0.0.5: the nested layout keeps the directories small
+        width = len(str(chunk_count))
+        if self.__version in _FLAT_VERSIONS and width > _FLAT_DIGITS:
+            raise myexceptions.VersionError("Version %s splits keep every chunk in one directory, so %d chunks "
+                                            "is too many. Use bigger chunks, or version 0.0.5" %
+                                            (self.__version, chunk_count))
+        return width
+
+    def __ChunkPath(self, destination_directory, base_name, count, width):
+        ''' Where chunk number count lives.
+
+        Indices get padded to width digits. A width of None is for streamed
+        splits, where there's no telling how many chunks there will be: each
+        index gets prefixed with a letter for how many digits it has ('a' for
+        1, 'b' for 2...) instead, so alphabetical order is still chunk order:
+        a0 ... a9, b10 ... b99, c100 ...
+
+        The last _FANOUT_DIGITS digits pick the file. Any digits in front of
+        those pick nested directories, _FANOUT_DIGITS digits per level, so a
+        split with a few million chunks looks like 1/234/name.1234567.chunk
+        and one with under 1000 doesn't have any subdirectories at all.
+        Versions before 0.0.5 don't nest at all. '''
+        digits = str(count)
+        if width is None:
+            index = chr(ord('a') + len(digits) - 1) + digits
+        else:
+            digits = digits.zfill(width)
+            index = digits
+
+        levels = []
+        prefix = digits[:-_FANOUT_DIGITS]
+        if self.__version in _FLAT_VERSIONS:
+            prefix = ''
+        while prefix:
+            levels.insert(0, prefix[-_FANOUT_DIGITS:])
+            prefix = prefix[:-_FANOUT_DIGITS]
+        if levels and width is None:
+            # Keep each length of index to itself
+            levels.insert(0, index[0])
+
+        name = '%s.%s.chunk' % (base_name, index)
+        return os.path.join(destination_directory, *(levels + [name]))
+
+    def __PickDestinationFileName(self, destination_directory, count, width):
+        ''' The chunk's path, creating its directory if need be '''
+        destination_path = self.__ChunkPath(destination_directory, self.__PickBaseName(), count, width)
+        parent = os.path.dirname(destination_path)
+        if parent != self.__chunk_directory:
+            # First chunk in this directory (that this run's seen, anyway)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            self.__chunk_directory = parent
+        return destination_path
 
-        # Finally build the actual file name string
-        destination_path = os.path.join(destination_directory, destination_name)
+    def __Layout(self, width):
+        ''' The .details headers that tell a merge where to find everything.
+        Nothing for versions before 0.0.5, whose chunks are all right there '''
+        if self.__version in _FLAT_VERSIONS:
+            return []
+        return [('Layout', 'nested %s' % (width is None and 'streamed' or width,))]
 
-        return destination_path
+    def __SaveDetails(self, count, digest, destination_directory, extra=()):
+        ''' How do we fit the chunks back together again?
 
-    def __SaveDetails(self, count, digest, destination_directory):
-        ''' How do we fit the chunks back together again? '''
+        extra is any more (key, value) headers this kind of split needs '''
 
         # Not that this is particularly meaningful without all the chunks
-        checksum = digest.hexdigest()
+        if digest is not None:
+            checksum = digest.hexdigest()
+        elif self.__version in ('0.0.4', '0.0.5'):
+            # Comes out 'none' if the chunks didn't get hashed
+            checksum = self.__DerivedChecksum(self.__chunk_details)
+        else:
+            checksum = 'none'
 
         base_name = self.__PickBaseName()
         destination_name = base_name + '.details'
@@ -414,6 +1423,27 @@ class Splicer:
             destination.write('Chunk Count: ' + str(count) + '\n')
             destination.write('Checksum: ' + checksum + '\n')
             destination.write('BlockSize: ' + str(self.__buffer_size) + '\n')
+            if self.__digest != digests.DEFAULT and self.__version not in ('0.0.1', '0.0.2'):
+                destination.write('Digest: ' + self.__digest + '\n')
+            for key, value in extra:
+                destination.write('%s: %s\n' % (key, value))
+            if self.__chunk_codecs:
+                destination.write('Compression: ' + (self.__compression or compression.RAW) + '\n')
+            if self.__version != '0.0.2':
+                for index in sorted(self.__chunk_details):
+                    size, chunk_digest = self.__chunk_details[index]
+                    if index in self.__chunk_codecs:
+                        destination.write('Chunk: %d %d %s %s %d\n' % ((index, size, chunk_digest) +
+                                                                      self.__chunk_codecs[index]))
+                    elif index in self.__holes:
+                        destination.write('Chunk: %d %d %s %s\n' % (index, size, chunk_digest, HOLE))
+                    else:
+                        destination.write('Chunk: %d %d %s\n' % (index, size, chunk_digest))
+
+            # The .details is what says the split's done. Make sure it is
+            destination.flush()
+            with self.__progress.Timing(progress.FSYNC):
+                os.fsync(destination.fileno())
 
     def __TryToReadDifficultBlock(self, source, index):
         raise NotImplementedError("What should this do?")
@@ -433,8 +1463,312 @@ class Splicer:
             # Is there anything that needs to happen here?
             pass
 
-    def __ReadBlock(self, source, readSize):
-        return source.read(readSize)
+    def __ReadBlock(self, source, readSize, offset):
+        ''' Read up to readSize bytes, the I/O size at a time. Anything short
+        means EOF '''
+        pieces = []
+        done = 0
+        while done < readSize:
+            piece = self.__Read(source, min(self.__read_size, readSize - done), offset + done)
+            if not piece:
+                break
+            pieces.append(piece)
+            done += len(piece)
+        if len(pieces) == 1:
+            return pieces[0]
+        return ''.join(pieces)
+
+    def __Read(self, source, size, offset):
+        if self.__latency is None:
+            with self.__progress.Timing(progress.READ):
+                piece = source.read(size)
+        else:
+            started = time.time()
+            try:
+                with self.__progress.Timing(progress.READ):
+                    piece = source.read(size)
+            except IOError:
+                self.__latency.Record(offset, size, time.time() - started, True)
+                raise
+            self.__latency.Record(offset, size, time.time() - started)
+        self.__progress.Advance(len(piece))
+        return piece
+
+    def __ReadInto(self, source, view, offset):
+        ''' __Read, into view instead of a new string. Returns how much it read '''
+        if not hasattr(source, 'readinto'):
+            piece = self.__Read(source, len(view), offset)
+            view[:len(piece)] = piece
+            return len(piece)
+
+        started = time.time()
+        try:
+            with self.__progress.Timing(progress.READ):
+                count = source.readinto(view)
+        except IOError:
+            if self.__latency is not None:
+                self.__latency.Record(offset, len(view), time.time() - started, True)
+            raise
+        if self.__latency is not None:
+            self.__latency.Record(offset, len(view), time.time() - started)
+        self.__progress.Advance(count)
+        return count
+
+    def __ChunkBuffer(self):
+        ''' The one buffer every streamed chunk goes through, a read at a time '''
+        if self.__chunk_buffer is None or len(self.__chunk_buffer) != self.__read_size:
+            self.__chunk_buffer = bytearray(self.__read_size)
+        return memoryview(self.__chunk_buffer)
+
+    def __Streaming(self):
+        ''' Should the split copy each chunk a read at a time, rather than
+        reading the whole thing into memory first?
+
+        Only matters when a chunk takes more than one read. Compressing needs
+        the whole chunk at once '''
+        return self.__compressor is None and self.__buffer_size > self.__read_size
+
+    def __StreamChunk(self, source, destination_path, offset, digest):
+        ''' Copy up to a chunk from source to destination_path, through
+        __ChunkBuffer, feeding digest (if there is one) along the way.
+
+        The chunk goes into a .partial file that only gets its real name once
+        it's all there, and nothing gets created at all if source is already
+        at EOF. When the split's sparse, nothing gets created for a chunk
+        that's all zeros either. Returns (size, hex digest of the chunk,
+        whether it's a hole) '''
+        view = self.__ChunkBuffer()
+        chunk_digest = self.__hashing and digests.New(self.__digest) or None
+        temporary = destination_path + '.partial'
+        destination = None
+        # Zeros at the start of the chunk that haven't been written or hashed
+        # yet, in case it turns out to be a hole
+        zeros = 0
+        size = 0
+        try:
+            while size < self.__buffer_size:
+                count = self.__ReadInto(source, view[:min(len(view), self.__buffer_size - size)], offset + size)
+                if not count:
+                    break
+                # A buffer rather than a memoryview: zlib's checksums won't take those
+                piece = buffer(self.__chunk_buffer, 0, count)
+                size += count
+                if destination is None and self.__making_holes and self.__IsZero(piece):
+                    zeros += count
+                    continue
+                if destination is None:
+                    destination = open(temporary, "wb")
+                    if zeros:
+                        # Not a hole after all. The zeros stay a hole in the chunk file
+                        destination.seek(zeros)
+                        for partial in (chunk_digest, digest):
+                            if partial is not None:
+                                self.__HashZeros(partial, zeros)
+                with self.__progress.Timing(progress.WRITE):
+                    destination.write(piece)
+                if chunk_digest is not None:
+                    self.__Hash(chunk_digest, piece)
+                if digest is not None:
+                    self.__Hash(digest, piece)
+        except:
+            if destination is not None:
+                destination.close()
+                os.remove(temporary)
+            raise
+        if destination is None:
+            if zeros and digest is not None:
+                self.__HashZeros(digest, zeros)
+            return size, None, size > 0
+        destination.close()
+        os.rename(temporary, destination_path)
+        return size, chunk_digest is not None and chunk_digest.hexdigest() or 'none', False
+
+    def __HashStreamed(self, source, digest):
+        ''' Read a chunk that's already been written back through
+        __ChunkBuffer. Returns (size, hex digest of the chunk) '''
+        view = self.__ChunkBuffer()
+        chunk_digest = self.__hashing and digests.New(self.__digest) or None
+        size = 0
+        while size < self.__buffer_size:
+            with self.__progress.Timing(progress.READ):
+                count = source.readinto(view[:min(len(view), self.__buffer_size - size)])
+            if not count:
+                break
+            piece = buffer(self.__chunk_buffer, 0, count)
+            if chunk_digest is not None:
+                self.__Hash(chunk_digest, piece)
+            if digest is not None:
+                self.__Hash(digest, piece)
+            size += count
+        return size, chunk_digest is not None and chunk_digest.hexdigest() or 'none'
+
+    def __SaveLatencyReport(self):
+        ''' Next to the .details, as <base>.latency '''
+        recorder, self.__latency = self.__latency, None
+        if recorder is None or not recorder.Reads():
+            return
+        destination_directory = self.DestinationDirectory()
+        if not os.path.isdir(destination_directory):
+            return
+        path = os.path.join(destination_directory, self.__PickBaseName() + '.latency')
+        recorder.Save(path)
+
+        regions = recorder.SlowRegions()
+        self.__logger.info("Read latency: |%s|" % (recorder.HeatMapText(),))
+        if regions:
+            self.__logger.warn("%d slow regions (%d bytes in all). See '%s'" %
+                               (len(regions), sum(size for _, size, _ in regions), path))
+
+    def __Hash(self, digest, block):
+        with self.__progress.Timing(progress.HASH):
+            digest.update(block)
+
+    def __Digest(self, block):
+        ''' The hex digest of one chunk '''
+        with self.__progress.Timing(progress.HASH):
+            return digests.New(self.__digest, block).hexdigest()
+
+    def __HashZeros(self, digest, size):
+        for offset in xrange(0, size, len(_ZEROS)):
+            self.__Hash(digest, buffer(_ZEROS, 0, min(len(_ZEROS), size - offset)))
+
+    def __ZeroDigest(self, size):
+        ''' The hex digest of a chunk of size zeros. Only ever worked out once
+        per size, which usually means once '''
+        if size not in self.__zero_digests:
+            digest = digests.New(self.__digest)
+            self.__HashZeros(digest, size)
+            self.__zero_digests[size] = digest.hexdigest()
+        return self.__zero_digests[size]
+
+    def __IsZero(self, block):
+        ''' Is block (a string or a buffer) nothing but zeros? '''
+        for offset in xrange(0, len(block), len(_ZEROS)):
+            if not _ZEROS.startswith(buffer(block, offset, len(_ZEROS))):
+                return False
+        return True
+
+    def __CheckSparse(self):
+        ''' Can the split that's about to run leave holes? Says why not if it can't '''
+        if not self.__sparse:
+            return False
+        if self.__version in ('0.0.1', '0.0.2'):
+            self.__logger.warn("Version %s splices can't record holes. Writing every chunk" % (self.__version,))
+            return False
+        if self.__repairing:
+            # Unreadable areas read back as zeros too
+            self.__logger.warn("Rescues can't tell zeros from unreadable areas. Writing every chunk")
+            return False
+        if self.__ContentDefinedSizes() is not None:
+            self.__logger.warn("A chunk store only keeps one copy of a zero chunk anyway. Not making holes")
+            return False
+        return True
+
+    def __RecordHole(self, index, size):
+        ''' Remember an all-zero chunk that a sparse split didn't write '''
+        self.__holes.add(index)
+        self.__RecordChunkDetails(index, size, self.__hashing and self.__ZeroDigest(size) or 'none')
+
+    def __RecordChunk(self, index, block):
+        ''' Remember what a chunk looked like for the .details.
+
+        Only call this once the chunk's been written: it goes into the journal '''
+        if self.__hashing:
+            chunk_digest = self.__Digest(block)
+        else:
+            chunk_digest = 'none'
+        self.__RecordChunkDetails(index, len(block), chunk_digest)
+
+    def __RecordChunkDetails(self, index, size, chunk_digest):
+        self.__chunk_details[index] = (size, chunk_digest)
+        if self.__journal is not None:
+            if self.__digest != digests.DEFAULT and chunk_digest != 'none':
+                # So a restart with a different digest knows not to trust it
+                chunk_digest = self.__digest + ':' + chunk_digest
+            extra = index in self.__holes and (HOLE,) or self.__chunk_codecs.get(index, ())
+            self.__journal.Record(index, size, chunk_digest, *extra)
+
+    def __JournaledHole(self, entries, index, destination_path, digest):
+        ''' Is the chunk a hole a previous run already finished? '''
+        return (index in entries and entries[index][2:] == (HOLE,) and
+                self.__Journaled(entries, index, destination_path, digest))
+
+    def __JournaledDigest(self, entry):
+        ''' (which digest, hex digest) out of a journal entry '''
+        name, separator, chunk_digest = entry[1].rpartition(':')
+        return name or digests.DEFAULT, chunk_digest
+
+    def __RestoreJournaled(self, index, entry):
+        ''' Pick up a chunk a previous run finished. Returns its size '''
+        size = entry[0]
+        chunk_digest = self.__JournaledDigest(entry)[1]
+        self.__chunk_details[index] = (size, chunk_digest)
+        if entry[2:] == (HOLE,):
+            self.__holes.add(index)
+        elif len(entry) > 3:
+            self.__chunk_codecs[index] = (entry[2], int(entry[3]))
+        return size
+
+    def __SplitDigest(self):
+        ''' The whole-file digest for the version being written, if it has one '''
+        if not self.__hashing:
+            return None
+        return self.__PickDigest(self.__version)
+
+    def __OpenJournal(self, destination_directory):
+        ''' Returns what a previous attempt at this split already finished '''
+        path = os.path.join(destination_directory, self.__PickBaseName() + '.journal')
+        self.__journal = journal.Journal(path)
+        return self.__journal.Load()
+
+    def __CloseJournal(self):
+        if self.__journal is not None:
+            self.__journal.Close()
+            self.__journal = None
+
+    def __Journaled(self, entries, index, destination_path, digest):
+        ''' Can we trust an existing chunk without reading it again? '''
+        if digest is not None:
+            # The whole-file digest needs every byte anyway
+            return False
+        if index not in entries:
+            return False
+        size = entries[index][0]
+        name, chunk_digest = self.__JournaledDigest(entries[index])
+        if self.__hashing and (chunk_digest == 'none' or name != self.__digest):
+            return False
+        if entries[index][2:] == (HOLE,):
+            # There's no file to check. Only good for another sparse split
+            return self.__making_holes
+        if len(entries[index]) > 3:
+            # Compressed. What's on disk is smaller
+            size = int(entries[index][3])
+        # Cheap sanity check for chunks that got truncated after the fact
+        return os.path.getsize(destination_path) == size
+
+    def __WriteChunk(self, destination_path, index, block):
+        ''' Runs on a worker thread when there are any '''
+        stored = block
+        if self.__compressor is not None:
+            with self.__progress.Timing(progress.COMPRESS):
+                codec, stored = self.__compressor.Compress(block)
+            self.__chunk_codecs[index] = (codec, len(stored))
+        with self.__progress.Timing(progress.WRITE):
+            with open(destination_path, "wb") as destination:
+                destination.write(stored)
+        self.__RecordChunk(index, block)
+
+    def __StartCompressing(self):
+        ''' Returns how many threads should be writing chunks '''
+        self.__chunk_codecs = {}
+        if self.__compression is None:
+            return self.__workers
+
+        if self.__version not in ('0.0.3', '0.0.4', '0.0.5'):
+            raise myexceptions.VersionError("Compressed splits need per-chunk details (0.0.3 or later)")
+        self.__OpenCompressor(self.__compression)
+        # Each writer waits on one compressing process at a time
+        return self.__workers or multiprocessing.cpu_count()
 
     def __PossiblyThrowRandomErrorIfDebugging(self):
         if _DEBUG:
@@ -444,57 +1778,375 @@ class Splicer:
             if percentage < 15:
                 raise IOError("Random test simulating read failure")
 
-    def __RecursiveRepairBlock(self, source, initial_offset, chunkSize, chunkCount):
-        result = []
-        source.seek(initial_offset)
+    def __Tune(self):
+        ''' Work out the chunk size and the I/O size, unless they're set already.
+
+        The I/O size gets measured (see tuning.ProbeIOSize), except in a
+        rescue, which just goes by what the device prefers. The chunk size
+        comes from the target chunk count and the cap, rounded to the
+        device's preferred size rather than the measured one, so that a
+        restarted split always picks the same chunk size as the first go. '''
+        auto = self.__auto_tune or self.__buffer_size is None
+        preferred = tuning.PreferredIOSize(self.__source)
+        if self.__io_size is not None:
+            self.__read_size = self.__io_size
+        elif not auto:
+            # One read per chunk, the way it's always been. Within reason
+            self.__read_size = min(self.__buffer_size, tuning.LARGEST_IO)
+        elif self.__streaming or self.__repairing:
+            # Probing would read all over a failing source, with nothing
+            # keeping track of what broke
+            self.__read_size = preferred
+        else:
+            self.__read_size = tuning.ProbeIOSize(self.__source, self.__source_size, preferred)
+
+        if self.__buffer_size is None:
+            size = None
+            if not self.__streaming:
+                size = self.__source_size
+            self.__buffer_size = tuning.PickChunkSize(size, preferred, self.__target_chunk_count,
+                                                      self.__maximum_chunk_size)
+            self.__logger.info("Chunks of %d bytes" % (self.__buffer_size,))
+        self.__read_size = max(1, min(self.__read_size, self.__buffer_size))
+        self.__logger.debug("Reading %d bytes at a time" % (self.__read_size,))
+
+    def __DirectSource(self):
+        ''' What the split should read from. A fastio.DirectFile, if it can '''
+        if not self.__direct_io:
+            return self.__source
+        if self.__streaming:
+            self.__logger.warn("Direct I/O needs a source that can seek. Reading it normally")
+            return self.__source
+        if self.__zero_copy and not self.__repairing:
+            self.__logger.warn("Zero-copy never reads the source itself. Not using direct I/O")
+            return self.__source
+
+        try:
+            direct = fastio.DirectFile(self.__source, self.__read_size)
+        except (AttributeError, IOError, OSError), e:
+            # Plenty of filesystems (tmpfs, for one) refuse O_DIRECT
+            self.__logger.warn("No direct I/O on '%s' (%s). Reading it normally" % (self.__source_file_name, e))
+            return self.__source
+        direct.seek(self.__source.tell())
+        return direct
+
+    def __ZeroCopySource(self):
+        ''' The source's file descriptor, if the kernel can copy straight out of it '''
+        if self.__repairing:
+            self.__logger.warn("Repairs need to see every byte. Not using zero-copy")
+            return None
+        if self.__compression is not None:
+            self.__logger.warn("Compressing means seeing every byte. Not using zero-copy")
+            return None
 
-        i = 0
-        while i < chunkCount:
-            try:
-                self.__PossiblyThrowRandomErrorIfDebugging()
-                buffer = self.__ReadBlock(source, chunkSize)
-                result += buffer
-            except IOError:
-                # Recurse in a smaller chunks
-                if chunkSize == 1:
-                    # Just give up. Though there are probably better defaults to 
-                    # depict flawed sectors
-                    self.__logger.error("Byte %d within the source file is not readable")
-                    result.append(0)
+        try:
+            source_fd = self.__source.fileno()
+        except (AttributeError, IOError, ValueError):
+            # Including io.UnsupportedOperation, for in-memory sources
+            source_fd = None
+
+        if source_fd is None or not stat.S_ISREG(os.fstat(source_fd).st_mode):
+            self.__logger.warn("Zero-copy needs a regular file. Splitting the slow way")
+            return None
+
+        return source_fd
+
+    def __CopyChunk(self, source_fd, destination_path, index, offset, size, mapped, copy):
+        ''' Runs on a worker thread when there are any '''
+        if self.__making_holes and self.__IsZero(buffer(mapped, offset, size)):
+            self.__RecordHole(index, size)
+            return
+
+        if copy:
+            with self.__progress.Timing(progress.WRITE):
+                with open(destination_path, "wb") as destination:
+                    copied = fastio.CopyRange(source_fd, destination.fileno(), offset, size)
+            if copied != size:
+                raise IOError("Only copied %d of %d bytes into '%s'" % (copied, size, destination_path))
+
+        if mapped is not None:
+            # buffer() instead of slicing, so this doesn't copy either
+            self.__RecordChunk(index, buffer(mapped, offset, size))
+        else:
+            self.__RecordChunkDetails(index, size, 'none')
+
+    def __ZeroCopySplitter(self, source_fd):
+        ''' Split a regular file without pulling the chunks through python.
+
+        The checksums come from a separate pass over a read-only mmap of the
+        source, which overlaps with the copies when there are workers. '''
+        destination_directory = self.DestinationDirectory()
+        if not os.path.exists(destination_directory):
+            self.__CreateDirectory(destination_directory)
+        else:
+            # Chunks that are already the right size get left alone
+            self.__logger.warn("Using existing directory, in an attempt to restart")
+
+        count = 0
+        digest = self.__SplitDigest()
+        mapped = None
+        if (self.__hashing or self.__making_holes) and self.__source_size > 0:
+            # (Can't mmap an empty file)
+            mapped = mmap.mmap(source_fd, 0, access=mmap.ACCESS_READ)
+        self.__chunk_details = {}
+        self.__chunk_codecs = {}
+        journaled = self.__OpenJournal(destination_directory)
+
+        width = self.__PickChunkDigits()
+        copiers = pools.WorkerPool(self.__workers)
+        try:
+            offset = 0
+            while offset < self.__source_size:
+                size = min(self.__buffer_size, self.__source_size - offset)
+                destination_path = self.__PickDestinationFileName(destination_directory, count, width)
+
+                exists = os.path.exists(destination_path)
+                if ((exists or self.__JournaledHole(journaled, count, destination_path, digest)) and
+                    self.__Journaled(journaled, count, destination_path, digest)):
+                    # Already finished. Don't touch it
+                    self.__RestoreJournaled(count, journaled[count])
                 else:
-                    divisor = 0
+                    copy = not (exists and os.path.getsize(destination_path) == size)
+                    # The per-chunk digests can go in parallel, right along with the copies
+                    copiers.Submit(self.__CopyChunk, source_fd, destination_path,
+                                   count, offset, size, mapped, copy)
+
+                if digest is not None:
+                    self.__Hash(digest, buffer(mapped, offset, size))
+
+                self.__progress.Advance(size)
+                offset += size
+                count += 1
+                if (count % 1024) == 0:
+                    self.__ui.UpdateProgress()
+        finally:
+            try:
+                copiers.Close()
+            finally:
+                self.__CloseJournal()
+                if mapped is not None:
+                    mapped.close()
+                self.__SaveDetails(count, digest, destination_directory, self.__Layout(width))
+
+    def __StreamingSplitter(self):
+        ''' Split something that can't seek and doesn't know how big it is, like a pipe.
+
+        Memory use stays at a few blocks however long the stream runs, and the
+        .details gets written once EOF finally shows up. '''
+        if self.__repairing:
+            self.__logger.warn("Can't go back over a stream to repair it. Splitting it straight through")
+        destination_directory = self.DestinationDirectory()
+        # There's no seeking past what a previous run wrote, so no restarting either
+        self.__CreateDirectory(destination_directory)
 
-                    if chunkSize > 10:
-                        divisor = 10
+        count = 0
+        digest = self.__SplitDigest()
+        self.__chunk_details = {}
+
+        writers = pools.WorkerPool(self.__StartCompressing())
+        streaming = self.__Streaming()
+        try:
+            while True:
+                destination_path = self.__PickDestinationFileName(destination_directory, count, None)
+                if streaming:
+                    bytes, chunk_digest, hole = self.__StreamChunk(self.__source, destination_path,
+                                                                   count * self.__buffer_size, digest)
+                    if not bytes:
+                        break
+                    if hole:
+                        self.__RecordHole(count, bytes)
                     else:
-                        divisor = 2
-
-                    # Get the first x sub-chunks:
-                    sub_chunk_size = chunkSize / divisor
-                    offset = initial_offset + chunkSize * i
-                    result += self.__RecursiveRepairBlock(source, offset, sub_chunk_size, 2)
-
-                    remainder = chunkSize % divisor
-                    if remainder != 0:
-                        # and the last sub-chunk:
-                        final_offset = offset + (sub_chunk_size*divisor)
-                        result += self.__RecursiveRepairBlock(source, final_offset, remainder, 1)
-                        
-            i += 1
-
-        return result
-    
-    # Honestly, this deserves its own class
-    def __RepairBlock(self, source, count):
-        ''' Entry point for repairing one single block. Returns the block as best it can be repaired '''
-        # Can't start out this way. Don't actually know where we are in the file
-        #offset = source.tell()
-        initial_offset = self.__buffer_size * count
-        result = self.__RecursiveRepairBlock(source, initial_offset, self.__buffer_size/10, 10)
+                        self.__RecordChunkDetails(count, bytes, chunk_digest)
+                else:
+                    block = self.__ReadBlock(self.__source, self.__buffer_size, count * self.__buffer_size)
+                    if not block:
+                        break
+                    if digest is not None:
+                        self.__Hash(digest, block)
+                    if self.__making_holes and self.__IsZero(block):
+                        self.__RecordHole(count, len(block))
+                    else:
+                        writers.Submit(self.__WriteChunk, destination_path, count, block)
+
+                count += 1
+                if (count % 1024) == 0:
+                    self.__ui.UpdateProgress()
+        finally:
+            try:
+                writers.Close()
+            finally:
+                self.__SaveDetails(count, digest, destination_directory, self.__Layout(None))
+
+    def __ContentDefinedSizes(self):
+        ''' (minimum, average, maximum), or None for plain fixed-size chunks '''
+        if self.__content_defined is not None:
+            return self.__content_defined
+        if self.__store_path is not None:
+            # Aim for chunks about the size of the buffer
+            average = self.__buffer_size
+            return (max(1, average / 4), average, average * 4)
+        return None
+
+    def __StoreChunk(self, store, index, block, written):
+        ''' Runs on a worker thread when there are any '''
+        chunk_digest = self.__Digest(block)
+        with self.__progress.Timing(progress.WRITE):
+            stored = store.Put(chunk_digest, block)
+        if stored:
+            written.append(index)
+        self.__RecordChunkDetails(index, len(block), chunk_digest)
+
+    def __ContentDefinedSplitter(self):
+        ''' Cut wherever the content says to, and only write the chunks the
+        store doesn't already have.
+
+        An insert or delete near the start of the source only changes the
+        chunks right around it, so the next snapshot of the same image
+        mostly turns up chunks that are already stored. That also makes
+        restarting a failed split cheap. '''
+        if self.__version not in ('0.0.3', '0.0.4', '0.0.5'):
+            raise myexceptions.VersionError("Content-defined splits need per-chunk digests (0.0.3 or later)")
+        if not self.__hashing:
+            self.__logger.warn("Stored chunks are named by their digests. Hashing anyway")
+        if not digests.IsCryptographic(self.__digest):
+            # Two different chunks with the same name would be one too many
+            self.__logger.warn("Stored chunks are named by their digests. Using %s instead of %s" %
+                               (digests.DEFAULT, self.__digest))
+            self.__digest = digests.DEFAULT
+        if self.__compression is not None:
+            self.__logger.warn("Chunk stores hold raw chunks. Not compressing")
+        self.__chunk_codecs = {}
+
+        destination_directory = self.DestinationDirectory()
+        if not os.path.exists(destination_directory):
+            self.__CreateDirectory(destination_directory)
+        else:
+            self.__logger.warn("Using existing directory. The store keeps whatever got written last time")
+
+        store_path = self.__store_path
+        if store_path is None:
+            store_path = os.path.join(destination_directory, 'store')
+        store = chunkstore.ChunkStore(store_path)
+        sizes = self.__ContentDefinedSizes()
+
+        count = 0
+        digest = self.__PickDigest(self.__version)
+        self.__chunk_details = {}
+        written = []
 
-        source.seek(initial_offset + self.__buffer_size)
+        writers = pools.WorkerPool(self.__workers)
+        try:
+            for block in chunkstore.ContentDefinedChunks(self.__source, *sizes):
+                self.__progress.Advance(len(block))
+                if digest is not None:
+                    self.__Hash(digest, block)
+                writers.Submit(self.__StoreChunk, store, count, block, written)
+
+                count += 1
+                if (count % 1024) == 0:
+                    self.__ui.UpdateProgress()
+        finally:
+            try:
+                writers.Close()
+            finally:
+                # The .details can move along with the store, as long as
+                # they stay put relative to each other
+                extra = [('Store', os.path.relpath(store_path, destination_directory)),
+                         ('Chunking', '%d %d %d' % sizes)]
+                self.__SaveDetails(count, digest, destination_directory, extra)
+
+        self.__logger.info("%d of %d chunks were new to the store" % (len(written), count))
+
+    def __RescueSink(self, paths, touched):
+        ''' Where the rescue puts what it reads: straight into the chunk files '''
+        def Sink(offset, data):
+            written = 0
+            while written < len(data):
+                index, within = divmod(offset + written, self.__buffer_size)
+                piece = min(len(data) - written, self.__buffer_size - within)
+                with self.__progress.Timing(progress.WRITE):
+                    with open(paths[index], "r+b") as chunk:
+                        chunk.seek(within)
+                        chunk.write(data[written:written + piece])
+                touched.add(index)
+                written += piece
+            self.__progress.Advance(len(data))
+        return Sink
+
+    def __RescueSplitter(self):
+        ''' Split a failing source, getting everything off it that can be gotten.
+
+        See rescue.Rescuer for how. The map of what's been read and what
+        hasn't lives in the split directory, so running this again only goes
+        after what's still unreadable, and nobody gets asked about each bad
+        block. Whatever never does get read stays zeros in the chunks, and
+        the .details says how much of that there is.
+
+        Returns whether everything got read. '''
+        destination_directory = self.DestinationDirectory()
+        if not os.path.exists(destination_directory):
+            self.__CreateDirectory(destination_directory)
+        if self.__compression is not None:
+            self.__logger.warn("Repairs write chunks in place. Not compressing")
+        if self.__ContentDefinedSizes() is not None:
+            self.__logger.warn("Repairs need fixed-size chunks. Not cutting on content")
+        self.__chunk_codecs = {}
+
+        # Every chunk file exists, full size, from the start
+        width = self.__PickChunkDigits()
+        count = (self.__source_size + self.__buffer_size - 1) / self.__buffer_size
+        paths = []
+        for index in xrange(count):
+            destination_path = self.__PickDestinationFileName(destination_directory, index, width)
+            size = min(self.__buffer_size, self.__source_size - index * self.__buffer_size)
+            if not os.path.exists(destination_path) or os.path.getsize(destination_path) != size:
+                with open(destination_path, "ab") as chunk:
+                    chunk.truncate(size)
+            paths.append(destination_path)
+
+        map_path = os.path.join(destination_directory, self.__PickBaseName() + '.rescue')
+        rescue_map = rescue.RescueMap(map_path, self.__source_size)
+        if rescue_map.Load():
+            self.__logger.info("Resuming the rescue in '%s'" % (map_path,))
+
+        # Direct reads only work in whole sectors anyway
+        sector_size = 512
+        if isinstance(self.__source, fastio.DirectFile):
+            sector_size = self.__source.SectorSize()
+
+        touched = set()
+        rescuer = rescue.Rescuer(self.__source, rescue_map, self.__RescueSink(paths, touched),
+                                 block_size=min(self.__read_size, 1024 * 1024),
+                                 sector_size=sector_size, retries=self.__rescue_retries,
+                                 latency=self.__latency)
+        unreadable = rescuer.Run()
+
+        digest = self.__SplitDigest()
+        self.__chunk_details = {}
+        journaled = self.__OpenJournal(destination_directory)
+        try:
+            for index, destination_path in enumerate(paths):
+                if index not in touched and self.__Journaled(journaled, index, destination_path, digest):
+                    self.__RestoreJournaled(index, journaled[index])
+                    continue
+
+                # A read at a time, rather than a whole chunk in memory
+                with open(destination_path, "rb") as chunk:
+                    size, chunk_digest = self.__HashStreamed(chunk, digest)
+                if rescue_map.Finished(index * self.__buffer_size, size):
+                    self.__RecordChunkDetails(index, size, chunk_digest)
+                else:
+                    # Not journaled: the next run might still fill in the holes
+                    self.__chunk_details[index] = (size, chunk_digest)
+                    self.__logger.warn("Chunk %d has unreadable pieces" % (index,))
+        finally:
+            self.__CloseJournal()
 
-        return result
+        extra = self.__Layout(width)
+        if unreadable:
+            extra.append(('Unreadable', unreadable))
+        self.__SaveDetails(count, digest, destination_directory, extra)
+        return unreadable == 0
 
     def __ActualSplitter(self):
         '''
@@ -502,7 +2154,13 @@ class Splicer:
         '''
         destination_directory = self.DestinationDirectory()
         count = 0
-        digest = hashlib.sha256()
+        digest = self.__SplitDigest()
+        self.__chunk_details = {}
+        journaled = {}
+
+        # The digest still gets updated here, strictly in order, so it doesn't
+        # matter what order the workers finish writing in
+        writers = pools.WorkerPool(self.__StartCompressing())
 
         try:
             if not os.path.exists(destination_directory):
@@ -511,100 +2169,118 @@ class Splicer:
                 self.__logger.warn("Using existing directory, in an attempt to restart")
                 # FIXME: If the .details file exists in the directory, read it and hope
                 # to find out how many files are supposed to be present
+            journaled = self.__OpenJournal(destination_directory)
 
             finished = False
+            width = self.__PickChunkDigits()
+            streaming = self.__Streaming()
 
             while True:
                 destination_path = self.__PickDestinationFileName(destination_directory,
-                                                          count)
+                                                                  count, width)
+                exists = (os.path.exists(destination_path) or
+                          self.__JournaledHole(journaled, count, destination_path, digest))
+                finished_earlier = exists and self.__Journaled(journaled, count, destination_path, digest)
+                if exists and self.__compressor is not None and not finished_earlier:
+                    # No telling whether it got compressed, or how. Start it over
+                    exists = False
         
-                if not os.path.exists(destination_path):
+                if not exists:
                     if finished:
                         # This is what we expect to see
                         # (finished, with no "next" file to deal with)
                         # Really should check that size match source's EOF.
                         # Maybe in a future version
                         break
-                    if self.__repairing:
-                        # it's tempting to do some prompting here. Maybe this
-                        # is a sector we're willing to concede is just bad and
-                        # skip, while we'd like to try another sector that failed
-                        # during the last run further down the line.
-                        # This is what I was trying initially, but it was annoying.
-                        
-                        # OTOH, this is pretty much the perfect opportunity to switch
-                        # into a recursive mode, trying to recover smaller chunks.
-
-                        # Should probably enable this option for non-repairing as well.
-                        # Or something along these lines, anyway
-                        block = self.__RepairBlock(self.__source, count)
-
-                        msg = "Is there enough in there to be worth trying to save?"
-                        commit = self.__ui.PromptForYorN(msg)
-                        if not commit:
-                            # Skip this block
+                    # Standard logic...not particularly worried about I/O failure.
+                    # (Repairs go through __RescueSplitter instead)
+                    try:
+                        # There are really two very different standpoints from a performance
+                        # standpoint. The first time through, there won't be any pre-existing
+                        # destination files. In that case, it really doesn't make any sense
+                        # to seek between reads.
+                        # OTOH, hopefully almost all the pieces were read the first time through.
+                        # On the second pass, we should already have the vast majority of chunks
+                        # (or we're *really* screwed), so it doesn't make any sense to seek
+                        # in source file *unless* there's a block to read
+                        # When the seek actually happens is the difference
+                        # between the repairing and standard versions. There's no particular
+                        # reason for the standard not to build as much of the broken splice
+                        # as possible                            
+
+                        if streaming:
+                            # Straight from the source to the chunk file, a
+                            # read at a time, so the whole chunk never has to
+                            # fit in memory
+                            bytes, chunk_digest, hole = self.__StreamChunk(self.__source, destination_path,
+                                                                           count * self.__buffer_size, digest)
+                            block = None
+                        else:
+                            block = self.__ReadBlock(self.__source, self.__buffer_size,
+                                                     count * self.__buffer_size)
+                            bytes = len(block)
+                        if not bytes:
+                            # EOF. We're done
+                            break
+                        if finished:
+                            # (No EOF even though the previously read chunk indicated that
+                            # it *should* be)
+                            # This isn't pretty, but I'm in a hurry.
+                            # Best bet is to just delete the file with the incorrect size
+                            # and try running this agais
+                            # (what this means is that a pre-existing destination file
+                            # had an incorrect bufferSize, but it wasn't the final
+                            # chunk)
+                            assert False, "Last destination file has wrong chunk size"
+
+                        self.__PossiblyThrowRandomErrorIfDebugging()
+
+                    except IOError, e:
+                        msg = "Error reading block # %d (%s). Keep trying?\n" % (count, str(e),)
+                        response = self.__ui.PromptForYorN(msg)
+                        if response:
+                            # Skip to the next block
                             count += 1
+
+                            # This is problematic. Don't really have any guarantee
+                            # that each read will get bufferSize bytes.
+                            # Even though that *is* the behavior I've seen so far.
+                            # Technically, I should be keeping a running total of all
+                            # the chunk sizes
+                            # Worry about it if it ever becomes an issue
+                            if not self.__repairing:
+                                # We've already established that we aren't in repairing mode.
+                                # *Very* strong evidence that this method is *way* too long and complicated
+                                # Could probably seek to self.__buffer_size, relative.
+                                # But, after an IOError, who knows where tell() is?
+                                self.__source.seek(count * self.__buffer_size)
                             continue
-            
-                    else:
-                        # Standard logic...not particularly worried about I/O failure
-                        try:
-                            # There are really two very different standpoints from a performance
-                            # standpoint. The first time through, there won't be any pre-existing
-                            # destination files. In that case, it really doesn't make any sense
-                            # to seek between reads.
-                            # OTOH, hopefully almost all the pieces were read the first time through.
-                            # On the second pass, we should already have the vast majority of chunks
-                            # (or we're *really* screwed), so it doesn't make any sense to seek
-                            # in source file *unless* there's a block to read
-                            # When the seek actually happens is the difference
-                            # between the repairing and standard versions. There's no particular
-                            # reason for the standard not to build as much of the broken splice
-                            # as possible                            
-
-                            block = self.__ReadBlock(self.__source, self.__buffer_size)
-                            if not block:
-                                # EOF. We're done
-                                break
-                            if finished:
-                                # (No EOF even though the previously read chunk indicated that
-                                # it *should* be)
-                                # This isn't pretty, but I'm in a hurry.
-                                # Best bet is to just delete the file with the incorrect size
-                                # and try running this agais
-                                # (what this means is that a pre-existing destination file
-                                # had an incorrect bufferSize, but it wasn't the final
-                                # chunk)
-                                assert False, "Last destination file has wrong chunk size"
-
-                            self.__PossiblyThrowRandomErrorIfDebugging()
-
-                        except IOError, e:
-                            msg = "Error reading block # %d (%s). Keep trying?\n" % (count, str(e),)
-                            response = ui.PromptForYorN(msg)
-                            if response:
-                                # Skip to the next block
-                                count += 1
-
-                                # This is problematic. Don't really have any guarantee
-                                # that each read will get bufferSize bytes.
-                                # Even though that *is* the behavior I've seen so far.
-                                # Technically, I should be keeping a running total of all
-                                # the chunk sizes
-                                # Worry about it if it ever becomes an issue
-                                if not self.__repairing:
-                                    # We've already established that we aren't in repairing mode.
-                                    # *Very* strong evidence that this method is *way* too long and complicated
-                                    # Could probably seek to self.__buffer_size, relative.
-                                    # But, after an IOError, who knows where tell() is?
-                                    self.__source.seek(count * self.__buffer_size)
-                                continue
-                            else:
-                                break
+                        else:
+                            break
 
                     # Save the chunk
-                    with open(destination_path, "wb") as destination:
-                        destination.write(block)
+                    if streaming:
+                        if hole:
+                            self.__RecordHole(count, bytes)
+                        else:
+                            self.__RecordChunkDetails(count, bytes, chunk_digest)
+                        if self.__buffer_size != bytes:
+                            finished = True
+                    elif self.__making_holes and self.__IsZero(block):
+                        self.__RecordHole(count, bytes)
+                    else:
+                        writers.Submit(self.__WriteChunk, destination_path, count, block)
+
+                elif finished_earlier:
+                    # Already wrote (and checkpointed) this chunk. No need to read it
+                    bytes = self.__RestoreJournaled(count, journaled[count])
+                    if self.__buffer_size != bytes:
+                        finished = True
+                    block = None
+
+                    if not self.__repairing:
+                        self.__source.seek(bytes, 1)
+                    self.__progress.Advance(bytes)
 
                 else: # already wrote this chunk
                     # Honestly, this is another special-case. Don't want to waste time on this
@@ -612,28 +2288,46 @@ class Splicer:
                     # Set this to something reasonable
                     bytes = self.__buffer_size
 
-                    # Read the destination file.
+                    # Read the destination file. Whatever wrote it never made it
+                    # as far as the journal (or this is an older version)
                     with open(destination_path, "rb") as destination:
-                        block = destination.read(self.__buffer_size)
-                        bytes = len(block)
+                        if streaming:
+                            bytes, chunk_digest = self.__HashStreamed(destination, digest)
+                            block = None
+                        else:
+                            block = destination.read(self.__buffer_size)
+                            bytes = len(block)
                         if self.__buffer_size != bytes:
                             finished = True
+                    if streaming:
+                        self.__RecordChunkDetails(count, bytes, chunk_digest)
+                    else:
+                        self.__RecordChunk(count, block)
 
                     if not self.__repairing:
                         # Again, the distinction between the two
                         self.__source.seek(bytes, 1)
+                    self.__progress.Advance(bytes)
           
-                # update the checksum
-                digest.update(block)
+                # update the checksum (streamed chunks already did)
+                if digest is not None and block is not None:
+                    self.__Hash(digest, block)
 
                 count  += 1
                 if (count % 1024) == 0:
                     self.__ui.UpdateProgress()
 
         finally:
-            # Don't necessarily want this to happen every time. It's worth
-            # contemplating
-            self.__SaveDetails(count, digest, destination_directory)
+            try:
+                # Everything that was read needs to actually land before the
+                # details claim it's there
+                writers.Close()
+            finally:
+                self.__CloseJournal()
+                # Don't necessarily want this to happen every time. It's worth
+                # contemplating
+                self.__SaveDetails(count, digest, destination_directory,
+                                   self.__Layout(self.__PickChunkDigits()))
 
             # FIXME: Make this go away. It's only here currently to make the change
             # more obvious in source control history
@@ -0,0 +1,251 @@
+#! /usr/bin/env python
+
+''' Reading a splice in place, as if it were the original file.
+
+A SplicedFile is a read-only file object over the chunks a .details
+describes. read(), readinto(), seek() and tell() work anywhere, across
+chunk boundaries, without merging anything first. So tarfile, zipfile, an
+image parser, or anything else that wants a seekable file can read
+straight out of a split, and there's no need for room to merge it into.
+
+Only the chunks that actually get read are opened, and only the most
+recently used few stay open. A compressed chunk has to be decompressed
+whole, so its handle is the decompressed chunk, in memory. A hole (see
+splice.Splicer.Sparse) reads as zeros without touching the disk. With
+read-ahead, moving on to the next chunk sends a background thread to pull
+the few after it into the page cache (or decompress them), so reading
+straight through doesn't stall at the start of every chunk.
+
+Nothing gets verified on the way through. That's what validating is for. '''
+
+import bisect, collections, errno, io, logging, os, Queue, threading
+import compression, splice, ui
+
+# How much the read-ahead thread reads at a time, warming the page cache
+_PREFETCH_READ_SIZE = 1024 * 1024
+
+_ZEROS = '\0' * (64 * 1024)
+
+class _Zeros:
+    ''' The handle for a hole a sparse split left (see splice.Splicer.Sparse) '''
+    def __init__(self, size):
+        self.__size = size
+        self.__position = 0
+
+    def seek(self, offset):
+        self.__position = offset
+
+    def readinto(self, view):
+        count = max(0, min(len(view), self.__size - self.__position))
+        for done in xrange(0, count, len(_ZEROS)):
+            piece = min(len(_ZEROS), count - done)
+            view[done:done + piece] = buffer(_ZEROS, 0, piece)
+        self.__position += count
+        return count
+
+    def close(self):
+        pass
+
+class SplicedFile:
+    ''' Like a file opened 'rb'. Not thread safe, any more than a file is '''
+    def __init__(self, details_path, handles=16, read_ahead=0):
+        ''' details_path is the splice's .details. handles is how many chunks
+        stay open at once. read_ahead is how many chunks past the one being
+        read get pulled in in the background (0 for none) '''
+        self.__logger = logging.getLogger("splice.SplicedFile")
+
+        directory, details_name = os.path.split(details_path)
+        splicer = splice.Splicer(ui.DoesNothing())
+        splicer.WorkingDirectory(directory or '.')
+        splicer.SourceFileName(details_name)
+        self.__chunks = splicer.ChunkMap()
+
+        # Where each chunk starts in the original file
+        self.__starts = []
+        offset = 0
+        for index, file_path, size, codec in self.__chunks:
+            self.__starts.append(offset)
+            offset += size
+        self.__size = offset
+        self.__position = 0
+
+        # Chunk number => open file (or decompressed chunk), least recently
+        # used first
+        self.__handles = collections.OrderedDict()
+        self.__handle_limit = max(1, handles)
+        self.__decompressor = compression.Pool(compression.RAW, processes=0)
+
+        self.__read_ahead = read_ahead
+        # Decompressed chunks the read-ahead thread got to first
+        self.__prefetched = collections.OrderedDict()
+        self.__lock = threading.Lock()
+        # The last chunk anything got read from, and the furthest one the
+        # read-ahead's been asked for
+        self.__current = None
+        self.__horizon = -1
+        self.__prefetch_queue = None
+        self.__prefetcher = None
+        if read_ahead:
+            self.__prefetch_queue = Queue.Queue()
+            self.__prefetcher = threading.Thread(target=self.__Prefetch, name="splice-read-ahead")
+            self.__prefetcher.daemon = True
+            self.__prefetcher.start()
+
+        # What callers expect to find on a file
+        self.name = details_path[:-len('.details')]
+        self.mode = 'rb'
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def Size(self):
+        return self.__size
+
+    def Chunks(self):
+        return len(self.__chunks)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def read(self, size=-1):
+        self.__CheckOpen()
+        available = max(0, self.__size - self.__position)
+        if size is None or size < 0 or size > available:
+            size = available
+        block = bytearray(size)
+        count = self.readinto(block)
+        if count < size:
+            del block[count:]
+        return str(block)
+
+    def readinto(self, target):
+        self.__CheckOpen()
+        view = memoryview(target)
+        done = 0
+        while done < len(view) and self.__position < self.__size:
+            # Empty chunks share their start with the next one. This finds
+            # the last of those, which is the one with the bytes
+            chunk = bisect.bisect_right(self.__starts, self.__position) - 1
+            offset = self.__position - self.__starts[chunk]
+            size = min(len(view) - done, self.__chunks[chunk][2] - offset)
+
+            handle = self.__Handle(chunk)
+            handle.seek(offset)
+            count = handle.readinto(view[done:done + size])
+            if not count:
+                raise IOError("'%s' is shorter than the .details says" % (self.__chunks[chunk][1],))
+            done += count
+            self.__position += count
+        return done
+
+    def seek(self, offset, whence=0):
+        self.__CheckOpen()
+        if whence == 1:
+            offset += self.__position
+        elif whence == 2:
+            offset += self.__size
+        if offset < 0:
+            raise IOError(errno.EINVAL, "Invalid argument")
+        self.__position = offset
+        return offset
+
+    def tell(self):
+        self.__CheckOpen()
+        return self.__position
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.__prefetcher is not None:
+            self.__prefetch_queue.put(None)
+            self.__prefetcher.join()
+            self.__prefetcher = None
+        for handle in self.__handles.values():
+            handle.close()
+        self.__handles.clear()
+        self.__prefetched.clear()
+
+    def __CheckOpen(self):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+
+    def __Handle(self, chunk):
+        ''' Something to seek() and readinto() for the chunk, opening it if need be '''
+        if chunk != self.__current:
+            self.__ReadAhead(chunk)
+            self.__current = chunk
+
+        if chunk in self.__handles:
+            # Most recently used goes last
+            handle = self.__handles.pop(chunk)
+        else:
+            index, file_path, size, codec = self.__chunks[chunk]
+            if codec == splice.HOLE:
+                handle = _Zeros(size)
+            elif codec == compression.RAW:
+                handle = open(file_path, "rb")
+            else:
+                with self.__lock:
+                    block = self.__prefetched.pop(chunk, None)
+                if block is None:
+                    block = self.__Decompressed(chunk)
+                handle = io.BytesIO(block)
+            while len(self.__handles) >= self.__handle_limit:
+                self.__handles.popitem(last=False)[1].close()
+        self.__handles[chunk] = handle
+        return handle
+
+    def __Decompressed(self, chunk):
+        index, file_path, size, codec = self.__chunks[chunk]
+        with open(file_path, "rb") as source:
+            return self.__decompressor.Decompress(codec, source.read())
+
+    def __ReadAhead(self, chunk):
+        ''' Reading just moved to chunk. Ask for the next few '''
+        if not self.__read_ahead:
+            return
+        if self.__current is None or chunk != self.__current + 1:
+            # Jumped somewhere. Whatever was coming up is probably no use now
+            self.__horizon = chunk
+        for wanted in range(max(chunk, self.__horizon) + 1,
+                            min(chunk + self.__read_ahead, len(self.__chunks) - 1) + 1):
+            self.__prefetch_queue.put(wanted)
+            self.__horizon = wanted
+
+    def __Prefetch(self):
+        ''' Runs on the read-ahead thread '''
+        scratch = bytearray(_PREFETCH_READ_SIZE)
+        while True:
+            chunk = self.__prefetch_queue.get()
+            if chunk is None:
+                return
+            if chunk <= self.__current or chunk in self.__handles or self.__chunks[chunk][3] == splice.HOLE:
+                # Already there, or nothing to read
+                continue
+            try:
+                if self.__chunks[chunk][3] == compression.RAW:
+                    # All it needs is to be in the page cache
+                    with open(self.__chunks[chunk][1], "rb") as source:
+                        while source.readinto(scratch):
+                            pass
+                else:
+                    block = self.__Decompressed(chunk)
+                    with self.__lock:
+                        self.__prefetched[chunk] = block
+                        while len(self.__prefetched) > self.__read_ahead:
+                            self.__prefetched.popitem(last=False)
+            except (IOError, OSError), e:
+                # Whatever actually reads it will find out
+                self.__logger.debug("Couldn't read ahead into chunk %d: %s" % (chunk, e))
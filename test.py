@@ -1,9 +1,9 @@
 #! /usr/bin/env/python
 
-import os, shutil, sys, unittest
+import hashlib, json, os, random, shutil, sys, tarfile, tempfile, time, unittest
 import io
 
-import splice, ui
+import benchmark, chunkstore, digests, jobs, myexceptions, progress, splice, splicedfile, tuning, ui
 
 class TestStreamSplicing(unittest.TestCase):
     buffer = """The quick red fox jumped over the lazy brown dog.
@@ -50,6 +50,7 @@ being obnoxious about that entire thing."""
         # Because tearDown() closes the old buffer
         self.__buffer = io.BytesIO(self.buffer)
         self.__BuildTestSplice()
+        self.__splicer.Operate()
 
         merger = splice.Splicer(ui.DoesNothing())
         merger.WorkingDirectory(self.__splicer.DestinationDirectory())
@@ -57,7 +58,7 @@ being obnoxious about that entire thing."""
         # Actually, if this fails, you probably have hardware issues
         # Except for the fact that it's so freaking flaky to get this set up.
         # This part of the interaction is horribly brittle
-        self.assertTrue(self.__splicer.Validate())
+        self.assertTrue(merger.Validate())
 
         dst = self.__splicer.DestinationDirectory()
         files = os.listdir(dst)
@@ -66,11 +67,11 @@ being obnoxious about that entire thing."""
             ext = f[-5:]
             if ext == 'chunk':
                 found_chunk = True
-                os.remove(f)
+                os.remove(os.path.join(dst, f))
                 break
         self.assertTrue(found_chunk)
 
-        self.assertFalse(self.__splicer.Validate())
+        self.assertFalse(merger.Validate())
 
     ##############################################################
     # Boiler Plate
@@ -104,5 +105,934 @@ being obnoxious about that entire thing."""
         del self.__splicer
         self.__buffer.close()
 
+class Pipe(io.BytesIO):
+    ''' Something that can only be read straight through, like STDIN '''
+    def seek(self, offset, whence=0):
+        raise IOError(29, "Illegal seek")
+
+class FailingDisk(io.BytesIO):
+    ''' Reads touching a bad range fail, until it's failed failures times '''
+    def __init__(self, contents, bad):
+        io.BytesIO.__init__(self, contents)
+        # [start, end, failures left]
+        self.bad = [list(piece) for piece in bad]
+        self.bytes_read = 0
+
+    def readinto(self, view):
+        start = self.tell()
+        for piece in self.bad:
+            if piece[2] and start < piece[1] and start + len(view) > piece[0]:
+                piece[2] -= 1
+                raise IOError(5, "Input/output error")
+        count = io.BytesIO.readinto(self, view)
+        self.bytes_read += count
+        return count
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self.getvalue()) - self.tell()
+        block = bytearray(max(0, size))
+        del block[self.readinto(block):]
+        return str(block)
+
+class SlowDisk(FailingDisk):
+    ''' Reads touching a slow range take their time. Remembers where it read '''
+    def __init__(self, contents, slow, delay):
+        FailingDisk.__init__(self, contents, [])
+        self.slow = slow
+        self.delay = delay
+        self.offsets = []
+
+    def readinto(self, view):
+        start = self.tell()
+        self.offsets.append(start)
+        if start < self.slow[1] and start + len(view) > self.slow[0]:
+            time.sleep(self.delay)
+        return FailingDisk.readinto(self, view)
+
+class TestSplitting(unittest.TestCase):
+    ''' Splits of a real (if small) file in a scratch directory '''
+    def test_ParallelWritersMatchSerial(self):
+        ''' Background chunk writers shouldn't change a thing about the output '''
+        serial = self.__Split("serial", 0)
+        parallel = self.__Split("parallel", 4)
+        self.__AssertSameSplit(serial, parallel)
+
+    def test_ZeroCopyMatchesSerial(self):
+        ''' Kernel-side copies should produce the same chunks and details '''
+        serial = self.__Split("serial", 0)
+        zero_copy = self.__Split("zero-copy", 3, zero_copy=True)
+        self.__AssertSameSplit(serial, zero_copy)
+
+    def test_DirectMatchesSerial(self):
+        ''' Unaligned chunks read with O_DIRECT (or not, where that's refused) '''
+        serial = self.__Split("serial", 0)
+        direct = self.__Split("direct", 2, direct=True)
+        self.__AssertSameSplit(serial, direct)
+
+    def test_ChunkAndIOSizes(self):
+        ''' Small reads make the same chunks. Left alone, the chunk size comes from the targets '''
+        serial = self.__Split("serial", 0)
+        os.mkdir("small-reads")
+        os.chdir("small-reads")
+        try:
+            splicer = splice.Splicer(ui.DoesNothing())
+            splicer.BufferSize(self.chunk_size)
+            splicer.IOSize(300)
+            splicer.SourceFileName(self.source_name)
+            with open(self.source_name, "rb") as source:
+                splicer.Source(source)
+                splicer.Operate()
+            self.__AssertSameSplit(serial, splicer.DestinationDirectory())
+
+            for count, maximum, expected in ((5, None, 5), (5, 4000, 10), (None, 6000, 7)):
+                splicer = splice.Splicer(ui.DoesNothing())
+                if count is not None:
+                    splicer.ChunkCount(count)
+                if maximum is not None:
+                    splicer.MaximumChunkSize(maximum)
+                splicer.SourceFileName("%s-%s.bin" % (count, maximum))
+                with open(self.source_name, "rb") as source:
+                    splicer.Source(source)
+                    splicer.Operate()
+                with open(os.path.join(splicer.DestinationDirectory(), splicer.SourceFileName() + ".details")) as details:
+                    self.assertTrue("Chunk Count: %d\n" % (expected,) in details.read())
+        finally:
+            os.chdir(self.__scratch)
+
+        # Whole reads per chunk, where that still fits under the cap
+        self.assertEqual(2 * 65536, tuning.PickChunkSize(2 ** 30, 65536, 10000, 10 ** 6))
+        self.assertEqual(15 * 65536, tuning.PickChunkSize(2 ** 30, 65536, 10, 10 ** 6))
+        self.assertEqual(tuning.DEFAULT_MAXIMUM_CHUNK, tuning.PickChunkSize(None, 65536))
+
+    def test_StreamedChunks(self):
+        ''' Chunks bigger than a read go through one small buffer, both ways '''
+        serial = self.__Split("serial", 0)
+        os.mkdir("streamed")
+        os.chdir("streamed")
+        try:
+            for restart in (False, True):
+                splicer = splice.Splicer(ui.DoesNothing())
+                splicer.BufferSize(self.chunk_size)
+                splicer.IOSize(256)
+                splicer.SourceFileName(self.source_name)
+                with open(self.source_name, "rb") as source:
+                    splicer.Source(source)
+                    splicer.Operate()
+                destination = splicer.DestinationDirectory()
+                if not restart:
+                    # Without the journal, the restart has to read every chunk back
+                    os.remove(os.path.join(destination, "source.bin.journal"))
+                    os.remove(os.path.join(destination, "source.bin.05.chunk"))
+            self.__AssertSameSplit(serial, destination)
+
+            for read_ahead in (0, 1):
+                merger = splice.Splicer(ui.DoesNothing())
+                merger.WorkingDirectory(destination)
+                merger.SourceFileName("source.bin.details")
+                merger.SetMergeMode()
+                merger.ReadAhead(read_ahead)
+                merger.IOSize(100)
+                merger.MergeDestination("merged.bin")
+                self.assertTrue(merger.Operate())
+                with open(self.source_name, "rb") as expected:
+                    with open("merged.bin", "rb") as actual:
+                        self.assertEqual(expected.read(), actual.read())
+        finally:
+            os.chdir(self.__scratch)
+
+    def test_DigestChoices(self):
+        ''' Whatever the split hashed with, the .details says so, and merges and validations follow it '''
+        for name in [name for name in ("sha1", "blake2b", "crc32", "adler32") if name in digests.Available()]:
+            os.mkdir(name)
+            os.chdir(name)
+            try:
+                splicer = splice.Splicer(ui.DoesNothing())
+                splicer.BufferSize(self.chunk_size)
+                splicer.Digest(name)
+                splicer.SourceFileName(self.source_name)
+                with open(self.source_name, "rb") as source:
+                    splicer.Source(source)
+                    splicer.Operate()
+                destination = os.path.abspath(splicer.DestinationDirectory())
+                details_name = os.path.join(destination, "source.bin.details")
+                with open(details_name) as details:
+                    expected = details.read()
+                with open(self.source_name, "rb") as source:
+                    first = digests.New(name, source.read(self.chunk_size)).hexdigest()
+                self.assertTrue("Digest: %s\n" % (name,) in expected)
+                self.assertTrue("Chunk: 0 %d %s\n" % (self.chunk_size, first) in expected)
+
+                # A restart that hashes differently can't trust the journal
+                os.remove(details_name)
+                splicer = splice.Splicer(ui.DoesNothing())
+                splicer.BufferSize(self.chunk_size)
+                splicer.SourceFileName(self.source_name)
+                with open(self.source_name, "rb") as source:
+                    splicer.Source(source)
+                    splicer.Operate()
+                with open(details_name) as details:
+                    self.assertFalse("Digest:" in details.read())
+
+                splicer = splice.Splicer(ui.DoesNothing())
+                splicer.BufferSize(self.chunk_size)
+                splicer.Digest(name)
+                splicer.SourceFileName(self.source_name)
+                with open(self.source_name, "rb") as source:
+                    splicer.Source(source)
+                    splicer.Operate()
+                with open(details_name) as details:
+                    self.assertEqual(expected, details.read())
+            finally:
+                os.chdir(self.__scratch)
+
+            self.assertTrue(self.__Validator(destination).Validate(thorough=True))
+            merged = self.__Merge(destination, 2)
+            with open(self.source_name, "rb") as expected:
+                with open(merged, "rb") as actual:
+                    self.assertEqual(expected.read(), actual.read())
+
+            with open(os.path.join(destination, "source.bin.03.chunk"), "r+b") as chunk:
+                chunk.write("corrupt")
+            self.assertFalse(self.__Validator(destination).Validate(thorough=True))
+
+        self.assertRaises(ValueError, splice.Splicer(ui.DoesNothing()).Digest, "rot13")
+
+        # 0.0.2 has nowhere to say it's anything but sha256, whichever gets set first
+        splicer = splice.Splicer(ui.DoesNothing())
+        splicer.Version("0.0.2")
+        self.assertRaises(myexceptions.VersionError, splicer.Digest, "sha1")
+        splicer.Digest("sha256")
+        splicer = splice.Splicer(ui.DoesNothing())
+        splicer.Digest("sha1")
+        self.assertRaises(myexceptions.VersionError, splicer.Version, "0.0.2")
+        splicer.Version("0.0.3")
+
+    def test_RestartFromJournal(self):
+        ''' A restarted split only has to fill in what's missing '''
+        destination = self.__Split("split", 2)
+        details_name = os.path.join(destination, "source.bin.details")
+        with open(details_name) as details:
+            expected = details.read()
+
+        # Pretend it died part way through
+        os.remove(details_name)
+        for name in ("source.bin.07.chunk", "source.bin.37.chunk"):
+            os.remove(os.path.join(destination, name))
+        journal_name = os.path.join(destination, "source.bin.journal")
+        with open(journal_name) as journal:
+            entries = journal.readlines()
+        with open(journal_name, "w") as journal:
+            journal.writelines(entries[:20])
+            # Torn write
+            journal.write(entries[20][:10])
+
+        self.__Split("split", 0, create=False)
+        with open(details_name) as details:
+            self.assertEqual(expected, details.read())
+
+    def test_VerifyRange(self):
+        ''' Checking a few chunks only reads those few chunks '''
+        destination = self.__Split("split", 0)
+        victim = os.path.join(destination, "source.bin.05.chunk")
+        with open(victim, "r+b") as chunk:
+            chunk.write("corrupt")
+
+        validator = self.__Validator(destination)
+        self.assertTrue(validator.Validate(thorough=True, chunks=range(10, 20)))
+        self.assertFalse(validator.Validate(thorough=True, chunks=range(0, 10)))
+
+        # Fixing up the .details to match doesn't help: the root won't add up
+        with open(victim, "rb") as chunk:
+            forged = hashlib.sha256(chunk.read()).hexdigest()
+        details_name = os.path.join(destination, "source.bin.details")
+        with open(details_name) as details:
+            lines = details.readlines()
+        with open(details_name, "w") as details:
+            for line in lines:
+                if line.startswith("Chunk: 5 "):
+                    line = "Chunk: 5 1000 %s\n" % (forged,)
+                details.write(line)
+        validator = self.__Validator(destination)
+        self.assertFalse(validator.Validate(thorough=True, chunks=[5]))
+
+    def test_ValidationLevels(self):
+        ''' Each level catches more, and says exactly which chunks are the problem '''
+        destination = self.__Split("split", 0)
+        def Chunk(index):
+            return os.path.join(destination, "source.bin.%02d.chunk" % (index,))
+        os.remove(Chunk(3))
+        with open(Chunk(8), "r+b") as chunk:
+            chunk.truncate(500)
+        open(Chunk(9), "w").close()
+        with open(Chunk(20), "r+b") as chunk:
+            chunk.write("corrupt")
+
+        validator = self.__Validator(destination)
+        report = validator.ValidationReport("count")
+        self.assertEqual([3], report.missing)
+        self.assertEqual([], report.short)
+
+        report = validator.ValidationReport("stat")
+        self.assertEqual([3], report.missing)
+        self.assertEqual([8, 9], report.short)
+        self.assertEqual([], report.checked)
+
+        report = validator.ValidationReport("sample", sample=5)
+        self.assertEqual(5, len(report.checked))
+
+        report = json.loads(validator.ValidationReport("full").ToJSON())
+        self.assertFalse(report['ok'])
+        self.assertEqual([20], report['corrupt'])
+        self.assertEqual(35, report['checked'])
+
+    def test_EmptySource(self):
+        ''' Nothing to split still round-trips, and checks out '''
+        open(self.source_name, "wb").close()
+        destination = self.__Split("empty", 0)
+
+        validator = self.__Validator(destination)
+        for level in ("stat", "sample", "full"):
+            report = validator.ValidationReport(level, sample=3)
+            self.assertTrue(report.Ok())
+            self.assertEqual([], report.checked)
+
+        merged = self.__Merge(destination, 0)
+        self.assertEqual(0, os.path.getsize(merged))
+
+    def test_RescueFailingSource(self):
+        ''' Bad areas get mapped, and the next run only goes after those '''
+        with open(self.source_name, "rb") as source:
+            contents = source.read()
+        # One area that stays bad for the whole first run, and one that
+        # comes good when it's retried
+        disk = FailingDisk(contents, [(10240, 12800, 1000), (20000, 20010, 2)])
+
+        def Rescue(disk):
+            splicer = splice.Splicer(ui.DoesNothing())
+            splicer.BufferSize(self.chunk_size)
+            splicer.SetRepairSplice(True)
+            splicer.SourceFileName("source.bin")
+            splicer.Source(disk)
+            return splicer.Operate(), splicer.DestinationDirectory()
+
+        complete, destination = Rescue(disk)
+        self.assertFalse(complete)
+        with open(os.path.join(destination, "source.bin.details")) as details:
+            self.assertTrue("Unreadable: 2560\n" in details.read())
+        with open(os.path.join(destination, "source.bin.11.chunk"), "rb") as chunk:
+            self.assertEqual("\0" * 1000, chunk.read())
+
+        healed = FailingDisk(contents, [])
+        complete, destination = Rescue(healed)
+        self.assertTrue(complete)
+        # Just the sectors that were still bad
+        self.assertEqual(2560, healed.bytes_read)
+
+        self.assertTrue(self.__Validator(destination).Validate(thorough=True))
+        merged = self.__Merge(destination, 0)
+        with open(merged, "rb") as actual:
+            self.assertEqual(contents, actual.read())
+
+    def test_RescueWithoutChunkSize(self):
+        ''' Picking the sizes doesn't go reading the failing source first '''
+        contents = os.urandom(4 * 2 ** 20)
+        bad = (200000, 300000)
+        self.assertEqual(tuning.PreferredIOSize(FailingDisk(contents, [bad + (1,)])),
+                         tuning.ProbeIOSize(FailingDisk(contents, [bad + (1,)]), len(contents)))
+
+        splicer = splice.Splicer(ui.DoesNothing())
+        splicer.SetRepairSplice(True)
+        splicer.SourceFileName("source.bin")
+        splicer.Source(FailingDisk(contents, [bad + (1000,)]))
+        self.assertFalse(splicer.Operate())
+        with open(os.path.join(splicer.DestinationDirectory(), "source.bin.details")) as details:
+            unreadable = [int(line.split()[1]) for line in details if line.startswith("Unreadable:")]
+        # Whole sectors of it
+        self.assertEqual(1, len(unreadable))
+        self.assertTrue(100000 <= unreadable[0] < 100000 + 2 * 512)
+
+    def test_RescueDefersSlowAreas(self):
+        ''' The healthy areas get read first, and the report says where it was slow '''
+        with open(self.source_name, "rb") as source:
+            contents = source.read()
+        disk = SlowDisk(contents, (10240, 10752), 0.05)
+
+        splicer = splice.Splicer(ui.DoesNothing())
+        splicer.BufferSize(self.chunk_size)
+        splicer.SetRepairSplice(True)
+        splicer.ReadLatency(threshold=0.02)
+        splicer.SourceFileName("source.bin")
+        splicer.Source(disk)
+        self.assertTrue(splicer.Operate())
+
+        # The slow block itself got kept, but what came right after it waited
+        # until everything else was done
+        self.assertTrue(disk.offsets.index(10240) < disk.offsets.index(36864) < disk.offsets.index(10752))
+
+        destination = splicer.DestinationDirectory()
+        with open(os.path.join(destination, "source.bin.latency")) as report:
+            report = json.load(report)
+        self.assertEqual(10240, report['slow_regions'][0]['offset'])
+        self.assertEqual(len(disk.offsets), sum(bucket['count'] for bucket in report['histogram']))
+        self.assertTrue('#' in report['heat_map_text'] or '@' in report['heat_map_text'])
+        merged = self.__Merge(destination, 0)
+        with open(merged, "rb") as actual:
+            self.assertEqual(contents, actual.read())
+
+    def test_StreamingSplit(self):
+        ''' No size up front, and more than 10 chunks, which used to break the names '''
+        with open(self.source_name, "rb") as source:
+            pipe = Pipe(source.read())
+
+        splicer = splice.Splicer(ui.DoesNothing())
+        splicer.BufferSize(self.chunk_size)
+        splicer.Workers(2)
+        splicer.WorkingDirectory(self.__scratch)
+        splicer.SourceFileName("source.bin")
+        splicer.Source(pipe)
+        self.assertTrue(splicer.Streaming())
+        splicer.Operate()
+
+        destination = splicer.DestinationDirectory()
+        self.assertTrue(self.__Validator(destination).Validate(thorough=True))
+        merged = self.__Merge(destination, 2)
+        with open(self.source_name, "rb") as expected:
+            with open(merged, "rb") as actual:
+                self.assertEqual(expected.read(), actual.read())
+
+    def test_PipelinedMergeRoundTrip(self):
+        ''' Split, then merge it back together with and without read-ahead '''
+        destination = self.__Split("split", 0)
+        for read_ahead in (0, 3):
+            merged = self.__Merge(destination, read_ahead)
+            with open(self.source_name, "rb") as expected:
+                with open(merged, "rb") as actual:
+                    self.assertEqual(expected.read(), actual.read())
+            os.remove(merged)
+
+    def test_ThoroughValidateFindsCorruption(self):
+        ''' Same size, same count, different bytes '''
+        destination = self.__Split("split", 2)
+        validator = self.__Validator(destination)
+        self.assertTrue(validator.Validate(thorough=True))
+
+        victim = os.path.join(destination, sorted(os.listdir(destination))[5])
+        with open(victim, "r+b") as chunk:
+            chunk.seek(10)
+            chunk.write("corrupt")
+        validator = self.__Validator(destination)
+        # A simple count has no way of noticing
+        self.assertTrue(validator.Validate())
+        self.assertFalse(validator.Validate(thorough=True))
+
+    def test_MergeToSink(self):
+        ''' Merge into anything with a write(), without touching the disk '''
+        destination = self.__Split("split", 0)
+        sink = io.BytesIO()
+        merger = self.__Validator(destination)
+        merger.SetMergeMode()
+        merger.MergeDestination(sink)
+        self.assertTrue(merger.Operate())
+        with open(self.source_name, "rb") as expected:
+            self.assertEqual(expected.read(), sink.getvalue())
+        self.assertFalse(os.path.exists(os.path.join(destination, "source.bin")))
+
+    def test_PreallocatedMergeRoundTrip(self):
+        ''' Chunks copied straight to their offsets, in parallel '''
+        destination = self.__Split("split", 0)
+        merged = self.__Merge(destination, 0, preallocate=True)
+        with open(self.source_name, "rb") as expected:
+            with open(merged, "rb") as actual:
+                self.assertEqual(expected.read(), actual.read())
+
+    def test_BackgroundJobs(self):
+        ''' Several splits queued at once, without anybody to answer prompts '''
+        runner = jobs.JobRunner(2, BufferSize=self.chunk_size, Workers=1)
+        names = []
+        for i in range(3):
+            name = os.path.join(self.__scratch, "source%d.bin" % (i,))
+            shutil.copy(self.source_name, name)
+            names.append(name)
+        splits = [runner.Split(name, self.__scratch) for name in names]
+
+        for job, name in zip(splits, names):
+            events = list(job.Events())
+            self.assertEqual("started", events[0]['event'])
+            self.assertEqual("finished", events[-1]['event'])
+            # At least the final one, which has every byte
+            self.assertEqual(set(["progress"]), set(event['event'] for event in events[1:-1]))
+            self.assertTrue(events[-2]['final'])
+            self.assertEqual(os.path.getsize(name), events[-2]['bytes_done'])
+            details = os.path.join(job.Result(), os.path.basename(name) + ".details")
+            self.assertTrue(runner.Validate(details, thorough=True).Result(5))
+        runner.Close()
+
+    def test_BatchOfManifests(self):
+        ''' A directory of splits, a few at a time, each one summarized '''
+        sources = os.path.join(self.__scratch, "sources")
+        os.mkdir(sources)
+        for i in range(4):
+            shutil.copy(self.source_name, os.path.join(sources, "source%d.bin" % (i,)))
+        inputs = jobs.ExpandInputs([sources])
+        self.assertEqual(4, len(inputs))
+
+        runner = jobs.JobRunner(3, io_limit=2, BufferSize=self.chunk_size, Workers=1)
+        for job in [runner.Split(name, self.__scratch) for name in inputs]:
+            job.Wait()
+        manifests = jobs.ExpandInputs([self.__scratch + "/*.split"], manifests=True)
+        self.assertEqual(4, len(manifests))
+        manifests.append(os.path.join(self.__scratch, "missing.details"))
+        checks = [runner.Validate(name, level="sample", sample=3) for name in manifests]
+        runner.Close()
+
+        summaries = [job.Summary() for job in checks]
+        self.assertEqual([True] * 4 + [False], [summary['ok'] for summary in summaries])
+        self.assertTrue(summaries[-1]['error'])
+        json.dumps(summaries)
+
+    def test_BatchOfSameNames(self):
+        ''' Two splits of different files that happen to have the same name '''
+        runner = jobs.JobRunner(2, BufferSize=self.chunk_size)
+        originals = []
+        for name in ("x", "y"):
+            directory = os.path.join(self.__scratch, name)
+            os.mkdir(directory)
+            original = os.path.join(directory, "disk.img")
+            with open(original, "wb") as f:
+                f.write(os.urandom(self.chunk_size * 5 + 17))
+            originals.append(original)
+            runner.Split(original, directory).Wait()
+        manifests = [os.path.join(original + ".split", "disk.img.details") for original in originals]
+
+        merges = [runner.Merge(name) for name in manifests]
+        clash = os.path.join(self.__scratch, "disk.img")
+        clashing = [runner.Merge(name, clash) for name in manifests]
+        runner.Close()
+
+        self.assertEqual([True, True], [job.Succeeded() for job in merges])
+        for original, manifest in zip(originals, manifests):
+            with open(original, "rb") as expected:
+                with open(manifest[:-len('.details')], "rb") as merged:
+                    self.assertEqual(expected.read(), merged.read())
+        # Whichever got there second didn't get to write over the first
+        self.assertEqual([True, False], [job.Succeeded() for job in clashing])
+        with open(originals[0], "rb") as expected:
+            with open(clash, "rb") as merged:
+                self.assertEqual(expected.read(), merged.read())
+
+    def test_Benchmark(self):
+        ''' Same sources every time, and a result for every operation '''
+        first, second = [os.path.join(self.__scratch, name) for name in ("first", "second")]
+        for name in (first, second):
+            benchmark.Generate(name, 3 * 2 ** 20 + 5, "sparse", seed=7)
+        with open(first, "rb") as one:
+            with open(second, "rb") as other:
+                self.assertEqual(one.read(), other.read())
+
+        results = benchmark.Run(self.__scratch, kinds=("mixed",), buffer_sizes=(self.chunk_size,),
+                                chunk_counts=(20,), repeat=1)
+        self.assertEqual(list(benchmark.OPERATIONS), [result['operation'] for result in results])
+        report = {'format': 1, 'results': results}
+        self.assertEqual([], benchmark.Compare(report, report))
+
+    def test_ProgressEvents(self):
+        ''' Where the bytes went, and how long each stage took '''
+        class Collect:
+            def __init__(self):
+                self.events = []
+            def Event(self, event):
+                self.events.append(event)
+            def Close(self):
+                pass
+        sink = Collect()
+        lines = io.BytesIO()
+        splicer = splice.Splicer(ui.DoesNothing())
+        splicer.BufferSize(self.chunk_size)
+        splicer.Progress().AddSink(sink)
+        splicer.Progress().AddSink(progress.JSONLines(lines))
+        splicer.SourceFileName(self.source_name)
+        with open(self.source_name, "rb") as source:
+            splicer.Source(source)
+            splicer.Operate()
+
+        final = sink.events[-1]
+        self.assertTrue(final['final'])
+        self.assertEqual(self.chunk_size * 37 + 123, final['bytes_done'])
+        self.assertEqual(final['bytes_total'], final['bytes_done'])
+        for stage in (progress.READ, progress.HASH, progress.WRITE, progress.FSYNC):
+            self.assertTrue(final['stages'][stage] > 0)
+        self.assertEqual("split", json.loads(lines.getvalue().splitlines()[-1])['operation'])
+
+        # Used to be a NameError, every 1024 chunks
+        stdout, sys.stdout = sys.stdout, io.BytesIO()
+        try:
+            interface = ui.UI()
+            interface.UpdateProgress()
+            interface.UpdateProgress()
+            self.assertEqual("# 1K chunks, # 2K chunks, ", sys.stdout.getvalue())
+        finally:
+            sys.stdout = stdout
+
+    def test_ContentDefinedCuts(self):
+        ''' With numpy or without, the same content gets cut in the same places '''
+        if chunkstore.numpy is None:
+            self.skipTest("No numpy, so only the one way to find the cuts")
+        random_source = random.Random(11)
+        contents = "".join(chr(random_source.randrange(256)) for i in xrange(300000))
+        # Something repetitive, where cuts are few and far between
+        contents = contents[:100000] + "\0" * 50000 + "abc" * 30000 + contents[100000:]
+
+        def Cuts():
+            return [len(chunk) for chunk in
+                    chunkstore.ContentDefinedChunks(io.BytesIO(contents), 2048, 8192, 32768)]
+        fast = Cuts()
+        numpy, chunkstore.numpy = chunkstore.numpy, None
+        try:
+            slow = Cuts()
+        finally:
+            chunkstore.numpy = numpy
+        self.assertEqual(slow, fast)
+        self.assertEqual(len(contents), sum(fast))
+
+    def test_ContentDefinedDedup(self):
+        ''' The next snapshot only adds the chunks around what changed '''
+        store = os.path.join(self.__scratch, "store")
+        with open(self.source_name, "rb") as source:
+            original = source.read()
+        edited = original[:4321] + "inserted" + original[4321:]
+
+        def Split(name, contents):
+            splicer = splice.Splicer(ui.DoesNothing())
+            splicer.BufferSize(self.chunk_size)
+            splicer.Workers(2)
+            splicer.ChunkStore(store)
+            splicer.SourceFileName(name)
+            splicer.Source(Pipe(contents))
+            splicer.Operate()
+            return splicer.DestinationDirectory()
+        def Stored():
+            return sum(len(files) for _, _, files in os.walk(store))
+
+        first = Split("first.bin", original)
+        before = Stored()
+        second = Split("second.bin", edited)
+        # With fixed-size chunks, nothing after the insert would line up
+        self.assertTrue(0 < Stored() - before <= 3)
+
+        for destination, name, expected in ((first, "first.bin", original),
+                                            (second, "second.bin", edited)):
+            merger = splice.Splicer(ui.DoesNothing())
+            merger.WorkingDirectory(destination)
+            merger.SourceFileName(name + ".details")
+            self.assertTrue(merger.Validate(thorough=True))
+            merger.SetMergeMode()
+            sink = io.BytesIO()
+            merger.MergeDestination(sink)
+            self.assertTrue(merger.Operate())
+            self.assertEqual(expected, sink.getvalue())
+
+    def test_NestedLayout(self):
+        ''' Thousands of chunks, a few hundred per directory, and no listing needed to merge them '''
+        self.chunk_size = 10
+        destination = self.__Split("split", 2)
+        for directory, subdirectories, files in os.walk(destination):
+            self.assertTrue(len(subdirectories) + len(files) <= 1001)
+        self.assertTrue(os.path.exists(os.path.join(destination, "3", "source.bin.3712.chunk")))
+
+        self.assertTrue(self.__Validator(destination).Validate(thorough=True))
+        merged = self.__Merge(destination, 2)
+        with open(self.source_name, "rb") as expected:
+            with open(merged, "rb") as actual:
+                self.assertEqual(expected.read(), actual.read())
+
+        # Chunk files the Layout doesn't account for: one past the end, and
+        # one in the wrong directory
+        os.mkdir(os.path.join(destination, "9"))
+        shutil.copy(os.path.join(destination, "3", "source.bin.3712.chunk"),
+                    os.path.join(destination, "9", "source.bin.9999.chunk"))
+        shutil.copy(os.path.join(destination, "3", "source.bin.3712.chunk"), destination)
+        report = self.__Validator(destination).ValidationReport("count")
+        self.assertEqual([3712, 9999], report.extra)
+        self.assertEqual([], report.missing)
+
+        # A smaller split from the same process gets fewer digits
+        self.chunk_size = 10000
+        destination = self.__Split("again", 0)
+        self.assertTrue(os.path.exists(os.path.join(destination, "source.bin.3.chunk")))
+
+    def test_FlatOlderVersions(self):
+        ''' Before 0.0.5, every chunk goes right in the split directory, however many there are '''
+        os.mkdir("split")
+        os.chdir("split")
+        try:
+            splicer = splice.Splicer(ui.DoesNothing())
+            splicer.BufferSize(10)
+            splicer.Version("0.0.2")
+            splicer.SourceFileName(self.source_name)
+            with open(self.source_name, "rb") as source:
+                splicer.Source(source)
+                splicer.Operate()
+            destination = os.path.abspath(splicer.DestinationDirectory())
+        finally:
+            os.chdir(self.__scratch)
+
+        names = os.listdir(destination)
+        self.assertTrue("source.bin.3712.chunk" in names)
+        self.assertEqual(3713, len([name for name in names if name.endswith(".chunk")]))
+        self.assertFalse(any(os.path.isdir(os.path.join(destination, name)) for name in names))
+        with open(os.path.join(destination, "source.bin.details")) as details:
+            self.assertFalse("Layout:" in details.read())
+        merged = self.__Merge(destination, 2)
+        with open(self.source_name, "rb") as expected:
+            with open(merged, "rb") as actual:
+                self.assertEqual(expected.read(), actual.read())
+
+    def test_CompressedRoundTrip(self):
+        ''' Compressible chunks shrink, random ones get stored raw, and it all merges back '''
+        with open(self.source_name, "rb") as random_source:
+            noise = random_source.read(self.chunk_size * 5)
+        with open(self.source_name, "wb") as source:
+            source.write("All work and no play makes Jack a dull boy. " * 500)
+            source.write(noise)
+
+        os.mkdir("split")
+        os.chdir("split")
+        try:
+            splicer = splice.Splicer(ui.DoesNothing())
+            splicer.BufferSize(self.chunk_size)
+            splicer.Workers(2)
+            splicer.Compression("zlib")
+            splicer.SourceFileName(self.source_name)
+            with open(self.source_name, "rb") as source:
+                splicer.Source(source)
+                splicer.Operate()
+            destination = os.path.abspath(splicer.DestinationDirectory())
+        finally:
+            os.chdir(self.__scratch)
+
+        sizes = [os.path.getsize(os.path.join(destination, name))
+                 for name in sorted(os.listdir(destination)) if name.endswith(".chunk")]
+        self.assertTrue(sizes[0] < self.chunk_size / 2)
+        self.assertEqual(self.chunk_size, sizes[-2])
+
+        self.assertTrue(self.__Validator(destination).Validate(thorough=True))
+        for preallocate in (False, True):
+            merged = self.__Merge(destination, 2, preallocate)
+            with open(self.source_name, "rb") as expected:
+                with open(merged, "rb") as actual:
+                    self.assertEqual(expected.read(), actual.read())
+            os.remove(merged)
+
+        with splicedfile.SplicedFile(os.path.join(destination, "source.bin.details"), 2, 2) as spliced:
+            with open(self.source_name, "rb") as expected:
+                self.assertEqual(expected.read(), spliced.read())
+                expected.seek(-1500, 2)
+                spliced.seek(-1500, 2)
+                self.assertEqual(expected.read(1000), spliced.read(1000))
+
+    def test_SplicedFile(self):
+        ''' Reading a split in place, anywhere, without merging it '''
+        destination = self.__Split("split", 0)
+        with open(self.source_name, "rb") as source:
+            expected = source.read()
+
+        for handles, read_ahead in ((1, 0), (4, 3)):
+            spliced = splicedfile.SplicedFile(os.path.join(destination, "source.bin.details"), handles, read_ahead)
+            self.assertEqual(len(expected), spliced.Size())
+            self.assertEqual(38, spliced.Chunks())
+            # Straight through, in pieces that keep straddling chunks
+            pieces = []
+            while True:
+                piece = spliced.read(777)
+                if not piece:
+                    break
+                pieces.append(piece)
+            self.assertEqual(expected, "".join(pieces))
+
+            random.seed(read_ahead)
+            for attempt in range(50):
+                offset = random.randint(0, len(expected))
+                size = random.randint(0, 3 * self.chunk_size)
+                spliced.seek(offset)
+                self.assertEqual(expected[offset:offset + size], spliced.read(size))
+                self.assertEqual(min(offset + size, len(expected)), spliced.tell())
+
+            target = bytearray(2500)
+            spliced.seek(-100, 1)
+            position = spliced.tell()
+            self.assertEqual(min(2500, len(expected) - position), spliced.readinto(target))
+            self.assertEqual(expected[position:position + 2500], str(target[:len(expected) - position]))
+            spliced.close()
+            self.assertRaises(ValueError, spliced.read)
+
+        # Straight into something that expects a real file
+        with open("archive.tar", "wb") as archive_file:
+            archive = tarfile.open(fileobj=archive_file, mode="w")
+            archive.add(self.source_name, "source.bin")
+            archive.close()
+        self.source_name = os.path.abspath("archive.tar")
+        destination = self.__Split("archive", 0)
+        with splicedfile.SplicedFile(os.path.join(destination, "archive.tar.details"), 2, 1) as spliced:
+            archive = tarfile.open(fileobj=spliced)
+            self.assertEqual(expected, archive.extractfile("source.bin").read())
+
+    def test_SparsePlacedMerge(self):
+        ''' Preallocating a sparse merge doesn't allocate the holes '''
+        probe = os.path.join(self.__scratch, "probe")
+        with open(probe, "wb") as f:
+            f.truncate(2 ** 20)
+        if os.stat(probe).st_blocks:
+            self.skipTest("This filesystem doesn't do sparse files")
+
+        self.chunk_size = 64 * 1024
+        data = os.urandom(self.chunk_size)
+        contents = data + "\0" * (30 * self.chunk_size) + data
+        with open(self.source_name, "wb") as source:
+            source.write(contents)
+
+        os.chdir(self.__scratch)
+        splicer = splice.Splicer(ui.DoesNothing())
+        splicer.BufferSize(self.chunk_size)
+        splicer.Sparse(True)
+        splicer.SourceFileName(self.source_name)
+        with open(self.source_name, "rb") as source:
+            splicer.Source(source)
+            splicer.Operate()
+        destination = os.path.abspath(splicer.DestinationDirectory())
+
+        merged = self.__Merge(destination, 2, preallocate=True)
+        with open(merged, "rb") as actual:
+            self.assertEqual(contents, actual.read())
+        # Room for the two chunks of data, give or take a block or two
+        self.assertTrue(os.stat(merged).st_blocks * 512 <= 4 * self.chunk_size)
+
+    def test_SparseRoundTrip(self):
+        ''' All-zero chunks become holes, and come back as zeros (and holes) '''
+        with open(self.source_name, "rb") as source:
+            original = source.read()
+        # A run of zero chunks, one that's zero only part way, and a zero tail
+        contents = (original[:3000] + "\0" * 7000 + original[10000:10500] + "\0" * 1500 +
+                    original[12000:-123] + "\0" * 123)
+        with open(self.source_name, "wb") as source:
+            source.write(contents)
+        holes = [3, 4, 5, 6, 7, 8, 9, 11, 37]
+
+        splits = {}
+        for name, io_size, zero_copy in (("whole", None, False), ("streamed", 256, False), ("zero-copy", None, True)):
+            os.mkdir(name)
+            os.chdir(name)
+            try:
+                for attempt in range(2):
+                    # The second time through, the journal already has everything
+                    splicer = splice.Splicer(ui.DoesNothing())
+                    splicer.BufferSize(self.chunk_size)
+                    splicer.Sparse(True)
+                    splicer.ZeroCopy(zero_copy)
+                    if io_size is not None:
+                        splicer.IOSize(io_size)
+                    splicer.SourceFileName(self.source_name)
+                    with open(self.source_name, "rb") as source:
+                        splicer.Source(source)
+                        splicer.Operate()
+                splits[name] = os.path.abspath(splicer.DestinationDirectory())
+            finally:
+                os.chdir(self.__scratch)
+
+        for name, destination in splits.items():
+            chunks = sorted(name for name in os.listdir(destination) if name.endswith(".chunk"))
+            self.assertEqual(38 - len(holes), len(chunks))
+            with open(os.path.join(destination, "source.bin.details")) as details:
+                recorded = [int(line.split()[1]) for line in details if line.endswith(" hole\n")]
+            self.assertEqual(holes, recorded)
+            self.assertTrue(self.__Validator(destination).Validate(thorough=True))
+
+            for preallocate in (False, True):
+                merged = self.__Merge(destination, 2, preallocate)
+                with open(merged, "rb") as actual:
+                    self.assertEqual(contents, actual.read())
+                os.remove(merged)
+            with splicedfile.SplicedFile(os.path.join(destination, "source.bin.details")) as spliced:
+                self.assertEqual(contents, spliced.read())
+        self.__AssertSameSplit(splits["whole"], splits["streamed"])
+
+        # Streaming it out, there's nowhere to seek to
+        merger = splice.Splicer(ui.DoesNothing())
+        merger.WorkingDirectory(splits["whole"])
+        merger.SourceFileName("source.bin.details")
+        merger.SetMergeMode()
+        sink = io.BytesIO()
+        merger.MergeDestination(sink)
+        self.assertTrue(merger.Operate())
+        self.assertEqual(contents, sink.getvalue())
+
+    ##############################################################
+    # Boiler Plate
+    ##############################################################
+
+    def __AssertSameSplit(self, expected_directory, actual_directory):
+        ''' Same chunks, same details. The journals are in whatever order the chunks landed '''
+        names = [name for name in os.listdir(expected_directory) if not name.endswith(".journal")]
+        self.assertEqual(sorted(names),
+                         sorted(name for name in os.listdir(actual_directory) if not name.endswith(".journal")))
+        for name in names:
+            with open(os.path.join(expected_directory, name), "rb") as expected:
+                with open(os.path.join(actual_directory, name), "rb") as actual:
+                    self.assertEqual(expected.read(), actual.read())
+
+    def __Validator(self, destination):
+        validator = splice.Splicer(ui.DoesNothing())
+        validator.WorkingDirectory(destination)
+        validator.SourceFileName(os.path.basename(self.source_name) + ".details")
+        return validator
+
+    def __Merge(self, destination, read_ahead, preallocate=False):
+        ''' Returns the path to the merged file '''
+        os.chdir(destination)
+        try:
+            merger = splice.Splicer(ui.DoesNothing())
+            merger.SetMergeMode()
+            merger.ReadAhead(read_ahead)
+            merger.Preallocate(preallocate)
+            merger.SourceFileName(os.path.basename(self.source_name) + ".details")
+            self.assertTrue(merger.Operate())
+            return os.path.abspath(os.path.basename(self.source_name))
+        finally:
+            os.chdir(self.__scratch)
+
+    def __Split(self, subdirectory, workers, zero_copy=False, create=True, direct=False):
+        ''' Returns the destination directory '''
+        if create:
+            os.mkdir(subdirectory)
+        os.chdir(subdirectory)
+        try:
+            splicer = splice.Splicer(ui.DoesNothing())
+            splicer.BufferSize(self.chunk_size)
+            splicer.Workers(workers)
+            splicer.ZeroCopy(zero_copy)
+            splicer.DirectIO(direct)
+            splicer.SourceFileName(self.source_name)
+            with open(self.source_name, "rb") as source:
+                splicer.Source(source)
+                splicer.Operate()
+            return os.path.abspath(splicer.DestinationDirectory())
+        finally:
+            os.chdir(self.__scratch)
+
+    def setUp(self):
+        self.__original_directory = os.getcwd()
+        self.__scratch = tempfile.mkdtemp(prefix="splice-test-")
+        os.chdir(self.__scratch)
+
+        self.chunk_size = 1000
+        self.source_name = os.path.join(self.__scratch, "source.bin")
+        with open(self.source_name, "wb") as source:
+            # Deliberately not a multiple of the chunk size
+            source.write(os.urandom(self.chunk_size * 37 + 123))
+
+    def tearDown(self):
+        os.chdir(self.__original_directory)
+        shutil.rmtree(self.__scratch)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,115 @@
+#! /usr/bin/env python
+
+''' Picking read sizes and chunk sizes, so nobody has to.
+
+Two different things:
+- The I/O size is how much each read() asks for. Too small and the
+  per-call overhead dominates. Too big and nothing overlaps, and memory
+  use balloons. It depends on the device, so it gets measured.
+- The chunk size is how big each chunk file is. It depends on how many
+  files anybody wants to deal with (and how big a file the destination
+  can take), so it comes from a target chunk count and/or a cap. '''
+
+import logging, os, time
+
+# Never read less than this at a time, whatever st_blksize says
+SMALLEST_IO = 64 * 1024
+# ...or more than this
+LARGEST_IO = 8 * 1024 * 1024
+
+# How many chunks an auto-tuned split aims for, and how big they can get,
+# unless somebody says otherwise
+DEFAULT_CHUNK_COUNT = 256
+DEFAULT_MAXIMUM_CHUNK = 64 * 1024 * 1024
+
+# A bigger read has to be at least this much faster to be worth it
+_WORTHWHILE = 1.1
+
+def PreferredIOSize(source):
+    ''' What the filesystem (or device) says it likes, rounded into the sane range '''
+    try:
+        blksize = os.fstat(source.fileno()).st_blksize
+    except (AttributeError, IOError, OSError, ValueError):
+        # In-memory sources and the like
+        blksize = 0
+    size = SMALLEST_IO
+    while size < blksize and size < LARGEST_IO:
+        size *= 2
+    return size
+
+def ProbeIOSize(source, source_size, start=None, budget=0.25):
+    ''' Time reads of a few sizes from source, and return the smallest that
+    comes within reach of the fastest.
+
+    Each size reads from a different part of the source, so none of them
+    gets a free ride from the page cache. Gives up on the bigger sizes once
+    budget seconds are up, or once the reads would cover more than an
+    eighth of the source. Leaves the position where it found it. A read
+    that fails means the source is in no shape to be measured, so that
+    just gets start back. '''
+    logger = logging.getLogger("splice.tuning")
+    if start is None:
+        start = PreferredIOSize(source)
+    candidates = []
+    size = start
+    while size <= LARGEST_IO:
+        candidates.append(size)
+        size *= 2
+    # Reads per candidate: enough to smooth over the first one's seek
+    reads = 4
+
+    position = source.tell()
+    spent = 0.0
+    offset = 0
+    rates = []
+    try:
+        for size in candidates:
+            if offset + size * reads > source_size / 8 or spent > budget:
+                break
+            source.seek(offset)
+            started = time.time()
+            try:
+                for read in range(reads):
+                    if not source.read(size):
+                        break
+            except IOError, e:
+                logger.warn("Couldn't probe the I/O size (%s). Reading %d bytes at a time" % (e, start))
+                return start
+            elapsed = max(time.time() - started, 1e-6)
+            spent += elapsed
+            offset += size * reads
+            rates.append((size, size * reads / elapsed))
+    finally:
+        source.seek(position)
+
+    if not rates:
+        # Too small to be worth measuring
+        return start
+    best = rates[0]
+    for size, rate in rates[1:]:
+        if rate > best[1] * _WORTHWHILE:
+            best = (size, rate)
+    logger.debug("I/O size probe: %s => %d" %
+                 (", ".join("%dK: %.0f MB/s" % (size / 1024, rate / 2 ** 20) for size, rate in rates), best[0]))
+    return best[0]
+
+def PickChunkSize(source_size, io_size, count=None, maximum=None):
+    ''' Chunks of a whole number of I/O-sized reads, as close to count of them
+    as fits under maximum. source_size is None when it's unknown (STDIN) '''
+    if count is None and maximum is None:
+        count, maximum = DEFAULT_CHUNK_COUNT, DEFAULT_MAXIMUM_CHUNK
+    if source_size is None or count is None:
+        size = maximum or DEFAULT_MAXIMUM_CHUNK
+    else:
+        size = (source_size + count - 1) / count
+        if maximum is not None:
+            size = min(size, maximum)
+
+    if size <= io_size:
+        # Smaller than one read anyway
+        return max(1, size)
+    # Whole reads, unless that would blow through the cap
+    rounded = (size + io_size - 1) / io_size * io_size
+    if maximum is not None and rounded > maximum:
+        rounded = maximum / io_size * io_size
+    return rounded
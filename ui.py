@@ -3,6 +3,8 @@
 ''' Think of this as the View part of MVC.
 I'm trying to split the UI away from program logic. '''
 
+import logging, sys
+
 class UI:
     def __init__(self):
         # For a cheesy command-line "progress bar". Sufficient for now, though
@@ -15,8 +17,11 @@ class UI:
         return response.strip()[0].lower() == 'y'
 
     def UpdateProgress(self):
-        msg = "# %dK, " % (self.__current_kilo,)
+        ''' Called every 1024 chunks. progress.TerminalBar says a lot more '''
+        self.__current_kilo += 1
+        msg = "# %dK chunks, " % (self.__current_kilo,)
         sys.stdout.write (msg)
+        sys.stdout.flush()
 
 class DoesNothing:
     ''' Really just for testing '''
@@ -25,3 +30,20 @@ class DoesNothing:
 
     def UpdateProgress(self):
         pass
+
+class Unattended:
+    ''' Answers every prompt from a fixed policy instead of asking anybody.
+
+    For running inside services, where there's nobody at a terminal.
+    keep_going is the answer to every "Keep trying?" style question: True
+    skips past unreadable blocks, False gives up at the first one. '''
+    def __init__(self, keep_going=False):
+        self.__keep_going = keep_going
+        self.__logger = logging.getLogger("splice.Unattended")
+
+    def PromptForYorN(self, msg):
+        self.__logger.warn("%s => %s" % (msg.strip(), self.__keep_going and "yes" or "no"))
+        return self.__keep_going
+
+    def UpdateProgress(self):
+        pass
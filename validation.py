@@ -0,0 +1,81 @@
+#! /usr/bin/env python
+
+''' What a validation found, in a form other programs can read.
+
+The levels, cheapest first:
+count: every chunk file exists
+stat: ...and is the size the .details says. Reads nothing but directories
+sample: ...and a random sample of chunks hash to what the .details says
+full: ...and so does every single chunk '''
+
+import json
+
+COUNT = 'count'
+STAT = 'stat'
+SAMPLE = 'sample'
+FULL = 'full'
+
+LEVELS = (COUNT, STAT, SAMPLE, FULL)
+
+# How many chunks a sample reads, unless somebody says otherwise
+DEFAULT_SAMPLE = 32
+
+class Report:
+    ''' Chunk indices, by what's wrong with them '''
+    def __init__(self, level, chunk_count):
+        if level not in LEVELS:
+            raise ValueError("Unknown validation level '%s'. Have: %s" % (level, ", ".join(LEVELS)))
+        self.level = level
+        self.chunk_count = chunk_count
+
+        # No file at all
+        self.missing = []
+        # Smaller than the .details says. Usually an interrupted write
+        self.short = []
+        # Bigger than the .details says
+        self.oversized = []
+        # Right size, wrong contents
+        self.corrupt = []
+        # Chunk files the .details doesn't know anything about
+        self.extra = []
+
+        # Which chunks actually got read and hashed
+        self.checked = []
+        # Whether the chunk digests add up to the .details checksum. None
+        # when that didn't get checked
+        self.checksum_matches = None
+
+    def Ok(self):
+        return (not (self.missing or self.short or self.oversized or self.corrupt or self.extra)
+                and self.checksum_matches is not False)
+
+    def Summary(self):
+        ''' One line, for logs and people '''
+        problems = []
+        for name in ('missing', 'short', 'oversized', 'corrupt', 'extra'):
+            indices = getattr(self, name)
+            if indices:
+                shown = ", ".join(str(index) for index in indices[:10])
+                if len(indices) > 10:
+                    shown += ", ... (%d in all)" % (len(indices),)
+                problems.append("%s: %s" % (name, shown))
+        if self.checksum_matches is False:
+            problems.append("checksum doesn't match")
+        if not problems:
+            return "%s validation of %d chunks: OK" % (self.level, self.chunk_count)
+        return "%s validation of %d chunks: %s" % (self.level, self.chunk_count, "; ".join(problems))
+
+    def ToDict(self):
+        return {'level': self.level,
+                'chunk_count': self.chunk_count,
+                'ok': self.Ok(),
+                'missing': self.missing,
+                'short': self.short,
+                'oversized': self.oversized,
+                'corrupt': self.corrupt,
+                'extra': self.extra,
+                'checked': len(self.checked),
+                'checksum_matches': self.checksum_matches}
+
+    def ToJSON(self):
+        return json.dumps(self.ToDict(), sort_keys=True)